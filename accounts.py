@@ -0,0 +1,25 @@
+from sqlalchemy import text
+
+# The user rows read and written by registration, login and the write routes,
+# as steps (see db.run_steps) shared by the Flask routes and asgi.py.
+
+USER_BY_ID = text('SELECT id, username, password_hash, follower_count FROM user WHERE id = :id')
+USER_BY_USERNAME = text('SELECT id, username, password_hash, follower_count FROM user WHERE username = :username')
+INSERT_USER = text('INSERT INTO user (username, password_hash, follower_count) VALUES (:username, :password_hash, 0)')
+SET_PASSWORD_HASH = text('UPDATE user SET password_hash = :password_hash WHERE id = :id')
+
+def user_by_id(user_id):
+    rows = yield USER_BY_ID, {'id': user_id}
+    return rows[0] if rows else None
+
+def user_by_username(username):
+    rows = yield USER_BY_USERNAME, {'username': username}
+    return rows[0] if rows else None
+
+def add_user(username, password_hash):
+    yield INSERT_USER, {'username': username, 'password_hash': password_hash}
+
+# The user cache does not see this change, so call invalidate_user once it is
+# committed.
+def set_password_hash(user_id, password_hash):
+    yield SET_PASSWORD_HASH, {'id': user_id, 'password_hash': password_hash}
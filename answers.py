@@ -0,0 +1,36 @@
+import math
+
+# Answers of the routes, as (body, status) or (body, status, headers) like a
+# Resource method returns them. The Flask routes, the async handlers of
+# asgi.py and the results of POST /batch all give these, so a request gets
+# the same answer whichever of them serves it.
+FIELDS_REQUIRED = {'error': 'Fields are required to be filled.'}, 400
+INVALID_PAGE = {'error': 'Invalid limit or cursor.'}, 400
+PASSWORD_MISMATCH = {'error': 'Password mismatch!'}, 401
+USER_EXISTS = {'error': 'User exists, try another username!'}, 409
+INCORRECT_PASSWORD = {'error': 'Incorrect password!'}, 401
+MESSAGE_SENT = {'success': 'Message has been sent!'}, 200
+TWEET_POSTED = {'success': 'Tweet has been posted!'}, 200
+TWEET_UPDATED = {'success': 'Tweet has been updated!'}, 200
+TWEET_DELETED = {'success': 'Tweet has been deleted!'}, 200
+TWEET_NOT_FOUND = {'error': 'Tweet Not Found'}, 404
+NOT_YOUR_TWEET = {'error': 'You can only change your own Tweets.'}, 403
+ALREADY_LIKED = {'error': 'You have already liked this Tweet!'}, 409
+NOT_LIKED = {'error': 'You have not liked this Tweet!'}, 409
+
+def user_not_found(username):
+    return {'error':'Cannot find user with username ' + username}, 404
+
+def liked(like):
+    return {'success': 'Liked the Tweet! Like count is now '+ str(like) + '!'}, 200
+
+def unliked(like):
+    return {'success': 'Unliked the Tweet! Like count is now '+ str(like) + '!'}, 200
+
+# Returned when too many passwords are waiting to be hashed.
+def busy():
+    return {'error': 'Server is busy, try again later.'}, 503, {'Retry-After': '1'}
+
+# The answer to a client that has to wait seconds before its next request.
+def too_many_requests(wait):
+    return {'error': 'Too many requests, try again later.'}, 429, {'Retry-After': str(math.ceil(wait))}
@@ -1,11 +1,24 @@
 from flask import Flask
 from flask_login import LoginManager
 from flask_restful import Api
-from db import initialize_db, db
-from models import User
+from db import initialize_db
 from routes import initialize_routes
+from like_buffer import init_like_buffer
+from stream import init_broker
+from user_cache import init_user_cache
+from passwords import init_hash_pool
+from versions import init_response_cache
+from bulk import load_command
+from metrics import init_metrics, BUCKETS
+from ratelimit import init_rate_limiter
+from trending import init_trending
+from pages import init_pages
+from archive import init_archive, archive_command
+from schema import create_schema, init_db_command
 
-def create_app(test):
+# Extra settings can be passed in config, for example by benchmarks that need
+# their own database or want to turn on optional features.
+def create_app(test=False, config=None):
     app = Flask(__name__)
 
     # Configurate database sqlite
@@ -14,13 +27,122 @@ def create_app(test):
     else:
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///twitter_clone.db"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    # Outside tests the database uses the production profile of db.py: WAL and
+    # tuned pragmas, a pool of DATABASE_POOL_SIZE connections and a read-only
+    # pool of DATABASE_READ_POOL_SIZE connections for GET handlers.
+    app.config["DATABASE_PROFILE"] = None if test else "production"
+    app.config["DATABASE_POOL_SIZE"] = 8
+    app.config["DATABASE_READ_POOL_SIZE"] = 16
     app.config["SECRET_KEY"] = "LeapGrad"
 
-    initialize_db(app)
+    # Likes are written straight to the database unless LIKE_BUFFER is set.
+    # Then they are collected in memory and written in batches every
+    # LIKE_FLUSH_INTERVAL_MS milliseconds or LIKE_FLUSH_MAX_EVENTS likes,
+    # trading fresh like counts for write throughput.
+    app.config["LIKE_BUFFER"] = False
+    app.config["LIKE_FLUSH_INTERVAL_MS"] = 100
+    app.config["LIKE_FLUSH_MAX_EVENTS"] = 1000
+
+    # New tweets are pushed into the home timelines of the author's followers,
+    # unless the author has more than TIMELINE_FANOUT_LIMIT followers. Then
+    # followers pull them when reading their timeline. Following a user copies
+    # their latest TIMELINE_BACKFILL tweets into the follower's timeline.
+    app.config["TIMELINE_FANOUT_LIMIT"] = 10000
+    app.config["TIMELINE_BACKFILL"] = 100
+
+    # Each /stream connection buffers at most STREAM_QUEUE_SIZE events, sends a
+    # heartbeat after STREAM_HEARTBEAT_SECONDS without events, and replays at
+    # most STREAM_REPLAY_LIMIT messages and tweets when it resumes.
+    app.config["STREAM_QUEUE_SIZE"] = 100
+    app.config["STREAM_HEARTBEAT_SECONDS"] = 15
+    app.config["STREAM_REPLAY_LIMIT"] = 500
+
+    # Logged in users are cached for USER_CACHE_TTL seconds, at most
+    # USER_CACHE_SIZE of them, so that most requests do not load their user.
+    app.config["USER_CACHE_SIZE"] = 10000
+    app.config["USER_CACHE_TTL"] = 60
+
+    # Passwords are hashed with PASSWORD_HASH_METHOD in a pool of
+    # PASSWORD_HASH_WORKERS processes (one per CPU when None, inline when 0).
+    # Logins and registrations past PASSWORD_HASH_MAX_PENDING waiting hashes
+    # get a 503 (no limit when 0). Hashes made with another method are redone
+    # at login.
+    app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:260000"
+    app.config["PASSWORD_HASH_WORKERS"] = None
+    app.config["PASSWORD_HASH_MAX_PENDING"] = 64
+
+    # /search ranks the newest SEARCH_WINDOW matches of a query with BM25,
+    # which bounds its cost however many tweets match.
+    app.config["SEARCH_WINDOW"] = 2000
+
+    # Up to TWEET_CACHE_SIZE encoded pages of the current tweet listing are
+    # kept in memory.
+    app.config["TWEET_CACHE_SIZE"] = 256
+
+    # /trending ranks the tweets of the last TRENDING_WINDOW_HOURS by likes,
+    # halving the weight of a tweet every TRENDING_HALF_LIFE_HOURS of its age.
+    # The index is updated by posts and likes and rebuilt from the database
+    # every TRENDING_REFRESH_SECONDS.
+    app.config["TRENDING_HALF_LIFE_HOURS"] = 6
+    app.config["TRENDING_WINDOW_HOURS"] = 48
+    app.config["TRENDING_REFRESH_SECONDS"] = 60
+
+    # With ARCHIVE_DATABASE set to a file, `flask archive` moves the messages
+    # and tweets older than ARCHIVE_AFTER_DAYS into it, compressed in segments
+    # of ARCHIVE_SEGMENT_SIZE rows, and the histories, conversations, inbox and
+    # tweet listing read on into the archive past the hot database.
+    app.config["ARCHIVE_DATABASE"] = None
+    app.config["ARCHIVE_AFTER_DAYS"] = 90
+    app.config["ARCHIVE_SEGMENT_SIZE"] = 256
 
-    @app.before_first_request
-    def create_table():
-        db.create_all()
+    # POST /batch takes at most BATCH_MAX_OPERATIONS operations. Each of them
+    # counts against the rate limit of its single endpoint.
+    app.config["BATCH_MAX_OPERATIONS"] = 100
+
+    # POST /bulk/tweets inserts BULK_BATCH_SIZE rows per transaction.
+    app.config["BULK_BATCH_SIZE"] = 5000
+
+    # With METRICS, the latency (in METRICS_BUCKETS), SQL queries and response
+    # size of every request are recorded per endpoint and served at /metrics,
+    # and requests slower than METRICS_SLOW_REQUEST_MS are logged with their
+    # queries (0 turns the log off).
+    app.config["METRICS"] = False
+    app.config["METRICS_BUCKETS"] = BUCKETS
+    app.config["METRICS_SLOW_REQUEST_MS"] = 500
+
+    # Requests to the routes in RATE_LIMITS are limited per user, or per client
+    # address before login, to the given number per second, minute, hour or
+    # day. Limits are kept in memory in each process unless RATE_LIMIT_STORE
+    # is set to a shared store (see ratelimit.TokenBuckets). The unit tests,
+    # which log in over and over from one address, run without limits.
+    app.config["RATE_LIMIT"] = not test
+    app.config["RATE_LIMIT_STORE"] = None
+    app.config["RATE_LIMITS"] = {
+        "register": "10/minute",
+        "login": "30/minute",
+        "chat": "60/minute",
+        "read": "120/minute",
+        "tweet": "30/minute",
+        "like": "120/minute",
+        "follow": "60/minute",
+        "bulk": "10/minute",
+    }
+
+    if config:
+        app.config.update(config)
+
+    initialize_db(app)
+    init_like_buffer(app)
+    init_broker(app)
+    init_user_cache(app)
+    init_hash_pool(app)
+    init_response_cache(app)
+    init_metrics(app)
+    init_rate_limiter(app)
+    init_trending(app)
+    init_archive(app)
+    init_pages(app)
 
     # User session maintenance is managed by Flask-Login
     login = LoginManager(app)
@@ -29,7 +151,16 @@ def create_app(test):
 
     @login.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        return app.extensions['user_cache'].load(int(id))
+
+    # Creating the tables, once before the app is first served: flask init-db
+    app.cli.add_command(init_db_command)
+
+    # Offline loading of NDJSON files: flask load users|tweets|messages FILE
+    app.cli.add_command(load_command)
+
+    # Moving old rows to the archive: flask archive [--days N] [--vacuum]
+    app.cli.add_command(archive_command)
 
     # Set up routes using Flask-RESTful
     api = Api(app)
@@ -39,4 +170,5 @@ def create_app(test):
 
 if __name__ == "__main__":
     app = create_app(test=False)
+    create_schema(app)
     app.run(debug=True)
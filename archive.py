@@ -0,0 +1,308 @@
+import heapq
+import itertools
+import json
+import zlib
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import (Column, DateTime, Index, Integer, LargeBinary, MetaData, String, Table, and_, create_engine,
+                        event, func, or_, select, text)
+from models import User, Message, Tweet, TweetLike, TimelineEntry
+from messages import message_key, key_time
+from versions import bump_version, current_version
+from db import db
+
+# Cold storage for old messages and tweets, in a separate SQLite file. Rows are
+# stored in segments: up to segment_size rows, JSON encoded and compressed
+# with zlib together, so that the repeated names and words of neighbouring
+# rows compress well. Message segments hold the messages of one sender to one
+# recipient in time order, and tweet segments hold consecutive tweet ids. Each
+# segment row keeps the range of ids and times it covers, which is all the
+# archive indexes, so it stays a small fraction of the hot indexes.
+#
+# `flask archive` moves the rows older than ARCHIVE_AFTER_DAYS: it writes the
+# segments and a watermark in one archive transaction, then deletes the rows
+# from the hot database. Readers only read hot rows above the watermark, so a
+# job that stops between the two commits never shows a row twice, and the
+# next run deletes what is left. Messages are archived by time; tweets by id,
+# below the first tweet that is newer than the cutoff, so the archived tweets
+# always come right below the hot ones in the listing.
+#
+# Archived tweets leave the timelines and the search index, and their likes
+# are kept as a count only.
+#
+# Every request that reads through needs the watermarks, so each process keeps
+# them in memory. The job bumps the 'archive' version of the hot database when
+# it deletes what it moved, and a process reads the watermarks again once it
+# sees a new version.
+
+metadata = MetaData()
+
+message_segment = Table(
+    'message_segment', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('sender_id', Integer, nullable=False),
+    Column('recipient_id', Integer, nullable=False),
+    Column('first_at', DateTime, nullable=False),
+    Column('last_at', DateTime, nullable=False),
+    Column('min_id', Integer, nullable=False),
+    Column('max_id', Integer, nullable=False),
+    Column('count', Integer, nullable=False),
+    Column('data', LargeBinary, nullable=False),
+    # Serve the sent and received histories and the conversations in time order.
+    Index('ix_message_segment_sender_id_recipient_id_last_at', 'sender_id', 'recipient_id', 'last_at'),
+    Index('ix_message_segment_recipient_id_sender_id_last_at', 'recipient_id', 'sender_id', 'last_at'),
+)
+
+tweet_segment = Table(
+    'tweet_segment', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('min_id', Integer, nullable=False),
+    Column('max_id', Integer, nullable=False),
+    Column('count', Integer, nullable=False),
+    Column('data', LargeBinary, nullable=False),
+    Index('ix_tweet_segment_max_id', 'max_id'),
+)
+
+# The watermarks: 'message' is the created_at below which messages are
+# archived, 'tweet' the id below which tweets are.
+archive_state = Table(
+    'archive_state', metadata,
+    Column('name', String(16), primary_key=True),
+    Column('value', String(32), nullable=False),
+)
+
+# Segments are written this many at a time.
+INSERT_BATCH = 100
+
+def _pack(records):
+    return zlib.compress(json.dumps(records, separators=(',', ':')).encode(), 6)
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data))
+
+# Archived rows have the attributes of the hot rows, so the same serializers
+# and cursors work on both.
+def _messages(data):
+    return [SimpleNamespace(id=m[0], sender_id=m[1], recipient_id=m[2], _from=m[3], _to=m[4], content=m[5],
+                            created_at=datetime.fromisoformat(m[6])) for m in _unpack(data)]
+
+def _tweets(data):
+    return [SimpleNamespace(id=t[0], uid=t[1], username=t[2], title=t[3], content=t[4], like=t[5],
+                            created_at=datetime.fromisoformat(t[6])) for t in _unpack(data)]
+
+class Archive:
+    def __init__(self, path, segment_size=256):
+        self.engine = create_engine('sqlite:///' + path, connect_args={'check_same_thread': False, 'timeout': 5})
+        self.segment_size = segment_size
+        # (archive version, watermarks) last read. Threads may race to replace
+        # it, which at worst costs another read.
+        self.cached = None
+
+        # WAL, so that readers go on while the job writes.
+        @event.listens_for(self.engine, 'connect')
+        def set_pragmas(connection, record):
+            connection.execute('PRAGMA journal_mode = WAL')
+
+    # Called by create_schema, with the tables of the main database.
+    def create_all(self):
+        metadata.create_all(self.engine)
+
+    # The watermarks as of the last archive version. The version is read first,
+    # so the watermarks kept are never older than the version they go with.
+    def watermarks(self):
+        version = current_version('archive')
+        cached = self.cached
+        if cached is None or cached[0] != version:
+            cached = self.cached = (version, self._read_watermarks())
+        return cached[1]
+
+    def _read_watermarks(self):
+        with self.engine.connect() as connection:
+            state = dict(connection.execute(select(archive_state.c.name, archive_state.c.value)).fetchall())
+        return {
+            'message': datetime.fromisoformat(state['message']) if 'message' in state else None,
+            'tweet': int(state.get('tweet', 0)),
+        }
+
+    # The archived messages sent (column is 'sender_id') or received ('recipient_id')
+    # by user_id, oldest first, up to the message watermark until. Segments of
+    # one peer follow each other in time and the peers are merged, so only one
+    # segment per peer is decompressed at a time.
+    def history(self, user_id, column, until):
+        other = 'recipient_id' if column == 'sender_id' else 'sender_id'
+        query = select(message_segment.c[other], message_segment.c.data) \
+            .where(message_segment.c[column] == user_id, message_segment.c.first_at < until) \
+            .order_by(message_segment.c[other], message_segment.c.last_at)
+        with self.engine.connect() as connection:
+            segments = connection.execute(query).fetchall()
+        peers = [itertools.chain.from_iterable(map(_messages, [segment.data for segment in group]))
+                 for peer, group in itertools.groupby(segments, key=lambda segment: segment[0])]
+        return heapq.merge(*peers, key=message_key)
+
+    # The archived part of a conversation page, as messages.conversation.
+    def conversation(self, user_id, peer_id, limit, before=None):
+        messages = self._direction(user_id, peer_id, limit, before)
+        if peer_id != user_id:
+            messages += self._direction(peer_id, user_id, limit, before)
+        messages.sort(key=message_key, reverse=True)
+        return messages[:limit]
+
+    def _direction(self, sender_id, recipient_id, limit, before):
+        query = select(message_segment.c.data) \
+            .where(message_segment.c.sender_id == sender_id, message_segment.c.recipient_id == recipient_id)
+        if before is not None:
+            query = query.where(message_segment.c.first_at <= key_time(before[0]))
+        messages = []
+        with self.engine.connect() as connection:
+            for segment in connection.execute(query.order_by(message_segment.c.last_at.desc())):
+                messages += [m for m in reversed(_messages(segment.data)) if before is None or message_key(m) < before]
+                if len(messages) >= limit:
+                    break
+        return messages[:limit]
+
+    # One archived message of the conversation between two users, or None.
+    def message(self, user_id, peer_id, message_id):
+        pair = or_(
+            and_(message_segment.c.sender_id == user_id, message_segment.c.recipient_id == peer_id),
+            and_(message_segment.c.sender_id == peer_id, message_segment.c.recipient_id == user_id),
+        )
+        query = select(message_segment.c.data) \
+            .where(pair, message_segment.c.min_id <= message_id, message_segment.c.max_id >= message_id)
+        with self.engine.connect() as connection:
+            for segment in connection.execute(query):
+                for message in _messages(segment.data):
+                    if message.id == message_id:
+                        return message
+        return None
+
+    # The archived tweets below the id before, newest first.
+    def tweets(self, limit, before=None):
+        query = select(tweet_segment.c.data)
+        if before is not None:
+            query = query.where(tweet_segment.c.min_id < before)
+        tweets = []
+        with self.engine.connect() as connection:
+            for segment in connection.execute(query.order_by(tweet_segment.c.max_id.desc())):
+                tweets += [t for t in reversed(_tweets(segment.data)) if before is None or t.id < before]
+                if len(tweets) >= limit:
+                    break
+        return tweets[:limit]
+
+    # Move the messages created before cutoff and the tweets below the first
+    # one created after it, and return how many of each were moved. Needs an
+    # app context.
+    def archive(self, cutoff):
+        report = {'messages': 0, 'tweets': 0, 'segments': 0}
+        marks = self._read_watermarks()
+
+        if marks['message'] is None or cutoff > marks['message']:
+            query = db.session.query(Message).filter(Message.created_at < cutoff)
+            if marks['message'] is not None:
+                query = query.filter(Message.created_at >= marks['message'])
+            query = query.order_by(Message.sender_id, Message.recipient_id, Message.created_at, Message.id) \
+                .yield_per(self.segment_size * INSERT_BATCH)
+            pairs = itertools.groupby(query, key=lambda m: (m.sender_id, m.recipient_id))
+            segments = (self._message_segment(pair, chunk) for pair, messages in pairs for chunk in self._chunks(messages))
+            self._write(segments, 'message', cutoff.isoformat(sep=' '), report, 'messages')
+            db.session.rollback()
+            db.session.execute(Message.__table__.delete().where(Message.created_at < cutoff))
+            bump_version('archive')
+            db.session.commit()
+
+        upto = db.session.query(func.min(Tweet.id)).filter(Tweet.created_at >= cutoff).scalar()
+        if upto is None:
+            upto = (db.session.query(func.max(Tweet.id)).scalar() or 0) + 1
+        if upto > marks['tweet']:
+            query = db.session.query(Tweet.id, Tweet.uid, User.username, Tweet.title, Tweet.content, Tweet.like,
+                                     Tweet.created_at) \
+                .outerjoin(User, User.id == Tweet.uid) \
+                .filter(Tweet.id >= marks['tweet'], Tweet.id < upto) \
+                .order_by(Tweet.id).yield_per(self.segment_size * INSERT_BATCH)
+            segments = (self._tweet_segment(chunk) for chunk in self._chunks(query))
+            self._write(segments, 'tweet', str(upto), report, 'tweets')
+            db.session.rollback()
+            TweetLike.query.filter(TweetLike.tweet_id < upto).delete(synchronize_session=False)
+            TimelineEntry.query.filter(TimelineEntry.tweet_id < upto).delete(synchronize_session=False)
+            Tweet.query.filter(Tweet.id < upto).delete(synchronize_session=False)
+            bump_version('tweet')
+            bump_version('archive')
+            db.session.commit()
+        return report
+
+    def _chunks(self, rows):
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.segment_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _message_segment(self, pair, messages):
+        return {
+            'sender_id': pair[0], 'recipient_id': pair[1],
+            'first_at': messages[0].created_at, 'last_at': messages[-1].created_at,
+            'min_id': min(m.id for m in messages), 'max_id': max(m.id for m in messages), 'count': len(messages),
+            'data': _pack([[m.id, m.sender_id, m.recipient_id, m._from, m._to, m.content, m.created_at.isoformat()]
+                           for m in messages]),
+        }
+
+    def _tweet_segment(self, tweets):
+        return {
+            'min_id': tweets[0].id, 'max_id': tweets[-1].id, 'count': len(tweets),
+            'data': _pack([[t.id, t.uid, t.username, t.title, t.content, t.like, t.created_at.isoformat()]
+                           for t in tweets]),
+        }
+
+    # Insert segments and move the watermark name to value in one transaction.
+    def _write(self, segments, name, value, report, counted):
+        table = message_segment if name == 'message' else tweet_segment
+        with self.engine.begin() as connection:
+            while True:
+                batch = list(itertools.islice(segments, INSERT_BATCH))
+                if not batch:
+                    break
+                connection.execute(table.insert(), batch)
+                report['segments'] += len(batch)
+                report[counted] += sum(segment['count'] for segment in batch)
+            connection.execute(text(
+                'INSERT INTO archive_state (name, value) VALUES (:name, :value) '
+                'ON CONFLICT (name) DO UPDATE SET value = excluded.value'
+            ), {'name': name, 'value': value})
+
+def init_archive(app):
+    if app.config.get('ARCHIVE_DATABASE'):
+        app.extensions['archive'] = Archive(app.config['ARCHIVE_DATABASE'], app.config['ARCHIVE_SEGMENT_SIZE'])
+
+# The messages of a sent or received history, with the archived ones first when
+# there is an archive. hot(since) reads the messages of the hot database from
+# the time since on, or all of them when since is None. column is the
+# history's filter on user_id.
+def with_archived_history(hot, user_id, column):
+    archive = current_app.extensions.get('archive')
+    if archive is None:
+        return hot(None)
+    since = archive.watermarks()['message']
+    if since is None:
+        return hot(None)
+    return itertools.chain(archive.history(user_id, column, since), hot(since))
+
+# flask archive [--days 90] [--vacuum]
+@click.command('archive')
+@with_appcontext
+@click.option('--days', type=float, default=None, help='Archive rows older than this, ARCHIVE_AFTER_DAYS by default.')
+@click.option('--vacuum', is_flag=True, help='Shrink the hot database file afterwards.')
+def archive_command(days, vacuum):
+    """Move old messages and tweets to the archive database."""
+    archive = current_app.extensions.get('archive')
+    if archive is None:
+        raise click.ClickException('Set ARCHIVE_DATABASE to archive.')
+    if days is None:
+        days = current_app.config['ARCHIVE_AFTER_DAYS']
+    report = archive.archive(datetime.utcnow() - timedelta(days=days))
+    if vacuum:
+        with db.engine.connect() as connection:
+            connection.execute(text('VACUUM'))
+    click.echo(json.dumps(report))
@@ -0,0 +1,499 @@
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import parse_qsl, quote
+import aiosqlite
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import dump_cookie, parse_cookie, parse_etags, quote_etag
+from app import create_app
+from db import db, db_integer, PRODUCTION_PRAGMAS
+from accounts import user_by_id, user_by_username, add_user, set_password_hash
+from inbox import record_message
+from likes import change_like, INSERT_LIKE, DELETE_LIKE, TweetNotFound, AlreadyLiked, NotLiked
+from messages import new_message, insert_message, HISTORY, history_params, sent_json, received_json
+from metrics import start_request, finish_request, record_query
+from pagination import parse_limit, decode_cursor
+from passwords import PoolSaturated, hash_task, verify_task, needs_rehash
+from routes import registration_error, message_sent, tweet_sent
+from answers import busy, too_many_requests, user_not_found, liked, unliked, FIELDS_REQUIRED, INVALID_PAGE, \
+    USER_EXISTS, INCORRECT_PASSWORD, MESSAGE_SENT, TWEET_POSTED, TWEET_NOT_FOUND, ALREADY_LIKED, NOT_LIKED
+from streaming import ChunkEncoder, mimetype
+from trending import tweet_liked
+from tweets import insert_tweet, list_tweet, listing_etag, listing_page, newest
+from user_cache import invalidate_user
+from versions import bump, version
+
+# ASGI entry point, for example:
+#
+#   uvicorn asgi:create_asgi_app --factory --workers 4
+#
+# The hot routes (register, login, chat, history, tweet, like and unlike) are
+# served by the async handlers below on aiosqlite connections, so a request
+# waiting on SQLite or on a password hash holds no thread. Every other route,
+# and every request these handlers do not take (multipart forms, buffered
+# likes), goes to the Flask app of create_app, run in threads by asgiref. Both
+# share the app's config, extensions and session cookies, so a client can be
+# served by either and the unit tests keep using create_app.
+#
+# The handlers only do the I/O. What they read and write, the checks and the
+# answers are those of the Flask routes: the same steps (see db.run_steps),
+# run on aiosqlite, the same answers from answers.py, and the same helpers for
+# what follows a commit. They run in an app context, so those helpers find
+# the app's extensions, and are measured by METRICS like the Flask routes.
+#
+# The database must have been set up with `flask init-db` first.
+
+BAD_REQUEST = {'message': 'The browser (or proxy) sent a request that this server could not understand.'}
+FORM = 'application/x-www-form-urlencoded'
+
+# Rows whose columns can be read as attributes, so the serializers of the
+# Flask routes can be used on them.
+class Row(sqlite3.Row):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except IndexError:
+            raise AttributeError(name)
+
+# A writer connection, used by one request at a time since SQLite has one
+# writer anyway, and a pool of reader connections. Connections are opened on
+# first use.
+class AsyncDatabase:
+    def __init__(self, path, pragmas, readers):
+        self.path = path
+        self.pragmas = pragmas
+        self.readers = readers
+        self.idle = None
+        self.writer = None
+        self.write_lock = asyncio.Lock()
+        self.open_lock = asyncio.Lock()
+
+    async def _connect(self, pragmas):
+        connection = await aiosqlite.connect(self.path, isolation_level=None)
+        connection.row_factory = Row
+        for name, value in pragmas.items():
+            await connection.execute('PRAGMA %s = %s' % (name, value))
+        return connection
+
+    async def open(self):
+        async with self.open_lock:
+            if self.writer is not None:
+                return
+            read_pragmas = {name: value for name, value in self.pragmas.items() if name != 'journal_mode'}
+            read_pragmas['query_only'] = 1
+            self.idle = asyncio.Queue()
+            for _ in range(self.readers):
+                self.idle.put_nowait(await self._connect(read_pragmas))
+            self.writer = await self._connect(self.pragmas)
+
+    async def close(self):
+        if self.writer is None:
+            return
+        while not self.idle.empty():
+            await self.idle.get_nowait().close()
+        await self.writer.close()
+        self.writer = None
+
+    @asynccontextmanager
+    async def read(self):
+        await self.open()
+        connection = await self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put_nowait(connection)
+
+    # One write transaction, taken with BEGIN IMMEDIATE so that it never has to
+    # upgrade a read lock, committed when the block ends without an error.
+    @asynccontextmanager
+    async def write(self):
+        await self.open()
+        async with self.write_lock:
+            await self.writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.writer
+            except BaseException:
+                await self.writer.rollback()
+                raise
+            await self.writer.commit()
+
+# Reads and writes Flask's signed session cookie, so that a session started by
+# either app is valid in the other.
+class Sessions:
+    def __init__(self, app):
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.name = app.session_cookie_name
+        self.max_age = int(app.permanent_session_lifetime.total_seconds())
+        self.options = {
+            'path': app.config['SESSION_COOKIE_PATH'] or '/',
+            'domain': app.config['SESSION_COOKIE_DOMAIN'],
+            'secure': app.config['SESSION_COOKIE_SECURE'],
+            'httponly': app.config['SESSION_COOKIE_HTTPONLY'],
+            'samesite': app.config['SESSION_COOKIE_SAMESITE'],
+        }
+
+    def load(self, request):
+        value = parse_cookie(request.headers.get('cookie', '')).get(self.name)
+        if not value:
+            return {}
+        try:
+            return dict(self.serializer.loads(value, max_age=self.max_age))
+        except Exception:
+            return {}
+
+    def cookie(self, session):
+        return dump_cookie(self.name, self.serializer.dumps(session), **self.options)
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope['query_string'].decode('latin-1')
+        self.args = dict(parse_qsl(self.query_string))
+        self.headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        self.remote_addr = scope['client'][0] if scope.get('client') else None
+        self.body = body
+        self._form = None
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._form = dict(parse_qsl(self.body.decode('utf-8'), keep_blank_values=True))
+        return self._form
+
+    def wants_ndjson(self):
+        return self.args.get('format') == 'ndjson' or \
+            self.headers.get('accept', '').split(',')[0].strip() == 'application/x-ndjson'
+
+async def respond(send, status, body=b'', headers=(), content_type='application/json'):
+    if isinstance(body, (dict, list)):
+        body = (json.dumps(body) + '\n').encode()
+    raw = [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+    raw += [(name.lower().encode(), value.encode()) for name, value in headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw})
+    await send({'type': 'http.response.body', 'body': body})
+
+# Send an answer of the Flask routes: (body, status) or (body, status, headers).
+async def reply(send, answer):
+    body, status, headers = answer if len(answer) == 3 else answer + ({},)
+    await respond(send, status, body, list(headers.items()))
+
+async def redirect(send, location, headers=()):
+    await respond(send, 302, b'', [('Location', location)] + list(headers), 'text/html; charset=utf-8')
+
+class AsyncApp:
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.wsgi = WsgiToAsgi(app)
+        self.sessions = Sessions(app)
+        with app.app_context():
+            path = db.engine.url.database
+        pragmas = dict(PRODUCTION_PRAGMAS, **app.config.get('DATABASE_PRAGMAS', {})) \
+            if app.config.get('DATABASE_PROFILE') == 'production' else {'busy_timeout': PRODUCTION_PRAGMAS['busy_timeout']}
+        self.db = AsyncDatabase(path, pragmas, app.config['DATABASE_READ_POOL_SIZE'])
+        self.routes = {
+            ('POST', '/register'): self.register,
+            ('POST', '/login'): self.login,
+            ('POST', '/chat'): self.chat,
+            ('POST', '/tweet'): self.post_tweet,
+        }
+        # Reads that go on into the archive are left to the Flask app.
+        if 'archive' not in app.extensions:
+            self.routes[('GET', '/history/sent')] = self.history_sent
+            self.routes[('GET', '/history/received')] = self.history_received
+            self.routes[('GET', '/tweet')] = self.tweets
+        # Buffered likes live in the Flask app's buffer, so they stay there.
+        if not app.config['LIKE_BUFFER']:
+            self.routes[('POST', '/like')] = self.like
+            self.routes[('POST', '/unlike')] = self.unlike
+        # The Flask endpoint of each route, the name METRICS records it under.
+        urls = app.url_map.bind('localhost')
+        self.endpoints = {(method, path): urls.match(path, method)[0] for method, path in self.routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        key = (scope.get('method'), scope.get('path'))
+        handler = self.routes.get(key) if scope['type'] == 'http' else None
+        if handler is not None and scope['method'] == 'POST':
+            content_type = dict(scope['headers']).get(b'content-type', b'')
+            if content_type.split(b';')[0].strip() != FORM.encode():
+                handler = None
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        request = Request(scope, body)
+        with self.app.app_context():
+            current = start_request(self.app)
+            if current is not None:
+                send = self.measured(send, current, self.endpoints[key], request)
+            try:
+                await handler(request, send)
+            except KeyError:
+                await respond(send, 400, BAD_REQUEST)
+            except Exception:
+                self.app.logger.exception('Exception on %s [%s]', request.path, request.method)
+                await respond(send, 500, {'message': 'Internal Server Error'})
+
+    # Wrap send to record the request in METRICS once its body has been sent.
+    def measured(self, send, current, endpoint, request):
+        response = {'status': 500, 'size': 0}
+        path = request.path + ('?' + request.query_string if request.query_string else '')
+
+        async def measured_send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            else:
+                response['size'] += len(message.get('body', b''))
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                finish_request(self.app, current, endpoint, request.method, path, response['status'], response['size'])
+        return measured_send
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.db.open()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Run steps (see db.run_steps) on an aiosqlite connection, as run_steps
+    # does on a session, and return their result.
+    async def run_steps(self, steps, connection):
+        result = None
+        while True:
+            try:
+                statement, params = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            started = time.perf_counter()
+            async with connection.execute(statement.text, params) as cursor:
+                result = await cursor.fetchall() if cursor.description else cursor.rowcount
+            record_query(time.perf_counter() - started, statement.text)
+
+    async def read(self, steps):
+        async with self.db.read() as connection:
+            return await self.run_steps(steps, connection)
+
+    # The logged in user's id, or None after sending the same redirect to the
+    # login page as login_required.
+    async def user_id(self, request, send):
+        user_id = self.sessions.load(request).get('_user_id')
+        if user_id is None:
+            await self.login_required(request, send)
+            return None
+        return int(user_id)
+
+    async def login_required(self, request, send):
+        await redirect(send, '/login?next=' + quote(request.path, safe=''))
+
+    # The 429 of rate_limit when the client is over the limit name.
+    async def limited(self, send, name, client):
+        limiter = self.app.extensions.get('rate_limiter')
+        wait = limiter.take(name, client) if limiter is not None else 0
+        if wait:
+            await reply(send, too_many_requests(wait))
+        return bool(wait)
+
+    # Run a password hash task (see passwords.py) in the hash pool without
+    # blocking the event loop.
+    async def hash(self, task):
+        pool = self.app.extensions['hash_pool']
+        if pool.workers <= 0:
+            return task[0](*task[1:])
+        return await asyncio.wrap_future(pool.submit(*task))
+
+    async def register(self, request, send):
+        if await self.limited(send, 'register', 'ip:%s' % request.remote_addr):
+            return
+        username = request.form['username']
+        password = request.form['password']
+        password2 = request.form['password2']
+        error = registration_error(username, password, password2)
+        if error is not None:
+            return await reply(send, error)
+        if await self.read(user_by_username(username)) is not None:
+            return await reply(send, USER_EXISTS)
+        try:
+            password_hash = await self.hash(hash_task(password))
+        except PoolSaturated:
+            return await reply(send, busy())
+        async with self.db.write() as connection:
+            await self.run_steps(add_user(username, password_hash), connection)
+        await redirect(send, '/login')
+
+    async def login(self, request, send):
+        if await self.limited(send, 'login', 'ip:%s' % request.remote_addr):
+            return
+        username = request.form['username']
+        password = request.form['password']
+        if not (username and password):
+            return await reply(send, FIELDS_REQUIRED)
+
+        user = await self.read(user_by_username(username))
+        if user is None:
+            return await reply(send, user_not_found(username))
+        try:
+            correct = await self.hash(verify_task(user.password_hash, password))
+        except PoolSaturated:
+            return await reply(send, busy())
+        if not correct:
+            return await reply(send, INCORRECT_PASSWORD)
+
+        if needs_rehash(user.password_hash):
+            try:
+                password_hash = await self.hash(hash_task(password))
+                async with self.db.write() as connection:
+                    await self.run_steps(set_password_hash(user.id, password_hash), connection)
+                invalidate_user(user.id)
+            except PoolSaturated:
+                pass
+
+        session = self.sessions.load(request)
+        session.update({'_user_id': str(user.id), '_fresh': True})
+        await redirect(send, '/', [('Set-Cookie', self.sessions.cookie(session))])
+
+    async def chat(self, request, send):
+        user_id = await self.user_id(request, send)
+        if user_id is None or await self.limited(send, 'chat', 'user:%d' % user_id):
+            return
+        _to = request.form['_to']
+        content = request.form['content']
+        if not (_to and content):
+            return await reply(send, FIELDS_REQUIRED)
+
+        sender = await self.read(user_by_id(user_id))
+        if sender is None:
+            return await self.login_required(request, send)
+        recipient = await self.read(user_by_username(_to))
+        if recipient is None:
+            return await reply(send, user_not_found(_to))
+
+        message = new_message(sender, recipient, content)
+        async with self.db.write() as connection:
+            await self.run_steps(insert_message(message), connection)
+            await self.run_steps(record_message(message), connection)
+        message_sent(message)
+        await reply(send, MESSAGE_SENT)
+
+    # Send the rows of a query as a JSON array, or NDJSON, in chunks while they
+    # are read, with the encoder of stream_json.
+    async def stream(self, request, send, statement, params, serialize):
+        ndjson = request.wants_ndjson()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', mimetype(ndjson).encode())]})
+        encoder = ChunkEncoder(serialize, ndjson)
+        started = time.perf_counter()
+        async with self.db.read() as connection:
+            async with connection.execute(statement.text, params) as cursor:
+                async for row in cursor:
+                    chunk = encoder.add(row)
+                    if chunk is not None:
+                        await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        record_query(time.perf_counter() - started, statement.text)
+        await send({'type': 'http.response.body', 'body': encoder.close().encode()})
+
+    async def history_sent(self, request, send):
+        user_id = await self.user_id(request, send)
+        if user_id is not None:
+            await self.stream(request, send, HISTORY['sender_id'], history_params(user_id), sent_json)
+
+    async def history_received(self, request, send):
+        user_id = await self.user_id(request, send)
+        if user_id is not None:
+            await self.stream(request, send, HISTORY['recipient_id'], history_params(user_id), received_json)
+
+    # The tweet listing of Tweets.get, with the same ETag and page cache.
+    async def tweets(self, request, send):
+        if await self.user_id(request, send) is None:
+            return
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            cursor = decode_cursor(request.args.get('cursor'))
+        except ValueError:
+            return await reply(send, INVALID_PAGE)
+
+        ndjson = request.wants_ndjson()
+        async with self.db.read() as connection:
+            current = await self.run_steps(version('tweet'), connection)
+            etag = listing_etag(current, ndjson)
+            headers = [('ETag', quote_etag(etag)), ('Cache-Control', 'no-cache'), ('Vary', 'Accept')]
+            if parse_etags(request.headers.get('if-none-match')).contains(etag):
+                return await respond(send, 304, b'', headers)
+
+            key = (current, cursor, limit, ndjson)
+            cache = self.app.extensions['tweet_cache']
+            page = cache.get(key)
+            if page is None:
+                tweets = await self.run_steps(newest(limit + 1, cursor[0] if cursor is not None else None), connection)
+                page = listing_page(tweets, limit, ndjson)
+                cache.put(key, page)
+
+        body, next_cursor = page
+        if next_cursor is not None:
+            headers.append(('X-Next-Cursor', next_cursor))
+        await respond(send, 200, body, headers, mimetype(ndjson))
+
+    async def post_tweet(self, request, send):
+        user_id = await self.user_id(request, send)
+        if user_id is None or await self.limited(send, 'tweet', 'user:%d' % user_id):
+            return
+        title = request.form['title']
+        content = request.form['content']
+        like = 0
+        if not (title and content):
+            return await reply(send, FIELDS_REQUIRED)
+
+        author = await self.read(user_by_id(user_id))
+        if author is None:
+            return await self.login_required(request, send)
+        posted = datetime.utcnow()
+        async with self.db.write() as connection:
+            tweet_id = await self.run_steps(insert_tweet(user_id, title, content, like, posted), connection)
+            await self.run_steps(list_tweet(author, tweet_id), connection)
+        tweet_sent(author, tweet_id, title, content, like, posted)
+        await reply(send, TWEET_POSTED)
+
+    # Like and unlike as in likes._apply: the like row, the counter and the
+    # version of the tweet listing change in one write transaction.
+    async def _like(self, request, send, statement, delta, conflict, answer):
+        user_id = await self.user_id(request, send)
+        if user_id is None or await self.limited(send, 'like', 'user:%d' % user_id):
+            return
+        tweet_id = request.form['tweet_id']
+        if not tweet_id:
+            return await reply(send, FIELDS_REQUIRED)
+        try:
+            tweet_id = db_integer(tweet_id)
+            async with self.db.write() as connection:
+                like = await self.run_steps(change_like(statement, user_id, tweet_id, delta, conflict), connection)
+                await self.run_steps(bump('tweet'), connection)
+        except (ValueError, TweetNotFound):
+            return await reply(send, TWEET_NOT_FOUND)
+        except conflict:
+            return await reply(send, ALREADY_LIKED if conflict is AlreadyLiked else NOT_LIKED)
+        tweet_liked(tweet_id, like)
+        await reply(send, answer(like))
+
+    async def like(self, request, send):
+        await self._like(request, send, INSERT_LIKE, 1, AlreadyLiked, liked)
+
+    async def unlike(self, request, send):
+        await self._like(request, send, DELETE_LIKE, -1, NotLiked, unliked)
+
+def create_asgi_app(test=False, config=None):
+    return AsyncApp(create_app(test, config))
@@ -0,0 +1,129 @@
+from flask import current_app
+from models import Tweet, TweetLike
+from likes import INSERT_LIKE, DELETE_LIKE, UPDATE_COUNT, TweetNotFound, AlreadyLiked, NotLiked
+from timeline import remove_tweet
+from trending import tweet_liked, tweet_deleted
+from versions import bump_version
+from db import db, db_integer
+from answers import too_many_requests, liked, unliked, FIELDS_REQUIRED, TWEET_UPDATED, TWEET_DELETED, \
+    TWEET_NOT_FOUND, NOT_YOUR_TWEET, ALREADY_LIKED, NOT_LIKED
+
+# Operations of POST /batch, each with the rate limit it counts against:
+#
+#   {"op": "like", "tweet_id": 1}
+#   {"op": "unlike", "tweet_id": 1}
+#   {"op": "update", "tweet_id": 1, "title": ..., "content": ...}
+#   {"op": "delete", "tweet_id": 1}
+LIMITS = {'like': 'like', 'unlike': 'like', 'update': 'tweet', 'delete': 'tweet'}
+
+UNKNOWN_OPERATION = {'error': 'Unknown operation.'}, 400
+
+# Apply a list of operations as user_id and return a (body, status) result for
+# each, the answer the single endpoint would have given.
+#
+# The authors of all the tweets involved are read with one query, and every
+# operation is applied in one transaction, committed once at the end. An
+# operation that fails leaves no write behind, so it does not stop the others.
+# With LIKE_BUFFER, likes and unlikes go to the buffer after the commit, as
+# the buffer reads outside the batch's transaction.
+def apply_batch(user_id, operations):
+    ids = set()
+    for operation in operations:
+        try:
+            ids.add(db_integer(operation['tweet_id']))
+        except (TypeError, ValueError, KeyError):
+            pass
+    owners = dict(db.session.query(Tweet.id, Tweet.uid).filter(Tweet.id.in_(ids)).all()) if ids else {}
+
+    buffer = current_app.extensions.get('like_buffer')
+    limiter = current_app.extensions.get('rate_limiter')
+    results, buffered = [], []
+    # tweet_id -> like count after the batch, and the deleted tweets.
+    likes, deleted = {}, []
+    for operation in operations:
+        if not isinstance(operation, dict) or operation.get('op') not in LIMITS:
+            results.append(UNKNOWN_OPERATION)
+            continue
+        wait = limiter.check(LIMITS[operation['op']]) if limiter is not None else 0
+        if wait:
+            body, status, _ = too_many_requests(wait)
+            results.append((body, status))
+            continue
+        if buffer is not None and operation['op'] in ('like', 'unlike'):
+            buffered.append((len(results), operation))
+            results.append(None)
+            continue
+        results.append(_apply(user_id, operation, owners, likes, deleted))
+
+    if any(result is not None and result[1] == 200 for result in results):
+        bump_version('tweet')
+    db.session.commit()
+
+    for index, operation in buffered:
+        results[index] = _buffered(buffer, user_id, operation, likes)
+    for tweet_id, like in likes.items():
+        tweet_liked(tweet_id, like)
+    for tweet_id in deleted:
+        tweet_deleted(tweet_id)
+    return results
+
+def _tweet_id(operation):
+    tweet_id = operation.get('tweet_id')
+    if tweet_id is None or tweet_id == '':
+        raise KeyError('tweet_id')
+    try:
+        return db_integer(tweet_id)
+    except (TypeError, ValueError):
+        raise TweetNotFound(tweet_id)
+
+def _apply(user_id, operation, owners, likes, deleted):
+    op = operation['op']
+    try:
+        tweet_id = _tweet_id(operation)
+    except KeyError:
+        return FIELDS_REQUIRED
+    except TweetNotFound:
+        return TWEET_NOT_FOUND
+    if tweet_id not in owners:
+        return TWEET_NOT_FOUND
+
+    if op in ('like', 'unlike'):
+        statement, delta = (INSERT_LIKE, 1) if op == 'like' else (DELETE_LIKE, -1)
+        if db.session.execute(statement, {'user_id': user_id, 'tweet_id': tweet_id}).rowcount == 0:
+            return ALREADY_LIKED if op == 'like' else NOT_LIKED
+        likes[tweet_id] = db.session.execute(UPDATE_COUNT, {'tweet_id': tweet_id, 'delta': delta}).scalar()
+        return liked(likes[tweet_id]) if op == 'like' else unliked(likes[tweet_id])
+
+    if owners[tweet_id] != user_id:
+        return NOT_YOUR_TWEET
+    if op == 'update':
+        title, content = operation.get('title'), operation.get('content')
+        if not (isinstance(title, str) and isinstance(content, str) and title and content):
+            return FIELDS_REQUIRED
+        Tweet.query.filter_by(id=tweet_id).update({'title': title, 'content': content}, synchronize_session=False)
+        return TWEET_UPDATED
+
+    TweetLike.query.filter_by(tweet_id=tweet_id).delete(synchronize_session=False)
+    remove_tweet(tweet_id)
+    Tweet.query.filter_by(id=tweet_id).delete(synchronize_session=False)
+    del owners[tweet_id]
+    likes.pop(tweet_id, None)
+    deleted.append(tweet_id)
+    return TWEET_DELETED
+
+def _buffered(buffer, user_id, operation, likes):
+    try:
+        tweet_id = _tweet_id(operation)
+        if operation['op'] == 'like':
+            likes[tweet_id] = buffer.like(user_id, tweet_id)
+            return liked(likes[tweet_id])
+        likes[tweet_id] = buffer.unlike(user_id, tweet_id)
+        return unliked(likes[tweet_id])
+    except KeyError:
+        return FIELDS_REQUIRED
+    except TweetNotFound:
+        return TWEET_NOT_FOUND
+    except AlreadyLiked:
+        return ALREADY_LIKED
+    except NotLiked:
+        return NOT_LIKED
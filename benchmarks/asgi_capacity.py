@@ -0,0 +1,231 @@
+# Compare the WSGI app (threaded werkzeug server, as app.run) with the ASGI app
+# of asgi.py (uvicorn) at growing numbers of concurrent connections. Each
+# connection logs in once and then sends requests to one route back to back.
+# Reports requests per second, p50/p99 latency and failed requests as JSON.
+#
+#   python benchmarks/asgi_capacity.py --route tweets --connections 16,64,256 --seconds 5
+#
+# Needs uvicorn besides the packages of asgi.py.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+
+from app import create_app
+from endpoints import seed, text, PASSWORD, HASH_METHOD
+
+ROUTES = {
+    'tweets': lambda rng, args: ('GET', '/tweet?limit=20', None),
+    'like': lambda rng, args: ('POST', '/like', {'tweet_id': rng.randint(1, args.tweets)}),
+    'tweet': lambda rng, args: ('POST', '/tweet', {'title': text(rng, 3), 'content': text(rng, 12)}),
+    'chat': lambda rng, args: ('POST', '/chat', {'_to': 'user%d' % rng.randint(1, args.users), 'content': text(rng, 8)}),
+    'history': lambda rng, args: ('GET', '/history/received', None),
+    'login': lambda rng, args: ('POST', '/login', {'username': 'user%d' % rng.randint(1, args.users), 'password': PASSWORD}),
+}
+
+def config(path, hash_method):
+    return {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'DATABASE_PROFILE': 'production',
+        'PASSWORD_HASH_METHOD': hash_method,
+        'RATE_LIMIT': False,
+    }
+
+# Run in a child process: serve the app on port until killed.
+def serve(mode, path, port, hash_method):
+    if mode == 'asgi':
+        import uvicorn
+        from asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(config=config(path, hash_method)), host='127.0.0.1', port=port,
+                    log_level='warning', backlog=4096)
+    else:
+        # Without the access log, like uvicorn above.
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        from werkzeug.serving import run_simple
+        run_simple('127.0.0.1', port, create_app(config=config(path, hash_method)), threaded=True)
+
+# A minimal HTTP/1.1 client on one kept-alive connection.
+class Connection:
+    def __init__(self, port):
+        self.port = port
+        self.reader = self.writer = None
+        self.cookie = None
+
+    async def request(self, method, path, form=None):
+        body = urlencode(form).encode() if form is not None else b''
+        head = '%s %s HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: %d\r\n' % (method, path, len(body))
+        if form is not None:
+            head += 'Content-Type: application/x-www-form-urlencoded\r\n'
+        if self.cookie:
+            head += 'Cookie: %s\r\n' % self.cookie
+        request = (head + '\r\n').encode() + body
+
+        # A kept-alive connection may have been closed by the server since the
+        # last response, then the request is sent again on a new one.
+        reused = self.writer is not None
+        if not reused:
+            self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            self.writer.write(request)
+            await self.writer.drain()
+            line = await self.reader.readline()
+        except ConnectionError:
+            if not reused:
+                raise
+            line = b''
+        if not line and reused:
+            self.close()
+            return await self.request(method, path, form)
+        status = int(line.split()[1])
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.lower()] = value.strip()
+        if 'set-cookie' in headers:
+            self.cookie = headers['set-cookie'].split(';')[0]
+
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def load(port, args, connections, route):
+    latencies = []
+    failures = 0
+    deadline = time.perf_counter() + args.seconds
+
+    async def client(number):
+        nonlocal failures
+        rng = random.Random(number)
+        connection = Connection(port)
+        try:
+            await connection.request('POST', '/login', {'username': 'user%d' % (number % args.users + 1),
+                                                        'password': PASSWORD})
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            failures += 1
+            return
+        while time.perf_counter() < deadline:
+            method, path, form = ROUTES[route](rng, args)
+            started = time.perf_counter()
+            try:
+                status = await connection.request(method, path, form)
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                connection.close()
+                failures += 1
+                continue
+            if status >= 500:
+                failures += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+        connection.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(connections)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    at = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+    return {
+        'connections': connections,
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': at(0.5),
+        'p99_ms': at(0.99),
+        'failures': failures,
+    }
+
+# Each server gets its own copy of the seeded database.
+def copy(source, target):
+    with sqlite3.connect(source) as original, sqlite3.connect(target) as duplicate:
+        original.backup(duplicate)
+
+def wait_for(port, process):
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError('server exited with status %d' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+def main(args):
+    directory = tempfile.mkdtemp()
+    template = os.path.join(directory, 'seed.db')
+    app = create_app(config=config(template, args.hash_method))
+    seed(app, args.users, args.tweets, args.messages, args.follows, args.likes, args.skew, args.seed)
+
+    results = []
+    for number, mode in enumerate(('wsgi', 'asgi')):
+        path = os.path.join(directory, '%s.db' % mode)
+        copy(template, path)
+        port = args.port + number
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, '--db', path,
+                                    '--port', str(port), '--hash-method', args.hash_method],
+                                   start_new_session=True)
+        try:
+            wait_for(port, process)
+            for connections in args.connections:
+                result = asyncio.run(load(port, args, connections, args.route))
+                result['mode'] = mode
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+        finally:
+            # The whole group, with the password hashing workers of the server.
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+    print(json.dumps({'route': args.route, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--route', choices=sorted(ROUTES), default='tweets')
+    parser.add_argument('--connections', type=lambda value: [int(n) for n in value.split(',')], default=[16, 64, 256])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--hash-method', default=HASH_METHOD,
+                        help='Password hash of the seeded users, slow ones make login expensive.')
+    parser.add_argument('--port', type=int, default=8701)
+    parser.add_argument('--serve', choices=('wsgi', 'asgi'), help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.db, args.port, args.hash_method)
+    else:
+        main(args)
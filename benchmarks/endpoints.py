@@ -0,0 +1,334 @@
+# Load test of every route on a seeded synthetic dataset. Reports the p50, p95
+# and p99 latency in milliseconds and the throughput of each route as JSON.
+#
+#   python benchmarks/endpoints.py --users 2000 --tweets 50000 --save baseline.json
+#   python benchmarks/endpoints.py --users 2000 --tweets 50000 --baseline baseline.json
+#
+# Requests go through the WSGI test client, or with --server through a local
+# HTTP server on a random port, from --workers threads. With --baseline the
+# run fails (exit status 1) when a route got slower at p95 or slower in
+# throughput than the baseline by more than --tolerance, or answered with an
+# unexpected status. /stream is left out: its responses never end.
+#
+# The dataset is generated from --seed, so runs with the same arguments see
+# the same data. Follows, tweets and likes go to users and tweets picked with
+# Zipf weights (1 / rank ** --skew), so a few users have most of the followers
+# and a few tweets most of the likes, as on a real network.
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+from app import create_app
+from schema import create_schema
+from db import db
+from models import User, Tweet, Message, TweetLike, Follow
+from pagination import encode_cursor
+from timeline import fan_out_since
+from inbox import summarize_since
+
+PASSWORD = 'password'
+HASH_METHOD = 'pbkdf2:sha256:1'
+WORDS = ('sqlite', 'python', 'flask', 'timeline', 'search', 'index', 'cache', 'stream',
+         'latency', 'tweet', 'follow', 'like', 'message', 'query', 'benchmark', 'profile')
+
+# Cumulative Zipf weights of n ranks, for random.choices.
+def zipf(n, skew):
+    return list(itertools.accumulate(1.0 / rank ** skew for rank in range(1, n + 1)))
+
+def text(rng, words):
+    return ' '.join(rng.choices(WORDS, k=words))
+
+def seed(app, users, tweets, messages, follows, likes, skew, seed):
+    rng = random.Random(seed)
+    ids = list(range(1, users + 1))
+    popular = zipf(users, skew)
+    password_hash = generate_password_hash(PASSWORD, HASH_METHOD)
+    create_schema(app)
+    with app.app_context():
+        connection = db.session.connection()
+        connection.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user%d' % i, 'password_hash': password_hash, 'follower_count': 0} for i in ids
+        ])
+
+        edges = set()
+        for follower in ids:
+            for followee in rng.choices(ids, cum_weights=popular, k=follows):
+                if followee != follower:
+                    edges.add((follower, followee))
+        connection.execute(Follow.__table__.insert(), [{'follower_id': a, 'followee_id': b} for a, b in edges])
+        connection.execute(
+            'UPDATE user SET follower_count = (SELECT count(*) FROM follow WHERE followee_id = user.id)'
+        )
+
+        # Spread over the last two days, oldest first.
+        now = datetime.utcnow()
+        connection.execute(Tweet.__table__.insert(), [
+            {'id': i, 'uid': uid, 'title': text(rng, 3), 'content': text(rng, 12), 'like': 0,
+             'created_at': now - timedelta(seconds=172800 * (tweets - i) / tweets)}
+            for i, uid in enumerate(rng.choices(ids, cum_weights=popular, k=tweets), 1)
+        ])
+        fan_out_since(connection, 0)
+
+        liked = rng.choices(range(1, tweets + 1), cum_weights=zipf(tweets, skew), k=likes)
+        pairs = set(zip(rng.choices(ids, k=likes), liked))
+        connection.execute(TweetLike.__table__.insert(), [{'user_id': u, 'tweet_id': t} for u, t in pairs])
+        connection.execute('UPDATE tweet SET "like" = (SELECT count(*) FROM tweet_like WHERE tweet_id = tweet.id)')
+
+        start = datetime.utcnow() - timedelta(days=30)
+        rows = []
+        for i, recipient in enumerate(rng.choices(ids, cum_weights=popular, k=messages)):
+            sender = rng.choice(ids)
+            rows.append({
+                'sender_id': sender, 'recipient_id': recipient, '_from': 'user%d' % sender,
+                '_to': 'user%d' % recipient, 'content': text(rng, 10),
+                'created_at': start + timedelta(seconds=i),
+            })
+        connection.execute(Message.__table__.insert(), rows)
+        summarize_since(connection, 0)
+        db.session.commit()
+
+# Requests through the WSGI test client.
+class WSGIClient:
+    def __init__(self, app, user_id=None):
+        self.client = app.test_client()
+        if user_id is not None:
+            with self.client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+
+    def request(self, method, path, data=None, body=None, content_type=None):
+        response = self.client.open(path, method=method, data=body if body is not None else data,
+                                    content_type=content_type)
+        response.get_data()
+        return response.status_code
+
+# Requests over HTTP to a running server, on one kept-alive connection.
+class HTTPClient:
+    def __init__(self, port, user_id=None):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.cookie = None
+        if user_id is not None:
+            self.request('POST', '/login', {'username': 'user%d' % user_id, 'password': PASSWORD})
+
+    def request(self, method, path, data=None, body=None, content_type=None):
+        headers = {}
+        if data is not None:
+            body = urlencode(data)
+            content_type = 'application/x-www-form-urlencoded'
+        if content_type:
+            headers['Content-Type'] = content_type
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status
+
+# The routes, each as a function that picks a request at random and returns
+# (method, path, form data, raw body, content type, expected statuses). Routes
+# marked anonymous run on a fresh client without a session, so that logging in
+# and out does not change the session of the worker.
+def routes(args):
+    counter = itertools.count()
+    ids = list(range(1, args.users + 1))
+    popular_users = zipf(args.users, args.skew)
+    tweet_ids = list(range(1, args.tweets + 1))
+    popular_tweets = zipf(args.tweets, args.skew)
+
+    def user(rng):
+        return 'user%d' % rng.choices(ids, cum_weights=popular_users)[0]
+
+    def tweet_id(rng):
+        return str(rng.choices(tweet_ids, cum_weights=popular_tweets)[0])
+
+    # Likes and unlikes of 20 tweets, as a client replaying its offline queue.
+    def batch(rng):
+        return json.dumps([{'op': rng.choice(('like', 'unlike')), 'tweet_id': tweet_id(rng)} for _ in range(20)])
+
+    def bulk(rng):
+        return '\n'.join(json.dumps({'title': text(rng, 3), 'content': text(rng, 12)}) for _ in range(100))
+
+    return [
+        ('index', False, lambda rng: ('GET', '/', None, None, None, (200,))),
+        ('users', False, lambda rng: ('GET', '/users', None, None, None, (200,))),
+        ('register_form', True, lambda rng: ('GET', '/register', None, None, None, (200,))),
+        ('register', True, lambda rng: ('POST', '/register', {
+            'username': 'bench%d_%d' % (os.getpid(), next(counter)), 'password': PASSWORD, 'password2': PASSWORD,
+        }, None, None, (302,))),
+        ('login', True, lambda rng: ('POST', '/login', {'username': user(rng), 'password': PASSWORD}, None, None, (302,))),
+        ('logout', True, lambda rng: ('GET', '/logout', None, None, None, (302,))),
+        ('chat_form', False, lambda rng: ('GET', '/chat', None, None, None, (200,))),
+        ('chat', False, lambda rng: ('POST', '/chat', {'_to': user(rng), 'content': text(rng, 10)}, None, None, (200,))),
+        ('mark_read', False, lambda rng: ('POST', '/inbox/read', {'username': user(rng)}, None, None, (200,))),
+        ('history_sent', False, lambda rng: ('GET', '/history/sent', None, None, None, (200,))),
+        ('history_received', False, lambda rng: ('GET', '/history/received', None, None, None, (200,))),
+        ('inbox', False, lambda rng: ('GET', '/inbox?limit=20', None, None, None, (200,))),
+        ('conversation', False, lambda rng: ('GET', '/conversation/%s?limit=20' % user(rng), None, None, None, (200,))),
+        ('tweets', False, lambda rng: ('GET', '/tweet?limit=20', None, None, None, (200,))),
+        ('tweets_page', False, lambda rng: ('GET', '/tweet?limit=20&cursor=' + encode_cursor(rng.randint(1, args.tweets)),
+                                            None, None, None, (200,))),
+        ('timeline', False, lambda rng: ('GET', '/timeline?limit=20', None, None, None, (200,))),
+        ('trending', False, lambda rng: ('GET', '/trending?limit=100', None, None, None, (200,))),
+        ('search', False, lambda rng: ('GET', '/search?limit=20&q=' + rng.choice(WORDS), None, None, None, (200,))),
+        ('search_messages', False, lambda rng: ('GET', '/search?type=messages&limit=20&q=' + rng.choice(WORDS),
+                                                None, None, None, (200,))),
+        ('metrics', False, lambda rng: ('GET', '/metrics', None, None, None, (200,) if args.metrics else (404,))),
+        ('tweet_post', False, lambda rng: ('POST', '/tweet', {'title': text(rng, 3), 'content': text(rng, 12)},
+                                           None, None, (200,))),
+        # Only the author may change a tweet, so most updates and deletes of
+        # these random tweets answer 403 after looking the tweet up.
+        ('tweet_put', False, lambda rng: ('PUT', '/tweet', {'tweet_id': tweet_id(rng), 'title': text(rng, 3),
+                                          'content': text(rng, 12)}, None, None, (200, 403, 404))),
+        ('like', False, lambda rng: ('POST', '/like', {'tweet_id': tweet_id(rng)}, None, None, (200, 404, 409))),
+        ('unlike', False, lambda rng: ('POST', '/unlike', {'tweet_id': tweet_id(rng)}, None, None, (200, 404, 409))),
+        ('follow', False, lambda rng: ('POST', '/follow', {'username': user(rng)}, None, None, (200, 400, 409))),
+        ('unfollow', False, lambda rng: ('POST', '/unfollow', {'username': user(rng)}, None, None, (200, 409))),
+        ('batch', False, lambda rng: ('POST', '/batch', None, batch(rng), 'application/json', (200,))),
+        ('bulk_tweets', False, lambda rng: ('POST', '/bulk/tweets', None, bulk(rng), 'application/x-ndjson', (200,))),
+        ('tweet_delete', False, lambda rng: ('DELETE', '/tweet', {'tweet_id': tweet_id(rng)}, None, None, (200, 403, 404))),
+    ]
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+# Send requests of one route from workers threads, each logged in as its own
+# user, and summarize their latencies.
+def run_route(connect, route, anonymous, requests, workers, seed, users):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(number):
+        rng = random.Random('%s-%s-%d' % (seed, route.__name__, number))
+        client = None if anonymous else connect(rng.randint(1, users))
+        mine = []
+        unexpected = []
+        for _ in range(requests // workers + (number < requests % workers)):
+            method, path, data, body, content_type, expected = route(rng)
+            started = time.perf_counter()
+            status = (connect(None) if anonymous else client).request(method, path, data, body, content_type)
+            mine.append(time.perf_counter() - started)
+            if status not in expected:
+                unexpected.append('%s %s: %d' % (method, path, status))
+        with lock:
+            latencies.extend(mine)
+            errors.extend(unexpected)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+    }
+
+# The routes that got slower than the baseline by more than tolerance, or
+# answered with unexpected statuses.
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        if result['errors']:
+            found.append('%s: %d unexpected statuses' % (name, result['errors']))
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            found.append('%s: p95 %.3f ms, baseline %.3f ms' % (name, result['p95_ms'], before['p95_ms']))
+        if result['requests_per_sec'] < before['requests_per_sec'] * (1 - tolerance):
+            found.append('%s: %.1f requests/sec, baseline %.1f' % (
+                name, result['requests_per_sec'], before['requests_per_sec']))
+    return found
+
+# The database is made in a temporary directory, removed when the run ends.
+def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        return benchmark(args, os.path.join(directory, 'bench.db'))
+
+def benchmark(args, path):
+    app = create_app(test=True, config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+        'DATABASE_PROFILE': args.profile,
+        'PASSWORD_HASH_METHOD': HASH_METHOD,
+        'PASSWORD_HASH_WORKERS': 0,
+        'METRICS': args.metrics,
+    })
+    seed(app, args.users, args.tweets, args.messages, args.follows, args.likes, args.skew, args.seed)
+
+    server = None
+    if args.server:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        connect = lambda user_id: HTTPClient(server.server_port, user_id)
+    else:
+        connect = lambda user_id: WSGIClient(app, user_id)
+
+    selected = set(args.routes.split(',')) if args.routes else None
+    results = {}
+    for name, anonymous, route in routes(args):
+        if selected is None or name in selected:
+            route.__name__ = name
+            results[name] = run_route(connect, route, anonymous, args.requests, args.workers, args.seed, args.users)
+            print('%-18s %s' % (name, json.dumps(results[name])), file=sys.stderr)
+    if server is not None:
+        server.shutdown()
+
+    report = {
+        'settings': {key: value for key, value in vars(args).items() if key not in ('save', 'baseline')},
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            report['regressions'] = regressions(results, json.load(file)['results'], args.tolerance)
+    print(json.dumps(report, indent=2))
+    return 1 if report.get('regressions') else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=20, help='Follows picked per user.')
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--skew', type=float, default=1.1, help='Exponent of the Zipf weights.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--routes', help='Comma separated route names, all by default.')
+    parser.add_argument('--server', action='store_true', help='Send requests over HTTP to a local server.')
+    parser.add_argument('--profile', choices=('production',), help='DATABASE_PROFILE of the app.')
+    parser.add_argument('--metrics', action='store_true', help='Turn on METRICS while benchmarking.')
+    parser.add_argument('--save', help='Write the report to this file, to be used as a baseline.')
+    parser.add_argument('--baseline', help='Compare with a report saved with --save.')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    sys.exit(main(parser.parse_args()))
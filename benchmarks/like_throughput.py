@@ -0,0 +1,71 @@
+# Measure sustained likes per second on one viral tweet, with likes written
+# straight to the database and with the write-behind like buffer.
+#
+#   python benchmarks/like_throughput.py --workers 16 --seconds 5
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from schema import create_schema
+from db import db
+from models import User, Tweet, TweetLike
+from likes import like_tweet
+
+def run(buffered, workers, seconds, interval_ms):
+    directory = tempfile.mkdtemp()
+    app = create_app(test=True, config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.db'),
+        'LIKE_BUFFER': buffered,
+        'LIKE_FLUSH_INTERVAL_MS': interval_ms,
+    })
+    create_schema(app)
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [{'id': 1, 'username': 'author', 'password_hash': ''}])
+        db.session.execute(Tweet.__table__.insert(), [{'id': 1, 'uid': 1, 'title': 'viral', 'content': 'viral', 'like': 0}])
+        db.session.commit()
+
+    counts = [0] * workers
+    deadline = time.perf_counter() + seconds
+
+    # Every worker likes the tweet as a stream of distinct users.
+    def worker(index):
+        with app.app_context():
+            user_id = index
+            while time.perf_counter() < deadline:
+                like_tweet(user_id, 1)
+                counts[index] += 1
+                user_id += workers
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    buffer = app.extensions.get('like_buffer')
+    if buffer is not None:
+        buffer.close()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        stored = Tweet.query.get(1).like
+        rows = TweetLike.query.count()
+    assert stored == rows == sum(counts), (stored, rows, sum(counts))
+    return {'buffered': buffered, 'likes': sum(counts), 'likes_per_sec': round(sum(counts) / elapsed)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--interval-ms', type=int, default=100)
+    args = parser.parse_args()
+    results = [run(buffered, args.workers, args.seconds, args.interval_ms) for buffered in (False, True)]
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,84 @@
+# Compare concurrent reads and writes of the tweet endpoints with the default
+# database settings and with the production profile of db.py.
+#
+#   python benchmarks/sqlite_profile.py --readers 8 --writers 2 --seconds 5
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from schema import create_schema
+from db import db
+from models import User, Tweet
+
+def run(profile, readers, writers, seconds, tweets):
+    directory = tempfile.mkdtemp()
+    app = create_app(test=True, config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'bench.db'),
+        'DATABASE_PROFILE': profile,
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1',
+        'PASSWORD_HASH_WORKERS': 0,
+    })
+    create_schema(app)
+    with app.app_context():
+        users = [{'id': i, 'username': 'user%d' % i, 'password_hash': ''} for i in range(1, readers + writers + 1)]
+        db.session.execute(User.__table__.insert(), users)
+        db.session.execute(Tweet.__table__.insert(), [
+            {'uid': 1 + i % len(users), 'title': 'title', 'content': 'content %d' % i, 'like': 0}
+            for i in range(tweets)
+        ])
+        db.session.commit()
+
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(user_id, write):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        done = errors = 0
+        while time.perf_counter() < deadline:
+            if write:
+                response = client.post('/tweet', data={'title': 'title', 'content': 'new tweet'})
+            else:
+                response = client.get('/tweet?limit=20')
+            if response.status_code == 200:
+                done += 1
+            else:
+                errors += 1
+        with lock:
+            counts['writes' if write else 'reads'] += done
+            counts['errors'] += errors
+
+    threads = [threading.Thread(target=worker, args=(i + 1, i >= readers)) for i in range(readers + writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'profile': profile or 'default',
+        'reads_per_sec': round(counts['reads'] / elapsed),
+        'writes_per_sec': round(counts['writes'] / elapsed),
+        'errors': counts['errors'],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--tweets', type=int, default=10000)
+    args = parser.parse_args()
+    results = [run(profile, args.readers, args.writers, args.seconds, args.tweets) for profile in (None, 'production')]
+    print(json.dumps(results, indent=2))
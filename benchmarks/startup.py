@@ -0,0 +1,77 @@
+# Measure a cold start of a worker: importing the app, create_app and the
+# first request, each run in a fresh interpreter against a database that
+# `flask init-db` has already set up. The report also lists the modules of
+# LAZY_MODULES that the cold start imported, which should be none. With
+# --check, exit with an error when the median of a step is over its budget.
+#
+#   python benchmarks/startup.py --runs 5 --check
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Seconds, with room for slower machines: about 0.5, 0.03 and 0.01 here.
+BUDGET = {'import_seconds': 1.5, 'create_app_seconds': 0.25, 'first_response_seconds': 0.1}
+
+# Modules a worker only needs later: the password hashing pool, and the ASGI
+# app with its dependencies.
+LAZY_MODULES = ['multiprocessing', 'asgi', 'aiosqlite', 'asgiref']
+
+COLD_START = '''
+import json, sys, time
+lazy = json.loads(sys.argv[2])
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(config={'SQLALCHEMY_DATABASE_URI': sys.argv[1], 'RATE_LIMIT': False})
+created = time.perf_counter()
+response = app.test_client().get('/users')
+answered = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import_seconds': imported - started,
+    'create_app_seconds': created - imported,
+    'first_response_seconds': answered - created,
+    'lazy_modules': [name for name in lazy if name in sys.modules],
+}))
+'''
+
+def cold_start(uri):
+    output = subprocess.run([sys.executable, '-c', COLD_START, uri, json.dumps(LAZY_MODULES)], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output)
+
+def measure(runs):
+    from app import create_app
+    from schema import create_schema
+    with tempfile.TemporaryDirectory() as directory:
+        uri = 'sqlite:///' + os.path.join(directory, 'startup.db')
+        create_schema(create_app(config={'SQLALCHEMY_DATABASE_URI': uri}))
+        samples = [cold_start(uri) for _ in range(runs)]
+    report = {step: round(statistics.median(sample[step] for sample in samples), 4) for step in BUDGET}
+    report['lazy_modules'] = sorted({name for sample in samples for name in sample['lazy_modules']})
+    return report
+
+# The steps of report that are over their budget.
+def over_budget(report):
+    return {step: report[step] for step in BUDGET if report[step] > BUDGET[step]}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--check', action='store_true', help='Fail when a step is over its budget.')
+    args = parser.parse_args()
+    report = measure(args.runs)
+    print(json.dumps(report))
+    if args.check and over_budget(report):
+        sys.exit('over budget: %s' % json.dumps(over_budget(report)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import json
+import time
+from datetime import datetime, timezone
+import click
+from sqlalchemy import func, select
+from flask import current_app
+from flask.cli import with_appcontext
+from models import User, Message, Tweet
+from passwords import hash_password
+from search import drop_sync_triggers, rebuild_index
+from timeline import fan_out_since
+from inbox import summarize_since
+from versions import bump_version
+from db import db
+
+# Bulk loading of NDJSON records, one JSON object per line:
+#
+#   users:    {"username": ..., "password": ...} or {"username": ..., "password_hash": ...}
+#   tweets:   {"author": username, "title": ..., "content": ..., "like": 0, "created_at": ISO 8601}
+#   messages: {"from": username, "to": username, "content": ..., "created_at": ISO 8601}
+#
+# Tweet.like must match the tweet's tweet_like rows, which are not loaded, so a
+# tweet can only be loaded without likes: like is optional and must be 0.
+#
+# Records are validated a batch at a time, with one query to resolve all the
+# usernames of the batch, and the valid rows of a batch are inserted with one
+# executemany in one transaction. Invalid records are skipped and reported.
+
+BATCH_SIZE = 5000
+# Only the first errors are kept, so a bad file cannot fill the memory.
+MAX_ERRORS = 100
+
+class LoadError(ValueError):
+    pass
+
+def read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, None
+            continue
+        yield number, record if isinstance(record, dict) else None
+
+def _text(record, field, maximum):
+    value = record.get(field)
+    if not isinstance(value, str) or not value:
+        raise LoadError('%s is required' % field)
+    if len(value) > maximum:
+        raise LoadError('%s is longer than %d characters' % (field, maximum))
+    return value
+
+def _user_ids(connection, usernames):
+    if not usernames:
+        return {}
+    rows = connection.execute(select(User.id, User.username).where(User.username.in_(usernames)))
+    return {row.username: row.id for row in rows}
+
+def _user_rows(connection, batch, author_id):
+    names = [record.get('username') for number, record in batch]
+    existing = set(_user_ids(connection, [name for name in names if isinstance(name, str)]))
+    rows, errors = [], []
+    for number, record in batch:
+        try:
+            username = _text(record, 'username', 16)
+            if username in existing:
+                raise LoadError('user %s exists' % username)
+            password_hash = record.get('password_hash')
+            if not isinstance(password_hash, str) or not password_hash:
+                password_hash = hash_password(_text(record, 'password', 128))
+            existing.add(username)
+            rows.append({'username': username, 'password_hash': password_hash, 'follower_count': 0})
+        except LoadError as error:
+            errors.append((number, str(error)))
+    return rows, errors
+
+# created_at is optional and defaults to the time of the load. Times with an
+# offset are converted to UTC, which the columns store without a zone.
+def _created_at(record, now):
+    if not record.get('created_at'):
+        return now
+    try:
+        created_at = datetime.fromisoformat(record['created_at'])
+    except (TypeError, ValueError):
+        raise LoadError('created_at must be an ISO 8601 date')
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return created_at
+
+def _tweet_rows(connection, batch, author_id):
+    ids = _user_ids(connection, {record.get('author') for number, record in batch if isinstance(record.get('author'), str)})
+    rows, errors = [], []
+    now = datetime.utcnow()
+    for number, record in batch:
+        try:
+            if author_id is not None:
+                uid = author_id
+            elif record.get('author') in ids:
+                uid = ids[record['author']]
+            else:
+                raise LoadError('cannot find author %s' % record.get('author'))
+            like = record.get('like', 0)
+            if isinstance(like, bool) or not isinstance(like, int) or like != 0:
+                raise LoadError('like must be 0, likes cannot be loaded')
+            rows.append({'uid': uid, 'title': _text(record, 'title', 64), 'content': _text(record, 'content', 128), 'like': 0,
+                         'created_at': _created_at(record, now)})
+        except LoadError as error:
+            errors.append((number, str(error)))
+    return rows, errors
+
+def _message_rows(connection, batch, author_id):
+    names = set()
+    for number, record in batch:
+        names.update(name for name in (record.get('from'), record.get('to')) if isinstance(name, str))
+    ids = _user_ids(connection, names)
+    rows, errors = [], []
+    now = datetime.utcnow()
+    for number, record in batch:
+        try:
+            sender, recipient = record.get('from'), record.get('to')
+            for name in (sender, recipient):
+                if name not in ids:
+                    raise LoadError('cannot find user %s' % name)
+            rows.append({
+                'sender_id': ids[sender], 'recipient_id': ids[recipient], '_from': sender, '_to': recipient,
+                'content': _text(record, 'content', 128), 'created_at': _created_at(record, now),
+            })
+        except LoadError as error:
+            errors.append((number, str(error)))
+    return rows, errors
+
+KINDS = {
+    'users': (User.__table__, _user_rows),
+    'tweets': (Tweet.__table__, _tweet_rows),
+    'messages': (Message.__table__, _message_rows),
+}
+
+# Load NDJSON lines of one kind of record and return a report with the number
+# of rows inserted, the skipped lines and the rows per second.
+#
+# author_id makes every tweet belong to that user, as for the HTTP endpoint.
+# progress is called with the report after every batch.
+#
+# With defer, the secondary indexes and the full-text triggers of the table are
+# dropped first and rebuilt once at the end, tweets are fanned out to the
+# timelines and messages are summarized into the inboxes once at the end. That
+# is much faster for big offline loads, but other writers must be stopped
+# while it runs.
+def load(kind, lines, batch_size=BATCH_SIZE, author_id=None, defer=False, progress=None):
+    table, validate = KINDS[kind]
+    engine = db.get_engine(current_app)
+    report = {'inserted': 0, 'skipped': 0, 'errors': [], 'seconds': 0.0, 'rows_per_sec': 0}
+    started = time.perf_counter()
+
+    with engine.connect() as connection:
+        def last_id():
+            return connection.execute(select(func.coalesce(func.max(table.c.id), 0))).scalar()
+
+        first_id = last_id()
+        if defer:
+            with connection.begin():
+                for index in table.indexes:
+                    index.drop(connection, checkfirst=True)
+                if table.name in ('tweet', 'message'):
+                    drop_sync_triggers(connection, table.name)
+
+        def flush(batch):
+            with connection.begin():
+                rows, errors = validate(connection, [(n, r) for n, r in batch if r is not None], author_id)
+                errors = [(n, 'invalid JSON object') for n, r in batch if r is None] + errors
+                if rows:
+                    before = last_id()
+                    connection.execute(table.insert(), rows)
+                    if kind == 'tweets' and not defer:
+                        fan_out_since(connection, before)
+                        bump_version('tweet', connection)
+                    if kind == 'messages' and not defer:
+                        summarize_since(connection, before)
+            report['inserted'] += len(rows)
+            report['skipped'] += len(errors)
+            report['errors'] += [{'line': n, 'error': e} for n, e in errors][:MAX_ERRORS - len(report['errors'])]
+            _finish(report, started)
+            if progress is not None:
+                progress(report)
+
+        try:
+            batch = []
+            for number, record in read_ndjson(lines):
+                batch.append((number, record))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+        finally:
+            if defer:
+                with connection.begin():
+                    for index in table.indexes:
+                        index.create(connection, checkfirst=True)
+                    if table.name in ('tweet', 'message'):
+                        rebuild_index(connection, table.name)
+                    if kind == 'tweets':
+                        fan_out_since(connection, first_id)
+                        bump_version('tweet', connection)
+                    if kind == 'messages':
+                        summarize_since(connection, first_id)
+
+    return _finish(report, started)
+
+def _finish(report, started):
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    report['rows_per_sec'] = round(report['inserted'] / report['seconds']) if report['seconds'] else 0
+    return report
+
+# flask load tweets tweets.ndjson, once `flask init-db` has created the tables.
+@click.command('load')
+@with_appcontext
+@click.argument('kind', type=click.Choice(sorted(KINDS)))
+@click.argument('path', type=click.File('rb'))
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows per transaction.')
+@click.option('--defer/--no-defer', default=True, show_default=True,
+              help='Rebuild indexes once at the end instead of for every row.')
+def load_command(kind, path, batch_size, defer):
+    """Load users, tweets or messages from an NDJSON file."""
+
+    def progress(report):
+        click.echo('%(inserted)d rows, %(skipped)d skipped, %(rows_per_sec)d rows/sec' % report, err=True)
+
+    report = load(kind, path, batch_size=batch_size, defer=defer, progress=progress)
+    for error in report['errors']:
+        click.echo('line %(line)d: %(error)s' % error, err=True)
+    click.echo(json.dumps({key: report[key] for key in ('inserted', 'skipped', 'seconds', 'rows_per_sec')}))
@@ -1,6 +1,113 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 db = SQLAlchemy()
 
+# Settings applied to every connection of the production profile. WAL lets
+# readers run while a write is in progress, synchronous=NORMAL only syncs at
+# checkpoints (safe with WAL), busy_timeout makes writers wait for the lock
+# instead of failing, and mmap_size and cache_size (in KiB when negative)
+# keep hot pages in memory.
+PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
+}
+
+def _set_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+# Engine options for a pool of pool_size connections shared between threads.
+def _pool_options(pool_size, busy_timeout):
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': pool_size,
+        'connect_args': {'check_same_thread': False, 'timeout': busy_timeout / 1000.0},
+    }
+
+# With DATABASE_PROFILE = 'production', connections come from a pool of
+# DATABASE_POOL_SIZE connections with PRODUCTION_PRAGMAS applied, and GET
+# handlers read through a separate pool of DATABASE_READ_POOL_SIZE read-only
+# connections (see reader). Without a profile the Flask-SQLAlchemy defaults
+# are used and reader is the normal session.
 def initialize_db(app):
+    production = app.config.get('DATABASE_PROFILE') == 'production'
+    if production:
+        pragmas = dict(PRODUCTION_PRAGMAS, **app.config.get('DATABASE_PRAGMAS', {}))
+        options = _pool_options(app.config['DATABASE_POOL_SIZE'], pragmas['busy_timeout'])
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
     db.init_app(app)
+    if not production:
+        return
+
+    with app.app_context():
+        engine = db.get_engine(app)
+    _set_pragmas(engine, pragmas)
+
+    # Read-only connections open the same file in SQLite's read-only mode, so
+    # they never take the write lock and always see the latest commit in WAL.
+    read_pragmas = {name: value for name, value in pragmas.items() if name != 'journal_mode'}
+    read_pragmas['query_only'] = 1
+    read_engine = create_engine(
+        'sqlite:///file:%s?mode=ro&uri=true' % engine.url.database,
+        **_pool_options(app.config['DATABASE_READ_POOL_SIZE'], pragmas['busy_timeout'])
+    )
+    _set_pragmas(read_engine, read_pragmas)
+    app.extensions['read_session'] = scoped_session(
+        sessionmaker(bind=read_engine),
+        scopefunc=db.session.registry.scopefunc,
+    )
+
+    @app.teardown_appcontext
+    def remove_read_session(exception):
+        app.extensions['read_session'].remove()
+
+# The session GET handlers read with: the read-only pool of the production
+# profile, or the normal session without it.
+def reader():
+    return current_app.extensions.get('read_session', db.session)
+
+# Transactions that both the Flask routes and the async handlers of asgi.py run
+# are written once, as steps: generators that yield (statement, params) and are
+# sent back the rows of a statement that returns rows, or else its rowcount.
+# Each app runs them on its own connections, run_steps on a session and
+# AsyncApp.run_steps on aiosqlite, and the generator's return value is the
+# result. Parameters are plain values, with times in the format of the
+# DateTime columns, so that both drivers bind them the same way.
+def run_steps(steps, session=None):
+    session = session if session is not None else db.session
+    result = None
+    while True:
+        try:
+            statement, params = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        rows = session.execute(statement, params)
+        result = rows.fetchall() if rows.returns_rows else rows.rowcount
+
+# Times are stored as text in this format by the DateTime columns.
+def db_time(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+# SQLite integers are signed 64-bit, and binding a larger Python int raises
+# OverflowError, so integers that come from clients are converted with this
+# instead of int(). Anything out of range raises ValueError, like bad input.
+def db_integer(value):
+    value = int(value)
+    if not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError('integer out of range')
+    return value
@@ -0,0 +1,167 @@
+from types import SimpleNamespace
+from flask import current_app
+from sqlalchemy import text, tuple_
+from sqlalchemy.orm import aliased
+from models import User, Message, ConversationSummary, UnreadCounter
+from messages import message_key, message_json, key_time
+from timeline import UserNotFound
+from db import db, reader, db_time
+
+# Inboxes are kept in conversation_summary (one row per user and peer) and
+# unread_counter (the totals per user). Sending a message moves the
+# conversation to the top of both inboxes and adds one unread message for the
+# recipient; marking a conversation read moves the read receipt and recounts
+# the messages after it. Both change the summary and the counters in the same
+# transaction as the message or the receipt.
+
+SENT_SUMMARY = text(
+    'INSERT INTO conversation_summary (user_id, peer_id, last_message_id, last_read_id, unread, updated_at) '
+    'VALUES (:sender_id, :recipient_id, :message_id, 0, 0, :created_at) '
+    'ON CONFLICT (user_id, peer_id) DO UPDATE SET '
+    'last_message_id = excluded.last_message_id, updated_at = excluded.updated_at'
+)
+RECEIVED_SUMMARY = text(
+    'INSERT INTO conversation_summary (user_id, peer_id, last_message_id, last_read_id, unread, updated_at) '
+    'VALUES (:recipient_id, :sender_id, :message_id, 0, 1, :created_at) '
+    'ON CONFLICT (user_id, peer_id) DO UPDATE SET '
+    'last_message_id = excluded.last_message_id, updated_at = excluded.updated_at, unread = unread + 1 '
+    'RETURNING unread'
+)
+ADD_UNREAD = text(
+    'INSERT INTO unread_counter (user_id, messages, conversations) VALUES (:user_id, :messages, :conversations) '
+    'ON CONFLICT (user_id) DO UPDATE SET '
+    'messages = messages + excluded.messages, conversations = conversations + excluded.conversations'
+)
+
+# The receipt only moves forward and never past the latest message. Being an
+# UPDATE, it also takes the write lock before the unread messages are counted.
+MARK_READ = text(
+    'UPDATE conversation_summary SET last_read_id = max(last_read_id, min(coalesce(:message_id, last_message_id), last_message_id)) '
+    'WHERE user_id = :user_id AND peer_id = :peer_id '
+    'RETURNING unread, last_read_id, last_message_id'
+)
+# Served by the (sender_id, recipient_id, created_at) index of message.
+COUNT_UNREAD = text(
+    'SELECT count(*) FROM message WHERE sender_id = :peer_id AND recipient_id = :user_id AND id > :last_read_id'
+)
+SET_UNREAD = text('UPDATE conversation_summary SET unread = :unread WHERE user_id = :user_id AND peer_id = :peer_id')
+
+# The parameters of SENT_SUMMARY and RECEIVED_SUMMARY for a new message.
+def summary_params(message):
+    return {
+        'sender_id': message.sender_id,
+        'recipient_id': message.recipient_id,
+        'message_id': message.id,
+        'created_at': db_time(message.created_at),
+    }
+
+# Steps (see db.run_steps) that add a new message to the inboxes of its sender
+# and recipient, run in the transaction that sends it.
+# The message needs its id, so insert it first.
+def record_message(message):
+    params = summary_params(message)
+    yield SENT_SUMMARY, params
+    rows = yield RECEIVED_SUMMARY, params
+    yield ADD_UNREAD, {'user_id': message.recipient_id, 'messages': 1, 'conversations': int(rows[0].unread == 1)}
+
+# Mark the messages of the conversation with username as read by user_id, up
+# to message_id or all of them, and return how many are still unread.
+def mark_read(user_id, username, message_id=None):
+    peer = User.query.filter_by(username=username).first()
+    if peer is None:
+        raise UserNotFound(username)
+    params = {'user_id': user_id, 'peer_id': peer.id, 'message_id': message_id}
+    row = db.session.execute(MARK_READ, params).first()
+    if row is None:
+        # Nothing was ever sent between the two.
+        db.session.rollback()
+        return 0
+
+    unread = 0
+    if row.last_read_id < row.last_message_id:
+        unread = db.session.execute(COUNT_UNREAD, dict(params, last_read_id=row.last_read_id)).scalar()
+    if unread != row.unread:
+        db.session.execute(SET_UNREAD, dict(params, unread=unread))
+        db.session.execute(ADD_UNREAD, {
+            'user_id': user_id,
+            'messages': unread - row.unread,
+            'conversations': int(unread > 0) - int(row.unread > 0),
+        })
+    db.session.commit()
+    return unread
+
+def unread_counts(user_id):
+    counter = reader().query(UnreadCounter.messages, UnreadCounter.conversations).filter_by(user_id=user_id).first()
+    return (counter.messages, counter.conversations) if counter is not None else (0, 0)
+
+# One page of the conversations of user_id, most recent first, starting below
+# the before key. Each row comes with the peer's username, the latest message
+# and the peer's read receipt, all joined on primary keys.
+def conversations(user_id, limit, before=None):
+    peer_summary = aliased(ConversationSummary)
+    query = reader().query(ConversationSummary, User.username, Message, peer_summary.last_read_id.label('peer_last_read_id')) \
+        .join(User, User.id == ConversationSummary.peer_id) \
+        .outerjoin(Message, Message.id == ConversationSummary.last_message_id) \
+        .outerjoin(peer_summary, (peer_summary.user_id == ConversationSummary.peer_id) &
+                   (peer_summary.peer_id == ConversationSummary.user_id)) \
+        .filter(ConversationSummary.user_id == user_id)
+    if before is not None:
+        query = query.filter(tuple_(ConversationSummary.updated_at, ConversationSummary.peer_id) <
+                             tuple_(key_time(before[0]), before[1]))
+    order = (ConversationSummary.updated_at.desc(), ConversationSummary.peer_id.desc())
+    rows = query.order_by(*order).limit(limit).all()
+
+    # The latest message of a quiet conversation may have been archived.
+    archive = current_app.extensions.get('archive')
+    if archive is not None and any(row.Message is None for row in rows):
+        rows = [row if row.Message is not None else SimpleNamespace(**dict(row._asdict(), Message=archive.message(
+            user_id, row.ConversationSummary.peer_id, row.ConversationSummary.last_message_id))) for row in rows]
+    return [row for row in rows if row.Message is not None]
+
+# Cursors of the inbox are (updated_at in microseconds, peer id).
+def conversation_key(row):
+    return (message_key(row.Message)[0], row.ConversationSummary.peer_id)
+
+def conversation_json(row):
+    return {
+        'username': row.username,
+        'unread': row.ConversationSummary.unread,
+        'last_read_id': row.ConversationSummary.last_read_id,
+        'read_by_peer': row.peer_last_read_id or 0,
+        'last_message': message_json(row.Message),
+    }
+
+# Summarize the messages with an id above after, for messages inserted in
+# bulk: every conversation they belong to gets its latest message and unread
+# count from the message table, keeping its read receipt, and the counters of
+# their users are summed again.
+TOUCHED = (
+    'SELECT sender_id AS user_id, recipient_id AS peer_id FROM message WHERE id > :after '
+    'UNION SELECT recipient_id, sender_id FROM message WHERE id > :after'
+)
+SUMMARIZE = [
+    text(
+        'INSERT INTO conversation_summary (user_id, peer_id, last_message_id, last_read_id, unread, updated_at) '
+        'SELECT user_id, peer_id, ('
+        '  SELECT id FROM message WHERE (sender_id = user_id AND recipient_id = peer_id) '
+        '  OR (sender_id = peer_id AND recipient_id = user_id) ORDER BY created_at DESC, id DESC LIMIT 1'
+        '), 0, 0, \'\' FROM (' + TOUCHED + ') WHERE true '
+        'ON CONFLICT (user_id, peer_id) DO UPDATE SET last_message_id = excluded.last_message_id'
+    ),
+    text(
+        'UPDATE conversation_summary SET '
+        'updated_at = (SELECT created_at FROM message WHERE id = last_message_id), '
+        'unread = (SELECT count(*) FROM message WHERE sender_id = peer_id AND recipient_id = user_id AND id > last_read_id) '
+        'WHERE (user_id, peer_id) IN (' + TOUCHED + ')'
+    ),
+    text(
+        'INSERT INTO unread_counter (user_id, messages, conversations) '
+        'SELECT user_id, sum(unread), sum(unread > 0) FROM conversation_summary '
+        'WHERE user_id IN (SELECT recipient_id FROM message WHERE id > :after) GROUP BY user_id '
+        'ON CONFLICT (user_id) DO UPDATE SET messages = excluded.messages, conversations = excluded.conversations'
+    ),
+]
+
+def summarize_since(connection, after):
+    for statement in SUMMARIZE:
+        connection.execute(statement, {'after': after})
@@ -0,0 +1,161 @@
+import atexit
+import threading
+from collections import defaultdict
+from sqlalchemy import text
+from likes import TweetNotFound, AlreadyLiked, NotLiked, INSERT_LIKE, DELETE_LIKE
+from versions import bump_version
+from db import db
+
+# Read the stored count of a tweet and whether the user already likes it.
+READ_STATE = text(
+    'SELECT "like", EXISTS (SELECT 1 FROM tweet_like WHERE user_id = :user_id AND tweet_id = tweet.id) '
+    'FROM tweet WHERE id = :tweet_id'
+)
+ADD_COUNT = text('UPDATE tweet SET "like" = "like" + :delta WHERE id = :tweet_id')
+
+# Write-behind buffer for likes. Instead of one write transaction per like,
+# like and unlike only record the wanted state of (user, tweet) in memory, and
+# a background thread writes all of them in one transaction every
+# flush_interval_ms, or earlier once max_events changes are waiting.
+#
+# The buffer keeps the state a user wants, not the number of clicks, so a like
+# followed by an unlike before a flush writes nothing. When flushing, the like
+# rows are written first and the counters are moved by the number of rows that
+# actually changed, so the count always matches tweet_like even when another
+# process wrote the same rows in the meantime.
+#
+# A longer interval means fewer, bigger transactions but like counts read from
+# the database lag behind by up to one interval.
+class LikeBuffer:
+    def __init__(self, app, flush_interval_ms=100, max_events=1000):
+        self.app = app
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        # Serializes flushes so that only one batch is written at a time.
+        self.flush_lock = threading.Lock()
+        # (user_id, tweet_id) -> [state in the database, wanted state].
+        self.state = {}
+        # tweet_id -> change of the count once the buffer is flushed.
+        self.deltas = defaultdict(int)
+        # Changes recorded since the last flush.
+        self.events = 0
+        # Bumped whenever a flush commits, so readers know their database read is stale.
+        self.generation = 0
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='like-buffer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def like(self, user_id, tweet_id):
+        return self._record(user_id, tweet_id, True)
+
+    def unlike(self, user_id, tweet_id):
+        return self._record(user_id, tweet_id, False)
+
+    # Record the wanted state and return the like count as it will be once the
+    # buffer has been flushed. The state is read on a connection of its own,
+    # which sees the latest flush and leaves the caller's session alone.
+    def _record(self, user_id, tweet_id, liked):
+        key = (user_id, tweet_id)
+        while True:
+            generation = self.generation
+            with db.get_engine(self.app).connect() as connection:
+                row = connection.execute(READ_STATE, {'user_id': user_id, 'tweet_id': tweet_id}).first()
+            if row is None:
+                raise TweetNotFound(tweet_id)
+            with self.lock:
+                # A flush committed between the read and now, read again.
+                if generation != self.generation:
+                    continue
+                entry = self.state.setdefault(key, [bool(row[1]), bool(row[1])])
+                if entry[1] == liked:
+                    raise AlreadyLiked(tweet_id) if liked else NotLiked(tweet_id)
+                entry[1] = liked
+                self.deltas[tweet_id] += 1 if liked else -1
+                count = row[0] + self.deltas[tweet_id]
+                self.events += 1
+                full = self.events >= self.max_events
+            if full:
+                self.wakeup.set()
+            return count
+
+    # Write everything recorded so far in one transaction and return the number
+    # of (user, tweet) pairs written.
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                # Pairs whose wanted state is already stored need no write.
+                for key in [key for key, entry in self.state.items() if entry[0] == entry[1]]:
+                    del self.state[key]
+                batch = {key: entry[1] for key, entry in self.state.items()}
+                self.events = 0
+            if not batch:
+                return 0
+
+            likes = defaultdict(list)
+            unlikes = defaultdict(list)
+            for (user_id, tweet_id), liked in batch.items():
+                rows = likes if liked else unlikes
+                rows[tweet_id].append({'user_id': user_id, 'tweet_id': tweet_id})
+
+            connection = db.get_engine(self.app).connect()
+            try:
+                transaction = connection.begin()
+                # executemany per tweet, so that the row count tells exactly how
+                # much the counter of that tweet has to move.
+                changes = defaultdict(int)
+                for tweet_id, rows in likes.items():
+                    changes[tweet_id] += connection.execute(INSERT_LIKE, rows).rowcount
+                for tweet_id, rows in unlikes.items():
+                    changes[tweet_id] -= connection.execute(DELETE_LIKE, rows).rowcount
+                updates = [{'tweet_id': tweet_id, 'delta': delta} for tweet_id, delta in changes.items() if delta]
+                if updates:
+                    connection.execute(ADD_COUNT, updates)
+                    bump_version('tweet', connection)
+
+                # Commit and forget the written changes under the lock, so that
+                # a reader never counts a like both in the database and here.
+                with self.lock:
+                    transaction.commit()
+                    for key, liked in batch.items():
+                        entry = self.state[key]
+                        self.deltas[key[1]] -= int(liked) - int(entry[0])
+                        if not self.deltas[key[1]]:
+                            del self.deltas[key[1]]
+                        entry[0] = liked
+                        if entry[1] == liked:
+                            del self.state[key]
+                    self.generation += 1
+            finally:
+                connection.close()
+            return len(batch)
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # The recorded state is kept, so the batch is retried next time.
+                self.app.logger.exception('Failed to flush likes')
+
+    # Stop the flush thread and write whatever is left. Registered with atexit
+    # so a normal shutdown does not lose likes.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+def init_like_buffer(app):
+    if app.config.get('LIKE_BUFFER'):
+        app.extensions['like_buffer'] = LikeBuffer(
+            app,
+            flush_interval_ms=app.config.get('LIKE_FLUSH_INTERVAL_MS', 100),
+            max_events=app.config.get('LIKE_FLUSH_MAX_EVENTS', 1000),
+        )
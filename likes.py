@@ -0,0 +1,83 @@
+from flask import current_app
+from sqlalchemy import text
+from versions import bump_version
+from trending import tweet_liked
+from db import db, run_steps, db_integer
+
+class TweetNotFound(Exception):
+    pass
+
+class AlreadyLiked(Exception):
+    pass
+
+class NotLiked(Exception):
+    pass
+
+# The like row is inserted only if the tweet exists, and a duplicate is ignored
+# by the primary key of tweet_like instead of being checked in Python first.
+INSERT_LIKE = text(
+    'INSERT OR IGNORE INTO tweet_like (user_id, tweet_id) '
+    'SELECT :user_id, id FROM tweet WHERE id = :tweet_id'
+)
+DELETE_LIKE = text('DELETE FROM tweet_like WHERE user_id = :user_id AND tweet_id = :tweet_id')
+
+# The counter is changed inside the database, so concurrent likes can never
+# overwrite each other, and the new value is returned by the same statement.
+UPDATE_COUNT = text('UPDATE tweet SET "like" = "like" + :delta WHERE id = :tweet_id RETURNING "like"')
+
+# Ids that are not integers, or too large for SQLite, match no tweet.
+def _tweet_id(tweet_id):
+    try:
+        return db_integer(tweet_id)
+    except (TypeError, ValueError):
+        raise TweetNotFound(tweet_id)
+
+TWEET_EXISTS = text('SELECT 1 FROM tweet WHERE id = :tweet_id')
+
+# Steps (see db.run_steps) that apply a change to the like set and the counter
+# and return the new count. They run without loading the Tweet, so the hot path
+# is one short write transaction per like. Only when the write changed nothing
+# is the tweet looked up, to tell a missing tweet apart from a duplicate like
+# or unlike.
+def change_like(statement, user_id, tweet_id, delta, conflict):
+    params = {'user_id': user_id, 'tweet_id': tweet_id}
+    if (yield statement, params) == 0:
+        if not (yield TWEET_EXISTS, params):
+            raise TweetNotFound(tweet_id)
+        raise conflict(tweet_id)
+    rows = yield UPDATE_COUNT, {'tweet_id': tweet_id, 'delta': delta}
+    return rows[0].like
+
+# Apply a change to the like set and the counter in one transaction, with the
+# version of the tweet listing.
+def _apply(statement, user_id, tweet_id, delta, conflict):
+    tweet_id = _tweet_id(tweet_id)
+    try:
+        like = run_steps(change_like(statement, user_id, tweet_id, delta, conflict))
+    except (TweetNotFound, conflict):
+        db.session.rollback()
+        raise
+    bump_version('tweet')
+    db.session.commit()
+    return like
+
+# Like a tweet as user_id and return its new like count. When the app runs
+# with LIKE_BUFFER, the like is recorded in the write-behind buffer instead.
+def like_tweet(user_id, tweet_id):
+    buffer = current_app.extensions.get('like_buffer')
+    if buffer is not None:
+        like = buffer.like(user_id, _tweet_id(tweet_id))
+    else:
+        like = _apply(INSERT_LIKE, user_id, tweet_id, 1, AlreadyLiked)
+    tweet_liked(_tweet_id(tweet_id), like)
+    return like
+
+# Remove user_id's like from a tweet and return its new like count.
+def unlike_tweet(user_id, tweet_id):
+    buffer = current_app.extensions.get('like_buffer')
+    if buffer is not None:
+        like = buffer.unlike(user_id, _tweet_id(tweet_id))
+    else:
+        like = _apply(DELETE_LIKE, user_id, tweet_id, -1, NotLiked)
+    tweet_liked(_tweet_id(tweet_id), like)
+    return like
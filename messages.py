@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy import text, tuple_
+from models import Message
+from db import reader, run_steps, db_time
+
+# Message cursors are (created_at in microseconds since the epoch, id), so that
+# messages sent in the same microsecond are still paged exactly once.
+def message_key(message):
+    created_at = message.created_at.replace(tzinfo=timezone.utc)
+    return (int(created_at.timestamp() * 1000000), message.id)
+
+def key_time(micros):
+    return datetime.fromtimestamp(micros / 1000000, timezone.utc).replace(tzinfo=None)
+
+INSERT_MESSAGE = text(
+    'INSERT INTO message (sender_id, recipient_id, _from, _to, content, created_at) '
+    'VALUES (:sender_id, :recipient_id, :_from, :_to, :content, :created_at) RETURNING id'
+)
+
+# A new message, sent now, that is not stored yet.
+def new_message(sender, recipient, content):
+    message = Message(sender, recipient, content)
+    message.created_at = datetime.utcnow()
+    return message
+
+def message_params(message):
+    return {
+        'sender_id': message.sender_id, 'recipient_id': message.recipient_id, '_from': message._from,
+        '_to': message._to, 'content': message.content, 'created_at': db_time(message.created_at),
+    }
+
+# Insert a new message and set its id.
+def insert_message(message):
+    rows = yield INSERT_MESSAGE, message_params(message)
+    message.id = rows[0].id
+
+# Add a new message and return it. It is inserted in db.session's transaction,
+# for the caller to commit with the rest of it, and the Message returned is not
+# attached to any session.
+def add_message(sender, recipient, content):
+    message = new_message(sender, recipient, content)
+    run_steps(insert_message(message))
+    return message
+
+# The messages sent by sender_id to recipient_id, newest first, starting below
+# the before key and not older than since. Served by the (sender_id,
+# recipient_id, created_at) index.
+def _direction(sender_id, recipient_id, limit, before, since):
+    query = reader().query(Message).filter(Message.sender_id == sender_id, Message.recipient_id == recipient_id)
+    if before is not None:
+        query = query.filter(tuple_(Message.created_at, Message.id) < tuple_(key_time(before[0]), before[1]))
+    if since is not None:
+        query = query.filter(Message.created_at >= since)
+    return query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).all()
+
+# One page of the conversation between two users, newest first. Each direction
+# is read with its own index range scan of at most limit rows and the two are
+# merged here, so the cost depends on the page size, not on the table size.
+# With an archive, a page that runs past the hot messages goes on with the
+# archived ones, which are all older.
+def conversation(user_id, peer_id, limit, before=None):
+    archive = current_app.extensions.get('archive')
+    since = archive.watermarks()['message'] if archive is not None else None
+    messages = _direction(user_id, peer_id, limit, before, since)
+    if peer_id != user_id:
+        messages += _direction(peer_id, user_id, limit, before, since)
+    messages.sort(key=message_key, reverse=True)
+    messages = messages[:limit]
+    if since is not None and len(messages) < limit:
+        messages += archive.conversation(user_id, peer_id, limit - len(messages), before)
+    return messages
+
+# The messages a user sent or received, oldest first, from since on (a time in
+# the format of the DateTime columns, '' for all of them). Served by the
+# (sender_id, created_at) and (recipient_id, created_at) indexes.
+HISTORY = {
+    'sender_id': text(
+        'SELECT _to, content, created_at, id FROM message '
+        'WHERE sender_id = :user_id AND created_at >= :since ORDER BY created_at, id'
+    ),
+    'recipient_id': text(
+        'SELECT _from, content, created_at, id FROM message '
+        'WHERE recipient_id = :user_id AND created_at >= :since ORDER BY created_at, id'
+    ),
+}
+
+def history_params(user_id, since=None):
+    return {'user_id': user_id, 'since': db_time(since) if since is not None else ''}
+
+def sent_json(message):
+    return {'_to': message._to, 'message': message.content}
+
+def received_json(message):
+    return {'_from': message._from, 'message': message.content}
+
+def message_json(message):
+    return {
+        'message_id': message.id,
+        '_from': message._from,
+        '_to': message._to,
+        'message': message.content,
+        'created_at': message.created_at.isoformat(),
+    }
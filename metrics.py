@@ -0,0 +1,192 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the latency buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Statements kept per request for the slow request log.
+MAX_LOGGED_QUERIES = 50
+
+# Per-endpoint request metrics: a latency histogram, request counts by status,
+# the number and total time of SQL queries and the bytes sent. Everything is
+# kept in plain dicts behind one lock, so recording a request costs a few
+# dict updates, and rendered in the Prometheus text format at /metrics.
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # (endpoint, method) -> [count in each bucket, the last one for +Inf]
+        self.latency = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.latency_sum = defaultdict(float)
+        # (endpoint, method, status) -> requests
+        self.requests = defaultdict(int)
+        # (endpoint, method) -> queries, seconds spent in them, bytes sent
+        self.queries = defaultdict(int)
+        self.query_seconds = defaultdict(float)
+        self.response_bytes = defaultdict(int)
+
+    def record(self, endpoint, method, status, seconds, queries, query_seconds, size):
+        key = (endpoint, method)
+        with self.lock:
+            self.latency[key][bisect_left(self.buckets, seconds)] += 1
+            self.latency_sum[key] += seconds
+            self.requests[(endpoint, method, status)] += 1
+            self.queries[key] += queries
+            self.query_seconds[key] += query_seconds
+            self.response_bytes[key] += size
+
+    def render(self, extra=()):
+        with self.lock:
+            latency = {key: list(counts) for key, counts in self.latency.items()}
+            latency_sum = dict(self.latency_sum)
+            requests = dict(self.requests)
+            queries = dict(self.queries)
+            query_seconds = dict(self.query_seconds)
+            response_bytes = dict(self.response_bytes)
+
+        lines = [
+            '# HELP http_request_duration_seconds Time spent handling requests.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for (endpoint, method), counts in sorted(latency.items()):
+            labels = 'endpoint="%s",method="%s"' % (endpoint, method)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append('http_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, total))
+            lines.append('http_request_duration_seconds_sum{%s} %f' % (labels, latency_sum[endpoint, method]))
+            lines.append('http_request_duration_seconds_count{%s} %d' % (labels, total))
+
+        lines += ['# HELP http_requests_total Requests by status code.', '# TYPE http_requests_total counter']
+        for (endpoint, method, status), count in sorted(requests.items()):
+            lines.append('http_requests_total{endpoint="%s",method="%s",status="%d"} %d' % (endpoint, method, status, count))
+
+        counters = (
+            ('db_queries_total', 'SQL statements executed while handling requests.', queries, '%d'),
+            ('db_query_duration_seconds_total', 'Time spent in SQL statements while handling requests.', query_seconds, '%f'),
+            ('http_response_size_bytes_total', 'Bytes sent in response bodies.', response_bytes, '%d'),
+        )
+        for name, help, values, number in counters:
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name]
+            for (endpoint, method), value in sorted(values.items()):
+                lines.append(('%s{endpoint="%s",method="%s"} ' + number) % (name, endpoint, method, value))
+
+        for name, kind, help, value in extra:
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind), '%s %s' % (name, value)]
+        return '\n'.join(lines) + '\n'
+
+# Cache statistics appended to the request metrics.
+def app_metrics(app):
+    extra = []
+    user_cache = app.extensions.get('user_cache')
+    if user_cache is not None:
+        stats = user_cache.stats()
+        extra += [
+            ('user_cache_hits_total', 'counter', 'Users loaded from the cache.', stats['hits']),
+            ('user_cache_misses_total', 'counter', 'Users loaded from the database.', stats['misses']),
+            ('user_cache_size', 'gauge', 'Users in the cache.', stats['size']),
+        ]
+    tweet_cache = app.extensions.get('tweet_cache')
+    if tweet_cache is not None:
+        extra.append(('tweet_cache_size', 'gauge', 'Encoded tweet pages in the cache.', len(tweet_cache.entries)))
+    return extra
+
+# Count the bytes of a streamed body as it is sent, closing it like the server
+# would have.
+def _counted(body, record):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+        record(size)
+
+# The measurements of the request running in this context: start, queries,
+# seconds in queries and the statements for the slow log (None without it).
+_current = ContextVar('metrics', default=None)
+
+def record_query(elapsed, statement):
+    current = _current.get()
+    if current is None:
+        return
+    current[1] += 1
+    current[2] += elapsed
+    if current[3] is not None and len(current[3]) < MAX_LOGGED_QUERIES:
+        current[3].append((elapsed, statement))
+
+# Queries are timed by listeners on every engine, which only do work while a
+# request with metrics is running in their context.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        context._metrics_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is not None:
+        record_query(time.perf_counter() - start, statement)
+
+# Start measuring a request in this context, when the app has METRICS.
+# Requests the Flask app does not serve, those of asgi.py's async handlers,
+# are measured with this and finish_request too, and record_query their
+# queries.
+def start_request(app):
+    if 'metrics' not in app.extensions:
+        return None
+    current = [time.perf_counter(), 0, 0.0, [] if app.config['METRICS_SLOW_REQUEST_MS'] > 0 else None]
+    _current.set(current)
+    return current
+
+def finish_request(app, current, endpoint, method, path, status, size):
+    _current.set(None)
+    seconds = time.perf_counter() - current[0]
+    app.extensions['metrics'].record(endpoint, method, status, seconds, current[1], current[2], size)
+    slow = app.config['METRICS_SLOW_REQUEST_MS'] / 1000.0
+    if 0 < slow <= seconds:
+        app.logger.warning(
+            'Slow request %s %s: %.1f ms, %d queries in %.1f ms\n%s',
+            method, path, seconds * 1000, current[1], current[2] * 1000,
+            '\n'.join('  %.1f ms  %s' % (elapsed * 1000, statement) for elapsed, statement in current[3]),
+        )
+
+_listening = False
+
+# With METRICS set, every request is measured and the results are served at
+# /metrics. Requests slower than METRICS_SLOW_REQUEST_MS are logged with their
+# SQL statements. Without it nothing is installed and /metrics is a 404.
+def init_metrics(app):
+    global _listening
+    if not app.config['METRICS']:
+        return
+    app.extensions['metrics'] = Metrics(app.config['METRICS_BUCKETS'])
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+    @app.before_request
+    def start():
+        start_request(app)
+
+    # A streamed body runs its queries while it is sent, so it is recorded once
+    # it has been sent.
+    @app.after_request
+    def record_request(response):
+        current = _current.get()
+        if current is None:
+            return response
+        args = (app, current, request.endpoint or 'unmatched', request.method, request.full_path.rstrip('?'),
+                response.status_code)
+        if response.is_streamed:
+            response.response = _counted(response.response, lambda size: finish_request(*args, size))
+        else:
+            finish_request(*args, response.calculate_content_length() or 0)
+        return response
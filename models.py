@@ -1,3 +1,4 @@
+from datetime import datetime
 from flask import jsonify
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -9,10 +10,15 @@ class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(16), unique=True)
     password_hash = db.Column(db.String(128))
+    # Kept up to date by follow and unfollow, so that posting a tweet can decide
+    # between fan-out-on-write and fan-out-on-read without counting followers.
+    follower_count = db.Column(db.Integer, nullable=False, default=0)
 
-    def __init__(self, username, password):
+    # The password can be given already hashed, as the routes hash it in the
+    # password worker pool.
+    def __init__(self, username, password=None, password_hash=None):
         self.username = username
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hash if password_hash is not None else generate_password_hash(password)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -25,18 +31,37 @@ class User(db.Model, UserMixin):
 
 class Message(db.Model):
     __tablename__ = 'message'
+    # The history endpoints read the messages a user sent or received in time
+    # order, and a conversation reads the messages between two users.
+    __table_args__ = (
+        db.Index('ix_message_sender_id_created_at', 'sender_id', 'created_at'),
+        db.Index('ix_message_recipient_id_created_at', 'recipient_id', 'created_at'),
+        db.Index('ix_message_sender_id_recipient_id_created_at', 'sender_id', 'recipient_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
+    sender_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    # Usernames are kept next to the ids, so listing messages needs no join.
     _from = db.Column(db.String(16))
     _to = db.Column(db.String(16))
     content = db.Column(db.String(128))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-    def __init__(self, _from, _to, content):
-        self._from = _from
-        self._to = _to
+    def __init__(self, sender, recipient, content):
+        self.sender_id = sender.id
+        self.recipient_id = recipient.id
+        self._from = sender.username
+        self._to = recipient.username
         self.content = content
 
 class Tweet(db.Model):
     __tablename__ = 'tweet'
+    # Serves the newest tweets of one author, used by timelines, and the
+    # tweets of the last hours, used by trending.
+    __table_args__ = (
+        db.Index('ix_tweet_uid_id', 'uid', 'id'),
+        db.Index('ix_tweet_created_at', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     uid = db.Column(db.Integer, db.ForeignKey("user.id"))
     # Connect a relationship with User model.
@@ -44,9 +69,79 @@ class Tweet(db.Model):
     title = db.Column(db.String(64))
     content = db.Column(db.String(128))
     like = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     def __init__(self, user, title, content, like):
         self.user = user
         self.title = title
         self.content = content
         self.like = like
+
+# One row per user who likes a tweet. The composite primary key is the unique
+# constraint that stops a user from liking the same tweet twice, and
+# Tweet.like is kept as a denormalized count of these rows.
+class TweetLike(db.Model):
+    __tablename__ = 'tweet_like'
+    __table_args__ = (db.Index('ix_tweet_like_tweet_id', 'tweet_id'),)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    tweet_id = db.Column(db.Integer, db.ForeignKey("tweet.id"), primary_key=True)
+
+    def __init__(self, user_id, tweet_id):
+        self.user_id = user_id
+        self.tweet_id = tweet_id
+
+class Follow(db.Model):
+    __tablename__ = 'follow'
+    # The primary key serves the followees of a user and this index serves the
+    # followers of a user, which is what posting a tweet needs.
+    __table_args__ = (db.Index('ix_follow_followee_id', 'followee_id', 'follower_id'),)
+    follower_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    followee_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+
+    def __init__(self, follower_id, followee_id):
+        self.follower_id = follower_id
+        self.followee_id = followee_id
+
+# Precomputed home timelines: one row for every tweet in a user's home feed.
+# Reading a page is a range scan of the primary key from the cursor down.
+class TimelineEntry(db.Model):
+    __tablename__ = 'timeline'
+    __table_args__ = (db.Index('ix_timeline_tweet_id', 'tweet_id'),)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    tweet_id = db.Column(db.Integer, db.ForeignKey("tweet.id"), primary_key=True)
+
+    def __init__(self, user_id, tweet_id):
+        self.user_id = user_id
+        self.tweet_id = tweet_id
+
+# One row per user and peer they have exchanged messages with: the latest
+# message either way, the read receipt (the id of the last message the user
+# has read) and the number of messages from the peer after it. Chat.post and
+# mark-read keep the rows up to date in their transactions, so the inbox is
+# read one row per conversation instead of scanning messages.
+class ConversationSummary(db.Model):
+    __tablename__ = 'conversation_summary'
+    # Serves the inbox of a user, most recent conversation first.
+    __table_args__ = (db.Index('ix_conversation_summary_user_id_updated_at', 'user_id', 'updated_at', 'peer_id'),)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    peer_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    last_message_id = db.Column(db.Integer, db.ForeignKey("message.id"), nullable=False)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    unread = db.Column(db.Integer, nullable=False, default=0)
+    # The created_at of the latest message.
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+# The unread messages of a user and the number of conversations they are in,
+# the totals of the user's conversation_summary rows.
+class UnreadCounter(db.Model):
+    __tablename__ = 'unread_counter'
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    messages = db.Column(db.Integer, nullable=False, default=0)
+    conversations = db.Column(db.Integer, nullable=False, default=0)
+
+# A counter per table (or other listing) that every write to it increases. Read
+# endpoints use it as their ETag and as the key of their response cache.
+class TableVersion(db.Model):
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
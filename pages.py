@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import threading
+from flask import Response, current_app, render_template, request
+from werkzeug.http import quote_etag
+
+# Brotli is optional. Without it the pages are offered in gzip only.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The register, login and chat pages are static forms with nothing specific
+# to the user in them (there are no CSRF tokens), so one copy serves every
+# request. Each page is rendered the first time a process serves it, which
+# keeps template compiling out of the start of a worker, and kept in memory
+# with its compressed variants and a strong ETag for each. After that a hit
+# is a few dictionary lookups: no template, no compression, and a 304 without
+# a body when the client already has the page.
+#
+# Clients must revalidate every time (no-cache), so a new deploy is seen at
+# once. A revalidation costs a request but no body, as the ETag matches.
+
+# Content codings we compress to, most preferred first.
+CODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+# Accept-Encoding headers seen so far and the coding chosen for them. Clients
+# send a handful of different headers, so the table stays small.
+MAX_CHOICES = 256
+
+def _compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=11)
+    # mtime=0 gives the same bytes in every process, so the ETag holds too.
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+class Page:
+    def __init__(self, body, cache_control):
+        digest = hashlib.sha256(body).hexdigest()[:20]
+        self.bodies = {'identity': body}
+        for coding in CODINGS:
+            compressed = _compress(body, coding)
+            # A variant that does not get smaller is not worth offering.
+            if len(compressed) < len(body):
+                self.bodies[coding] = compressed
+        self.etags = {coding: '%s-%s' % (digest, coding) for coding in self.bodies}
+        self.headers = {}
+        for coding in self.bodies:
+            headers = {'ETag': quote_etag(self.etags[coding]), 'Cache-Control': cache_control,
+                       'Vary': 'Accept-Encoding'}
+            if coding != 'identity':
+                headers['Content-Encoding'] = coding
+            self.headers[coding] = headers
+
+class StaticPages:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.choices = {}
+
+    def page(self, template, private):
+        page = self.pages.get(template)
+        if page is None:
+            cache_control = 'private, no-cache' if private else 'no-cache'
+            page = Page(render_template(template).encode(), cache_control)
+            with self.lock:
+                page = self.pages.setdefault(template, page)
+        return page
+
+    def coding(self, accept_encoding):
+        coding = self.choices.get(accept_encoding)
+        if coding is None:
+            accepted = request.accept_encodings
+            coding = next((coding for coding in CODINGS if accepted[coding] > 0), 'identity')
+            if len(self.choices) < MAX_CHOICES:
+                self.choices[accept_encoding] = coding
+        return coding
+
+    def response(self, template, private=False):
+        page = self.page(template, private)
+        coding = self.coding(request.headers.get('Accept-Encoding', ''))
+        if coding not in page.bodies:
+            coding = 'identity'
+        if request.if_none_match.contains(page.etags[coding]):
+            return Response(status=304, headers=page.headers[coding])
+        return Response(page.bodies[coding], mimetype='text/html', headers=page.headers[coding])
+
+def init_pages(app):
+    app.extensions['pages'] = StaticPages()
+
+# The response for a static page. Pages only logged in users see are private,
+# so that shared caches do not keep them.
+def static_page(template, private=False):
+    return current_app.extensions['pages'].response(template, private)
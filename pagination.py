@@ -0,0 +1,47 @@
+import base64
+from db import db_integer
+
+# Page sizes for list endpoints. Every page is fetched with an index range scan
+# starting at the cursor, so a deep page costs the same as the first one.
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 1000
+
+# The limit comes from the query string, so it is validated here and a
+# ValueError is raised for anything that is not a positive integer.
+def parse_limit(value, default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    if value is None or value == '':
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, maximum)
+
+# Cursors are opaque to clients: the keys of the last row on a page joined by
+# ':' and base64 encoded, so they can be passed around in URLs unchanged.
+def encode_cursor(*keys):
+    raw = ':'.join(str(key) for key in keys)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+# Decode a cursor into a tuple of keys, or None when no cursor is given. Keys
+# are integers in the range of SQLite unless types gives a conversion for each
+# of them. A malformed cursor raises ValueError.
+def decode_cursor(cursor, size=1, types=None):
+    if not cursor:
+        return None
+    types = types or (db_integer,) * size
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        keys = base64.urlsafe_b64decode(padded).decode().split(':')
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error):
+        raise ValueError('malformed cursor')
+    if len(keys) != size:
+        raise ValueError('malformed cursor')
+    return tuple(convert(key) for convert, key in zip(types, keys))
+
+# Split a result fetched with limit + 1 rows into the page and the cursor of
+# the next page. key(row) gives the tuple of keys to encode for the last row.
+def paginate(rows, limit, key):
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(*key(page[-1]))
@@ -0,0 +1,80 @@
+import os
+import threading
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+class PoolSaturated(Exception):
+    pass
+
+# Password hashing is deliberately slow, so it runs in a pool of worker
+# processes instead of on the request thread, where it would hold the GIL and
+# starve every other request. At most max_pending hashes may be queued or
+# running. Past that, requests are turned away at once with PoolSaturated
+# instead of waiting behind a login storm. With max_pending 0 (or less) there
+# is no limit. With no workers, hashing runs inline.
+class HashPool:
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        self.lock = threading.Lock()
+        self.executor = None
+
+    # Worker processes are spawned on first use, not forked, so they do not
+    # inherit the threads and database connections of the app. The modules of
+    # the pool are imported then too, which keeps them out of the app's start.
+    def _executor(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def run(self, function, *args):
+        if self.workers <= 0:
+            return function(*args)
+        return self.submit(function, *args).result()
+
+    # Start function in a worker and return its Future, for callers that wait
+    # for it without blocking a thread. The slot is released when it is done.
+    def submit(self, function, *args):
+        if self.slots is None:
+            return self._executor().submit(function, *args)
+        if not self.slots.acquire(blocking=False):
+            raise PoolSaturated()
+        try:
+            future = self._executor().submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future
+
+def init_hash_pool(app):
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if workers is None:
+        workers = os.cpu_count() or 1
+    app.extensions['hash_pool'] = HashPool(workers, app.config['PASSWORD_HASH_MAX_PENDING'])
+
+def _pool():
+    return current_app.extensions['hash_pool']
+
+# The calls that hash and check a password, as (function, *args) for the pool.
+# asgi.py submits them itself so that it can await them.
+def hash_task(password):
+    return generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD']
+
+def verify_task(password_hash, password):
+    return check_password_hash, password_hash, password
+
+def hash_password(password):
+    return _pool().run(*hash_task(password))
+
+def verify_password(password_hash, password):
+    return _pool().run(*verify_task(password_hash, password))
+
+# A stored hash starts with the method it was made with, for example
+# 'pbkdf2:sha256:260000$salt$hash'. It is out of date when that is not the
+# configured method, for example after the iteration count was raised.
+def needs_rehash(password_hash, method=None):
+    return password_hash.split('$', 1)[0] != (method or current_app.config['PASSWORD_HASH_METHOD'])
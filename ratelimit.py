@@ -0,0 +1,93 @@
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from flask_login import current_user
+from answers import too_many_requests
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Parse a limit like "30/minute" into (requests, seconds).
+def parse_rate(limit):
+    count, _, period = limit.partition('/')
+    return int(count), PERIODS[period]
+
+# Token buckets in memory, one per key. A bucket holds up to capacity tokens,
+# refills at capacity tokens per period and every request takes one. Buckets
+# are spread over shards with a lock each, so requests for different keys
+# rarely wait for each other, and a shard drops its buckets that have refilled
+# completely every sweep_every requests, so idle keys do not pile up.
+#
+# The buckets are per process. A deployment with several processes can share
+# limits by setting RATE_LIMIT_STORE to any object with the same take method,
+# for example one backed by Redis.
+class TokenBuckets:
+    def __init__(self, shards=64, sweep_every=1024):
+        self.shards = [(threading.Lock(), {}) for _ in range(shards)]
+        self.sweep_every = sweep_every
+        self.requests = [0] * shards
+
+    # Take a token for key and return 0, or the seconds until one is available.
+    def take(self, key, capacity, period):
+        rate = capacity / period
+        shard = hash(key) % len(self.shards)
+        lock, buckets = self.shards[shard]
+        now = time.monotonic()
+        with lock:
+            # key -> (tokens, time of the last request, time the bucket is full again)
+            bucket = buckets.get(key)
+            tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+
+            self.requests[shard] += 1
+            if self.requests[shard] % self.sweep_every == 0:
+                for stale in [stale for stale, bucket in buckets.items() if bucket[2] <= now]:
+                    del buckets[stale]
+        return wait
+
+# Checks requests against RATE_LIMITS, per logged in user or otherwise per
+# client address.
+class RateLimiter:
+    def __init__(self, limits, store):
+        self.limits = {name: parse_rate(limit) for name, limit in limits.items() if limit}
+        self.store = store
+
+    def check(self, name):
+        if current_user.is_authenticated:
+            return self.take(name, 'user:%s' % current_user.get_id())
+        return self.take(name, 'ip:%s' % request.remote_addr)
+
+    # Take a token of the limit name for client and return 0, or the seconds
+    # to wait when it is over the limit.
+    def take(self, name, client):
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0
+        return self.store.take('%s:%s' % (name, client), *limit)
+
+def init_rate_limiter(app):
+    if not app.config['RATE_LIMIT']:
+        return
+    store = app.config['RATE_LIMIT_STORE'] or TokenBuckets()
+    app.extensions['rate_limiter'] = RateLimiter(app.config['RATE_LIMITS'], store)
+
+# Limit a Resource method by the limit called name in RATE_LIMITS. Requests
+# over the limit get a 429 before the method runs, without touching the
+# database. Put it below login_required so that the user is known.
+def rate_limit(name):
+    def decorator(method):
+        @wraps(method)
+        def limited(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiter')
+            if limiter is not None:
+                wait = limiter.check(name)
+                if wait:
+                    return too_many_requests(wait)
+            return method(*args, **kwargs)
+        return limited
+    return decorator
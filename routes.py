@@ -1,8 +1,35 @@
-from flask import Flask, request, jsonify, render_template, redirect, make_response
+from datetime import datetime
+from flask import Flask, Response, current_app, request, jsonify, redirect
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
 from flask_restful import Resource
-from models import User, Message, Tweet
-from db import db
+from werkzeug.http import quote_etag
+from models import User, Tweet, TweetLike
+from db import db, reader, run_steps, db_integer
+from accounts import user_by_username, add_user, set_password_hash
+from likes import like_tweet, unlike_tweet, TweetNotFound, AlreadyLiked, NotLiked
+from timeline import follow_user, unfollow_user, remove_tweet, timeline_ids, \
+    UserNotFound, AlreadyFollowing, NotFollowing, CannotFollowSelf
+from pagination import parse_limit, decode_cursor, paginate
+from messages import add_message, conversation, message_key, message_json, HISTORY, history_params, sent_json, received_json
+from archive import with_archived_history
+from inbox import record_message, mark_read, unread_counts, conversations, conversation_key, conversation_json
+from tweets import tweet_json, tweets_json, newest_tweets, tweets_by_id, add_tweet, list_tweet, \
+    listing_etag, listing_page
+from stream import open_stream, publish
+from passwords import hash_password, verify_password, needs_rehash, PoolSaturated
+from user_cache import invalidate_user
+from pages import static_page
+from streaming import stream_json, wants_ndjson, mimetype, YIELD_PER
+from versions import bump_version, current_version
+from bulk import load
+from batch import apply_batch
+from metrics import app_metrics
+from ratelimit import rate_limit
+from trending import tweet_posted, tweet_deleted
+from search import fts_query, search_tweets, search_messages, search_key, CURSOR_TYPES
+from answers import busy, user_not_found, liked, unliked, FIELDS_REQUIRED, INVALID_PAGE, PASSWORD_MISMATCH, \
+    USER_EXISTS, INCORRECT_PASSWORD, MESSAGE_SENT, TWEET_POSTED, TWEET_UPDATED, TWEET_DELETED, TWEET_NOT_FOUND, \
+    NOT_YOUR_TWEET, ALREADY_LIKED, NOT_LIKED
 
 class Index(Resource):
     def get(self):
@@ -15,41 +42,60 @@ class Index(Resource):
 # This route is for the purpose of debugging
 class Users(Resource):
     def get(self):
-        users = User.query.all()
-        return jsonify([{'username': user.username, 'password_hash': user.password_hash, 'id': user.id} for user in users])
+        users = reader().query(User.username, User.password_hash, User.id).yield_per(YIELD_PER)
+        return stream_json(users, lambda user: {'username': user.username, 'password_hash': user.password_hash, 'id': user.id})
+
+# The registration form's error, if it has one.
+def registration_error(username, password, password2):
+    # This case is when the form is not completed.
+    if not (username and password and password2):
+        return FIELDS_REQUIRED
+    # This case is when user inputs two different passwords. Two passwords
+    # must be identical to prevent mistyping.
+    if password != password2:
+        return PASSWORD_MISMATCH
+    return None
+
+# What follows a message or a tweet once it is committed, in both apps: the
+# streams are told, and the trending index gets the tweet.
+def message_sent(message):
+    publish('user:%d' % message.recipient_id, 'message', message_key(message), message_json(message))
+
+def tweet_sent(author, tweet_id, title, content, like, posted):
+    tweet_posted(tweet_id, like, posted)
+    event = {'author': author.username, 'tweet_id': tweet_id, 'title': title, 'content': content, 'like': like}
+    publish('author:%d' % author.id, 'tweet', tweet_id, event)
 
 class Register(Resource):
     def get(self):
         # A logged in user will be redirect to home page
         if current_user.is_authenticated:
             return redirect('/')
-        headers = {'Content-Type': 'text/html'}
-        return make_response(render_template('register.html'), 200, headers)
+        return static_page('register.html')
 
+    @rate_limit('register')
     def post(self):
         username = request.form['username']
         password = request.form['password']
         password2 = request.form['password2']
 
-        # This case is when the form is not completed.
-        if not (username and password and password2):
-            return {'error': 'Fields are required to be filled.'}, 400
+        error = registration_error(username, password, password2)
+        if error is not None:
+            return error
 
         else:
-            # This case is when user inputs two different passwords. Two
-            # passwords must be identical to prevent mistyping.
-            if password != password2:
-                return {'error': 'Password mismatch!'}, 401
-
             # This case is when user registers a username that already exists
             # in the database
-            if User.query.filter_by(username=username).first():
-                return {'error': 'User exists, try another username!'}, 409
+            if run_steps(user_by_username(username)) is not None:
+                return USER_EXISTS
 
             # This case is when a user is successfully registered,
             # and its information will be stored in the database.
-            user = User(username=username, password=password)
-            db.session.add(user)
+            try:
+                password_hash = hash_password(password)
+            except PoolSaturated:
+                return busy()
+            run_steps(add_user(username, password_hash))
             db.session.commit()
             return redirect('/login')
 
@@ -58,15 +104,15 @@ class Login(Resource):
     def get(self):
         if current_user.is_authenticated:
             return redirect('/')
-        headers = {'Content-Type': 'text/html'}
-        return make_response(render_template('login.html'), 200, headers)
+        return static_page('login.html')
 
+    @rate_limit('login')
     def post(self):
         username = request.form['username']
         password = request.form['password']
 
         if not (username and password):
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
 
         else:
             user = User.query.filter_by(username = username).first()
@@ -75,15 +121,31 @@ class Login(Resource):
             if user is not None:
 
                 # Then check if its password is correct.
-                if user.check_password(password):
+                try:
+                    correct = verify_password(user.password_hash, password)
+                except PoolSaturated:
+                    return busy()
+
+                if correct:
+
+                    # Hashes made with an older method are upgraded while we
+                    # know the password. When the pool is busy, that waits
+                    # for the next login.
+                    if needs_rehash(user.password_hash):
+                        try:
+                            run_steps(set_password_hash(user.id, hash_password(password)))
+                            db.session.commit()
+                            invalidate_user(user.id)
+                        except PoolSaturated:
+                            pass
 
                     # Log this user in by login_user provided by flask_login
                     login_user(user)
                     return redirect('/')
                 else:
-                    return {'error': 'Incorrect password!'}, 401
+                    return INCORRECT_PASSWORD
             else:
-                return {'error':'Cannot find user with username ' + username}, 404
+                return user_not_found(username)
 
 class Logout(Resource):
     def get(self):
@@ -94,59 +156,180 @@ class Logout(Resource):
 class Chat(Resource):
     @login_required
     def get(self):
-        headers = {'Content-Type': 'text/html'}
-        return make_response(render_template('chat.html'), 200, headers)
+        return static_page('chat.html', private=True)
 
     @login_required
+    @rate_limit('chat')
     def post(self):
-        _from = current_user.get_username()
         _to = request.form['_to']
         content = request.form['content']
         if (_to and content):
-            if User.query.filter_by(username=_to).first():
-                message = Message(_from=_from, _to=_to, content=content)
-                db.session.add(message)
+            recipient = run_steps(user_by_username(_to))
+            if recipient:
+                # The inbox rows are written in the transaction of the message.
+                message = add_message(current_user, recipient, content)
+                run_steps(record_message(message))
                 db.session.commit()
-                return {'success': 'Message has been sent!'}, 200
+                message_sent(message)
+                return MESSAGE_SENT
             else:
-                return {'error':'Cannot find user with username ' + _to}, 404
+                return user_not_found(_to)
         else:
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
 
 # This endpoint is to check all the messages that current user has sent.
 class SentHistory(Resource):
     @login_required
     def get(self):
-        _from = current_user.get_username()
-        # Get all messages in database whose _from field is current_user's username.
-        messages = Message.query.filter_by(_from=_from)
-        return jsonify([{'_to': m._to, 'message': m.content} for m in messages])
+        # Get all messages in database sent by current_user, oldest first,
+        # read through the (sender_id, created_at) index.
+        user_id = current_user.get_id()
+        messages = with_archived_history(
+            lambda since: reader().execute(HISTORY['sender_id'], history_params(user_id, since)).yield_per(YIELD_PER),
+            user_id, 'sender_id')
+        return stream_json(messages, sent_json)
 
 # This endpoint is to check all the messages that current user has received.
 class ReceivedHistory(Resource):
     @login_required
     def get(self):
-        _to = current_user.get_username()
-        # Get all messages in database whose _to field is current_user's username.
-        messages = Message.query.filter_by(_to=_to)
-        return jsonify([{'_from': m._from, 'message': m.content} for m in messages])
+        # Get all messages in database received by current_user, oldest first,
+        # read through the (recipient_id, created_at) index.
+        user_id = current_user.get_id()
+        messages = with_archived_history(
+            lambda since: reader().execute(HISTORY['recipient_id'], history_params(user_id, since)).yield_per(YIELD_PER),
+            user_id, 'recipient_id')
+        return stream_json(messages, received_json)
+
+# This endpoint is the conversation between current user and another user,
+# newest message first, paginated with a cursor like the tweet listing.
+class Conversation(Resource):
+    @login_required
+    def get(self, username):
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            cursor = decode_cursor(request.args.get('cursor'), size=2)
+        except ValueError:
+            return INVALID_PAGE
+
+        peer = reader().query(User).filter_by(username=username).first()
+        if peer is None:
+            return user_not_found(username)
+
+        messages, next_cursor = paginate(conversation(current_user.get_id(), peer.id, limit + 1, cursor), limit, message_key)
+        response = jsonify([message_json(m) for m in messages])
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+# The conversations of current_user, most recent first, each with its latest
+# message, how many messages of it current_user has not read and the read
+# receipts of both sides, after the unread totals. Paginated with a cursor
+# like the tweet listing, reading one summary row per conversation.
+class Inbox(Resource):
+    @login_required
+    def get(self):
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            cursor = decode_cursor(request.args.get('cursor'), size=2)
+        except ValueError:
+            return INVALID_PAGE
+
+        user_id = current_user.get_id()
+        rows, next_cursor = paginate(conversations(user_id, limit + 1, cursor), limit, conversation_key)
+        unread_messages, unread_conversations = unread_counts(user_id)
+        response = jsonify({
+            'unread_messages': unread_messages,
+            'unread_conversations': unread_conversations,
+            'conversations': [conversation_json(row) for row in rows],
+        })
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+# Mark the conversation with username read, up to message_id when given.
+class MarkRead(Resource):
+    @login_required
+    @rate_limit('read')
+    def post(self):
+        username = request.form['username']
+        if not username:
+            return FIELDS_REQUIRED
+        message_id = request.form.get('message_id')
+        try:
+            message_id = db_integer(message_id) if message_id else None
+        except ValueError:
+            return {'error': 'Invalid message_id.'}, 400
+        try:
+            unread = mark_read(current_user.get_id(), username, message_id)
+        except UserNotFound:
+            return user_not_found(username)
+        return {'success': 'Marked as read!', 'unread': unread}, 200
+
+# Server-Sent Events for current_user: messages they receive and tweets of the
+# users they follow, as they happen. A client that reconnects sends the id of
+# the last event it got in Last-Event-ID and gets what it missed first.
+class Stream(Resource):
+    @login_required
+    def get(self):
+        try:
+            return open_stream(current_user.get_id(), request.headers.get('Last-Event-ID'))
+        except ValueError:
+            return {'error': 'Invalid Last-Event-ID.'}, 400
 
 class Tweets(Resource):
+    # Tweets are listed newest first, one page at a time. The cursor of the
+    # next page is returned in the X-Next-Cursor header so that the body stays
+    # a plain list of tweets.
     @login_required
     def get(self):
-        tweets = Tweet.query.all()
-        username = current_user.get_username()
-        return jsonify([{'author': username, 'tweet_id': t.id, 'title': t.title, 'content': t.content, 'like': t.like} for t in tweets])
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            cursor = decode_cursor(request.args.get('cursor'))
+        except ValueError:
+            return INVALID_PAGE
+
+        # Every write to the tweet table bumps its version, so a client that
+        # already has this version of the page gets a 304 without the tweet
+        # table being read, and pages of the current version are cached.
+        ndjson = wants_ndjson()
+        version = current_version('tweet')
+        etag = listing_etag(version, ndjson)
+        headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        key = (version, cursor, limit, ndjson)
+        cache = current_app.extensions['tweet_cache']
+        page = cache.get(key)
+        if page is None:
+            # Past the hot tweets, the page goes on with the archived ones.
+            archive = current_app.extensions.get('archive')
+            floor = archive.watermarks()['tweet'] if archive is not None else 0
+
+            # Keyset pagination on the primary key: the page starts right below the
+            # last id the client has seen, so no rows are skipped with OFFSET.
+            # Fetch one extra row to know whether there is a next page.
+            tweets = newest_tweets(limit + 1, cursor[0] if cursor is not None else None, floor)
+            if floor and len(tweets) <= limit:
+                tweets += archive.tweets(limit + 1 - len(tweets), min(cursor[0], floor) if cursor is not None else floor)
+            page = listing_page(tweets, limit, ndjson)
+            cache.put(key, page)
+
+        body, next_cursor = page
+        if next_cursor is not None:
+            headers['X-Next-Cursor'] = next_cursor
+        return Response(body, mimetype=mimetype(ndjson), headers=headers)
 
     @login_required
+    @rate_limit('tweet')
     def post(self):
         # Get uid through current_user.
         uid = current_user.get_id()
 
-        # Find this user in database. Note that this user must exists in the database,
-        # because when we log in this user, its information is already checked in
-        # the database.
-        user = User.query.filter_by(id = uid).first()
+        # current_user is already loaded into this request's session by the
+        # user loader, so the tweet can refer to it without another query.
+        user = current_user._get_current_object()
 
         # Get those information to create a new Tweet.
         title = request.form['title']
@@ -154,18 +337,19 @@ class Tweets(Resource):
         like = 0
 
         if (title and content):
-            tweet = Tweet(user, title, content, like)
-            db.session.add(tweet)
+            # Push the new tweet into the followers' home timelines in the same
+            # transaction, which needs its id first.
+            tweet_id, posted = add_tweet(user, title, content, like)
+            run_steps(list_tweet(user, tweet_id))
             db.session.commit()
-            return {'success': 'Tweet has been posted!'}, 200
+            tweet_sent(user, tweet_id, title, content, like, posted)
+            return TWEET_POSTED
         else:
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
 
     @login_required
+    @rate_limit('tweet')
     def put(self):
-        uid = current_user.get_id()
-        user = User.query.filter_by(id = uid).first()
-
         # This is very similar to the post method, except we need to find the tweet_id
         # we want to update.
         tweet_id = request.form['tweet_id']
@@ -174,67 +358,213 @@ class Tweets(Resource):
         if (tweet_id and title and content):
             tweet = Tweet.query.filter_by(id = tweet_id).first()
             if tweet is not None:
+                # Only the author may change a Tweet, as in POST /batch.
+                if tweet.uid != current_user.id:
+                    return NOT_YOUR_TWEET
 
                 # Update this Tweet
                 tweet.title = title
                 tweet.content = content
+                bump_version('tweet')
                 db.session.commit()
-                return {'success': 'Tweet has been updated!'}, 200
+                return TWEET_UPDATED
             else:
                 return {'error': 'Tweet Not Found.'}, 404
         else:
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
 
     @login_required
+    @rate_limit('tweet')
     def delete(self):
         tweet_id = request.form['tweet_id']
         if tweet_id:
             tweet = Tweet.query.filter_by(id = tweet_id).first()
             if tweet is not None:
+                if tweet.uid != current_user.id:
+                    return NOT_YOUR_TWEET
+                tweet_id = tweet.id
+                TweetLike.query.filter_by(tweet_id=tweet_id).delete()
+                remove_tweet(tweet_id)
                 db.session.delete(tweet)
+                bump_version('tweet')
                 db.session.commit()
-                return {'success': 'Tweet has been deleted!'}, 200
+                tweet_deleted(tweet_id)
+                return TWEET_DELETED
             else:
-                return {'error': 'Tweet Not Found'}, 404
+                return TWEET_NOT_FOUND
         else:
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
 
-# Note that this function is not fully implemented yet. If I had more time,
-# I will add another field 'liked_user' to the Tweet model, which contains all
-# user ids for those who like this Tweet. Then if a user is in the 'liked_user'
-# field, then he is not allowed to like this Tweet again.
+# A user can like a Tweet only once. Each like is a row in tweet_like, and the
+# like count on the Tweet is updated in the database in the same transaction.
 class Like(Resource):
+    @login_required
+    @rate_limit('like')
     def post(self):
         tweet_id = request.form['tweet_id']
         if tweet_id:
-            tweet = Tweet.query.filter_by(id = tweet_id).first()
-            if tweet is not None:
-
-                # Add one more like to this Tweet.
-                current_like = tweet.like+1
-                tweet.like = current_like
-                db.session.commit()
-                return {'success': 'Liked the Tweet! Like count is now '+ str(current_like) + '!'}, 200
-            else:
-                return {'error': 'Tweet Not Found'}, 404
+            try:
+                current_like = like_tweet(current_user.get_id(), tweet_id)
+            except TweetNotFound:
+                return TWEET_NOT_FOUND
+            except AlreadyLiked:
+                return ALREADY_LIKED
+            return liked(current_like)
         else:
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
 
 class Unlike(Resource):
+    @login_required
+    @rate_limit('like')
     def post(self):
         tweet_id = request.form['tweet_id']
         if tweet_id:
-            tweet = Tweet.query.filter_by(id = tweet_id).first()
-            if tweet is not None:
-                # Subtract one more like from this Tweet.
-                current_like = tweet.like-1
-                tweet.like = current_like
-                db.session.commit()
-                return {'success': 'Unliked the Tweet! Like count is now '+ str(current_like) + '!'}, 200
-            else:
-                return {'error': 'Tweet Not Found'}, 404
+            try:
+                current_like = unlike_tweet(current_user.get_id(), tweet_id)
+            except TweetNotFound:
+                return TWEET_NOT_FOUND
+            except NotLiked:
+                return NOT_LIKED
+            return unliked(current_like)
         else:
-            return {'error': 'Fields are required to be filled.'}, 400
+            return FIELDS_REQUIRED
+
+# The tweets with the most likes for their age, best first, from the trending
+# index, which the post and like paths keep up to date.
+class Trending(Resource):
+    @login_required
+    def get(self):
+        try:
+            limit = parse_limit(request.args.get('limit'))
+        except ValueError:
+            return {'error': 'Invalid limit.'}, 400
+
+        trending = current_app.extensions['trending']
+        top = trending.top(limit)
+        rows = {row.id: row for row in tweets_by_id([tweet_id for tweet_id, key in top])}
+        now = datetime.utcnow()
+        return jsonify([dict(tweet_json(rows[tweet_id]), score=round(trending.score(key, now), 6))
+                        for tweet_id, key in top if tweet_id in rows])
+
+# Apply a JSON array of like, unlike, update and delete operations (see
+# batch.py) in one request and one transaction. The body lists the status and
+# the answer of the single endpoint for every operation, in order.
+class Batch(Resource):
+    @login_required
+    def post(self):
+        operations = request.get_json(force=True, silent=True)
+        if not isinstance(operations, list):
+            return {'error': 'Expected a JSON array of operations.'}, 400
+        maximum = current_app.config['BATCH_MAX_OPERATIONS']
+        if len(operations) > maximum:
+            return {'error': 'At most %d operations per batch.' % maximum}, 413
+        results = apply_batch(current_user.get_id(), operations)
+        return {'results': [dict(body, status=status) for body, status in results]}, 200
+
+# Full-text search over tweets, or with type=messages over the messages
+# current_user sent or received. Results are ranked best match first, come with
+# a snippet of the matching text and are paginated like the tweet listing,
+# though the pages are only approximate when the index changes in between
+# (see search.py).
+class Search(Resource):
+    @login_required
+    def get(self):
+        query = fts_query(request.args.get('q'))
+        if query is None:
+            return FIELDS_REQUIRED
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            cursor = decode_cursor(request.args.get('cursor'), size=3, types=CURSOR_TYPES)
+        except ValueError:
+            return INVALID_PAGE
+
+        if request.args.get('type', 'tweets') == 'messages':
+            rows, floor = search_messages(current_user.get_id(), query, limit + 1, cursor)
+            results = lambda page: [{
+                'message_id': m.id, '_from': m._from, '_to': m._to, 'message': m.content,
+                'created_at': datetime.fromisoformat(m.created_at).isoformat(), 'snippet': m.snippet,
+            } for m in page]
+        else:
+            rows, floor = search_tweets(query, limit + 1, cursor)
+            results = lambda page: [dict(tweet_json(t), snippet=t.snippet) for t in page]
+
+        page, next_cursor = paginate(rows, limit, search_key(floor))
+        response = jsonify(results(page))
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+# Post many tweets at once as current_user: one JSON object per line with
+# title and content. The report says how many were inserted, which lines were
+# skipped and why, and the rows per second.
+class BulkTweets(Resource):
+    @login_required
+    @rate_limit('bulk')
+    def post(self):
+        report = load('tweets', request.stream, batch_size=current_app.config['BULK_BATCH_SIZE'],
+                      author_id=current_user.get_id())
+        return report, 200
+
+# Request metrics in the Prometheus text format, when METRICS is on.
+class Metrics(Resource):
+    def get(self):
+        metrics = current_app.extensions.get('metrics')
+        if metrics is None:
+            return {'error': 'Metrics are disabled.'}, 404
+        body = metrics.render(app_metrics(current_app))
+        return Response(body, mimetype='text/plain', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class Follow(Resource):
+    @login_required
+    @rate_limit('follow')
+    def post(self):
+        username = request.form['username']
+        if username:
+            try:
+                follow_user(current_user.get_id(), username)
+            except UserNotFound:
+                return user_not_found(username)
+            except CannotFollowSelf:
+                return {'error': 'You cannot follow yourself!'}, 400
+            except AlreadyFollowing:
+                return {'error': 'You are already following ' + username + '!'}, 409
+            return {'success': 'You are now following ' + username + '!'}, 200
+        else:
+            return FIELDS_REQUIRED
+
+class Unfollow(Resource):
+    @login_required
+    @rate_limit('follow')
+    def post(self):
+        username = request.form['username']
+        if username:
+            try:
+                unfollow_user(current_user.get_id(), username)
+            except UserNotFound:
+                return user_not_found(username)
+            except NotFollowing:
+                return {'error': 'You are not following ' + username + '!'}, 409
+            return {'success': 'You are no longer following ' + username + '!'}, 200
+        else:
+            return FIELDS_REQUIRED
+
+# The home timeline of current_user: their own tweets and the tweets of the
+# users they follow, newest first, paginated like the tweet listing.
+class Timeline(Resource):
+    @login_required
+    def get(self):
+        try:
+            limit = parse_limit(request.args.get('limit'))
+            cursor = decode_cursor(request.args.get('cursor'))
+        except ValueError:
+            return INVALID_PAGE
+
+        before = cursor[0] if cursor is not None else None
+        ids, next_cursor = paginate(timeline_ids(current_user.get_id(), limit + 1, before), limit, lambda i: (i,))
+        response = jsonify(tweets_json(tweets_by_id(ids)))
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
 
 # Add resource to api to initialize routes.
 def initialize_routes(api):
@@ -246,6 +576,18 @@ def initialize_routes(api):
     api.add_resource(Chat, '/chat')
     api.add_resource(SentHistory, '/history/sent')
     api.add_resource(ReceivedHistory, '/history/received')
+    api.add_resource(Conversation, '/conversation/<string:username>')
+    api.add_resource(Inbox, '/inbox')
+    api.add_resource(MarkRead, '/inbox/read')
+    api.add_resource(Stream, '/stream')
     api.add_resource(Tweets, '/tweet')
     api.add_resource(Like, '/like')
     api.add_resource(Unlike, '/unlike')
+    api.add_resource(Follow, '/follow')
+    api.add_resource(Unfollow, '/unfollow')
+    api.add_resource(Timeline, '/timeline')
+    api.add_resource(Trending, '/trending')
+    api.add_resource(Batch, '/batch')
+    api.add_resource(Search, '/search')
+    api.add_resource(BulkTweets, '/bulk/tweets')
+    api.add_resource(Metrics, '/metrics')
@@ -0,0 +1,87 @@
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from search import INDEXES, rebuild_index
+from inbox import summarize_since
+from db import db
+
+# create_all only creates the tables that are missing and never changes a
+# table that exists, so the columns added to a table after its first release
+# are added here, to databases made before them, and filled in from the rows
+# already there. An upgrade is skipped when its column exists, so running it
+# again is safe. Each one is (table, column, definition, backfill statements),
+# and {now} in a definition is the time of the upgrade, which existing rows
+# get as their created_at.
+UPGRADES = [
+    ('user', 'follower_count', 'INTEGER NOT NULL DEFAULT 0', [
+        'UPDATE user SET follower_count = (SELECT count(*) FROM follow WHERE follow.followee_id = user.id)',
+    ]),
+    # Messages of a username that no longer exists keep 0 and belong to no one.
+    ('message', 'sender_id', 'INTEGER NOT NULL DEFAULT 0', [
+        'UPDATE message SET sender_id = coalesce((SELECT id FROM user WHERE user.username = message._from), 0)',
+    ]),
+    ('message', 'recipient_id', 'INTEGER NOT NULL DEFAULT 0', [
+        'UPDATE message SET recipient_id = coalesce((SELECT id FROM user WHERE user.username = message._to), 0)',
+    ]),
+    ('message', 'created_at', "DATETIME NOT NULL DEFAULT '{now}'", []),
+    ('tweet', 'created_at', "DATETIME NOT NULL DEFAULT '{now}'", []),
+]
+
+def _columns(connection, table):
+    return {row[1] for row in connection.execute(text('PRAGMA table_info("%s")' % table))}
+
+def _tables(connection):
+    return {row[0] for row in connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+
+# Bring the tables of the main database up to date with the models, in one
+# transaction. The indexes of an upgraded table that are missing, those on
+# its new columns, are created once its columns are filled in.
+def upgrade(connection):
+    # In the format of the DateTime columns.
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    upgraded = []
+    for table, column, definition, backfill in UPGRADES:
+        if column in _columns(connection, table):
+            continue
+        definition = definition.format(now=now)
+        connection.execute(text('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table, column, definition)))
+        for statement in backfill:
+            connection.execute(text(statement))
+        upgraded.append(table)
+    for table in dict.fromkeys(upgraded):
+        for index in db.Model.metadata.tables[table].indexes:
+            index.create(connection, checkfirst=True)
+    # Messages from before the inbox get their conversations and unread counts.
+    if 'message' in upgraded:
+        summarize_since(connection, 0)
+
+    # The full-text indexes of search.py are only created with their tables,
+    # so tables made before them get theirs here, built from their rows.
+    tables = _tables(connection)
+    for table in INDEXES:
+        if table + '_fts' not in tables:
+            connection.execute(text(INDEXES[table][0]))
+            rebuild_index(connection, table)
+
+# The tables are created by an explicit step, `flask init-db` when deploying
+# or create_schema in scripts and tests, instead of being checked before the
+# first request of every worker. Only missing tables are created and only
+# missing columns added, so running it again is safe.
+def create_schema(app):
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as connection:
+            upgrade(connection)
+        archive = app.extensions.get('archive')
+        if archive is not None:
+            archive.create_all()
+
+# flask init-db
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create the tables that do not exist yet and add missing columns."""
+    create_schema(current_app)
+    click.echo('Database tables are ready.')
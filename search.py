@@ -0,0 +1,146 @@
+import re
+from flask import current_app
+from sqlalchemy import DDL, event, text
+from models import Tweet, Message
+from db import reader, db_integer
+
+# Full-text indexes over tweets and messages. They are FTS5 external content
+# tables: the text stays in tweet and message, the index only stores the terms,
+# and triggers keep it in sync in the same transaction as every write. The
+# update trigger on tweet only fires for title and content, so like counters
+# do not touch the index. Prefixes of 2 and 3 characters are indexed so that
+# short prefix queries do not scan the whole term list.
+TWEET_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tweet_fts USING fts5("
+    "title, content, content='tweet', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS tweet_fts_insert AFTER INSERT ON tweet BEGIN "
+    "INSERT INTO tweet_fts (rowid, title, content) VALUES (new.id, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS tweet_fts_delete AFTER DELETE ON tweet BEGIN "
+    "INSERT INTO tweet_fts (tweet_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS tweet_fts_update AFTER UPDATE OF title, content ON tweet BEGIN "
+    "INSERT INTO tweet_fts (tweet_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); "
+    "INSERT INTO tweet_fts (rowid, title, content) VALUES (new.id, new.title, new.content); END",
+]
+MESSAGE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "content, content='message', content_rowid='id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN "
+    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END",
+]
+
+INDEXES = {'tweet': TWEET_INDEX, 'message': MESSAGE_INDEX}
+
+for table, statements in [(Tweet.__table__, TWEET_INDEX), (Message.__table__, MESSAGE_INDEX)]:
+    for statement in statements:
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+# Bulk loads drop the triggers of a table, so that rows are not indexed one at
+# a time, and rebuild its index in one pass once all rows are in.
+def drop_sync_triggers(connection, table):
+    for action in ('insert', 'delete', 'update'):
+        connection.execute(text('DROP TRIGGER IF EXISTS %s_fts_%s' % (table, action)))
+
+def rebuild_index(connection, table):
+    connection.execute(text("INSERT INTO {0}_fts ({0}_fts) VALUES ('rebuild')".format(table)))
+    for statement in INDEXES[table]:
+        connection.execute(text(statement))
+
+# Ranking every match with BM25 costs time in proportion to the number of
+# matches, which is huge for a short prefix on a big table. So only the newest
+# SEARCH_WINDOW matches are ranked: the window is fixed by the lowest id among
+# them (the floor), found by walking the index in id order, which is cheap.
+# The floor is kept in the cursor, so later pages do not reach further back
+# than the first one did.
+#
+# Pages are approximate. They go on after the (score, id) of the last row,
+# but BM25 scores depend on the whole index, so a write between two pages can
+# move rows across that point: a row may then show up twice or be skipped, and
+# new matches join the later pages. Exact pages would need the ranked ids of
+# every search kept somewhere all workers can read them, a write for each
+# search, which is not worth it for a search box.
+
+# Titles count twice as much as content when ranking tweets.
+TWEET_FLOOR = """
+SELECT coalesce(min(rowid), 0) FROM (
+    SELECT rowid FROM tweet_fts WHERE tweet_fts MATCH :query ORDER BY rowid DESC LIMIT :window
+)
+"""
+TWEET_SEARCH = """
+SELECT tweet.id, tweet.title, tweet.content, tweet."like", user.username,
+       bm25(tweet_fts, 2.0, 1.0) AS score,
+       snippet(tweet_fts, -1, '<mark>', '</mark>', '...', 12) AS snippet
+FROM tweet_fts
+JOIN tweet ON tweet.id = tweet_fts.rowid
+JOIN user ON user.id = tweet.uid
+WHERE tweet_fts MATCH :query AND tweet_fts.rowid >= :floor {after}
+ORDER BY score, tweet.id
+LIMIT :limit
+"""
+
+# Messages are matched and then narrowed to the ones the user sent or received.
+MESSAGE_FLOOR = """
+SELECT coalesce(min(id), 0) FROM (
+    SELECT message.id FROM message_fts
+    JOIN message ON message.id = message_fts.rowid
+    WHERE message_fts MATCH :query AND (message.sender_id = :user_id OR message.recipient_id = :user_id)
+    ORDER BY message_fts.rowid DESC LIMIT :window
+)
+"""
+MESSAGE_SEARCH = """
+SELECT message.id, message._from, message._to, message.content, message.created_at,
+       bm25(message_fts) AS score,
+       snippet(message_fts, 0, '<mark>', '</mark>', '...', 12) AS snippet
+FROM message_fts
+JOIN message ON message.id = message_fts.rowid
+WHERE message_fts MATCH :query AND message_fts.rowid >= :floor
+AND (message.sender_id = :user_id OR message.recipient_id = :user_id) {after}
+ORDER BY score, message.id
+LIMIT :limit
+"""
+
+# Keyset pagination on (score, id): the next page starts after the last row,
+# as ranked now (see above).
+AFTER = "AND (bm25({table}{weights}) > :score OR (bm25({table}{weights}) = :score AND {column} > :id))"
+
+CURSOR_TYPES = (float, db_integer, db_integer)
+
+# Turn what the user typed into an FTS5 query. Every word is quoted, so that
+# FTS5 syntax in the input cannot break the query, and all words must match.
+# A word ending in * matches every word starting with it. Returns None when
+# there is nothing to search for.
+def fts_query(text):
+    terms = re.findall(r'(\w+)(\*?)', text or '')
+    if not terms:
+        return None
+    return ' '.join('"%s"%s' % (word, star) for word, star in terms)
+
+def _search(floor_statement, statement, table, weights, column, params, limit, cursor):
+    params = dict(params, limit=limit, window=current_app.config['SEARCH_WINDOW'])
+    if cursor is None:
+        params['floor'] = reader().execute(text(floor_statement), params).scalar()
+        after = ''
+    else:
+        params.update(score=cursor[0], id=cursor[1], floor=cursor[2])
+        after = AFTER.format(table=table, weights=weights, column=column)
+    rows = reader().execute(text(statement.format(after=after)), params).fetchall()
+    return rows, params['floor']
+
+# One page of tweets matching query, best match first, and the floor of the
+# window to pass to search_key. cursor is the (score, id, floor) of the last
+# row of the previous page.
+def search_tweets(query, limit, cursor=None):
+    return _search(TWEET_FLOOR, TWEET_SEARCH, 'tweet_fts', ', 2.0, 1.0', 'tweet.id',
+                   {'query': query}, limit, cursor)
+
+# One page of the messages user_id sent or received matching query.
+def search_messages(user_id, query, limit, cursor=None):
+    return _search(MESSAGE_FLOOR, MESSAGE_SEARCH, 'message_fts', '', 'message.id',
+                   {'query': query, 'user_id': user_id}, limit, cursor)
+
+def search_key(floor):
+    return lambda row: (row.score, row.id, floor)
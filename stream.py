@@ -0,0 +1,180 @@
+import json
+import threading
+from collections import defaultdict, deque
+from flask import current_app, Response
+from sqlalchemy import tuple_
+from models import Message
+from messages import message_key, message_json, key_time
+from pagination import decode_cursor, encode_cursor
+from timeline import timeline_ids, followee_ids
+from tweets import tweets_by_id, tweets_json
+from db import reader
+
+# Returned by Subscription.get when events were dropped because the client did
+# not keep up. The stream then tells the client to reconnect, and the events
+# are replayed from the database using Last-Event-ID.
+OVERFLOW = object()
+
+# The events waiting to be sent on one connection. The queue is bounded: a slow
+# client loses its queue instead of growing it without limit.
+class Subscription:
+    def __init__(self, topics, size):
+        self.topics = topics
+        self.size = size
+        self.events = deque()
+        self.overflowed = False
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        with self.condition:
+            if self.overflowed:
+                return
+            if len(self.events) >= self.size:
+                self.overflowed = True
+                self.events.clear()
+            else:
+                self.events.append(event)
+            self.condition.notify()
+
+    # Wait up to timeout seconds for the next event, and return None if there was none.
+    def get(self, timeout):
+        with self.condition:
+            if not self.events and not self.overflowed:
+                self.condition.wait(timeout)
+            if self.overflowed:
+                return OVERFLOW
+            return self.events.popleft() if self.events else None
+
+# In-process publish/subscribe. Topics are 'user:<id>' for the messages a user
+# receives and 'author:<id>' for the tweets a user posts. Publishing only takes
+# the lock to copy the subscribers of one topic, so it is cheap even with
+# thousands of open streams.
+#
+# Idle streams wait on a Condition, so with a cooperative worker (for example
+# gunicorn -k gevent, which patches threading) an idle connection costs a
+# greenlet and a small queue, not an operating system thread.
+class Broker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, topics, size):
+        subscription = Subscription(topics, size)
+        with self.lock:
+            for topic in topics:
+                self.subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers[topic].discard(subscription)
+                if not self.subscribers[topic]:
+                    del self.subscribers[topic]
+
+    def publish(self, topic, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def count(self):
+        with self.lock:
+            return len(set().union(*self.subscribers.values())) if self.subscribers else 0
+
+def init_broker(app):
+    app.extensions['broker'] = Broker()
+
+# Publish an event after its transaction has committed. key is the message key
+# of a message or the id of a tweet, and is used for Last-Event-ID.
+def publish(topic, kind, key, data):
+    current_app.extensions['broker'].publish(topic, (kind, key, data))
+
+def _format(kind, position, data):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (encode_cursor(*position), kind, json.dumps(data))
+
+# A stream position is (message created_at in microseconds, message id, tweet
+# id): the last message received and the last timeline tweet sent. It is sent
+# as the id of every event, so a client that reconnects with Last-Event-ID
+# gets everything after it from the indexed message and timeline tables.
+def _current_position(user_id):
+    message = reader().query(Message).filter_by(recipient_id=user_id) \
+        .order_by(Message.created_at.desc(), Message.id.desc()).first()
+    tweet_ids = timeline_ids(user_id, 1)
+    return list(message_key(message) if message else (0, 0)) + [tweet_ids[0] if tweet_ids else 0]
+
+def _replay(user_id, position, limit):
+    messages = reader().query(Message) \
+        .filter(Message.recipient_id == user_id,
+                tuple_(Message.created_at, Message.id) > tuple_(key_time(position[0]), position[1])) \
+        .order_by(Message.created_at, Message.id).limit(limit).all()
+    events = [('message', message_key(m), message_json(m)) for m in messages]
+
+    ids = timeline_ids(user_id, limit, after=position[2])
+    events += [('tweet', row['tweet_id'], row) for row in tweets_json(tweets_by_id(ids))]
+    return events, len(messages) >= limit or len(ids) >= limit
+
+# Open the event stream of a user. All database reads happen here, before the
+# response starts, so an idle stream holds no database connection.
+# Raises ValueError for a malformed Last-Event-ID.
+def open_stream(user_id, last_event_id):
+    position = decode_cursor(last_event_id, size=3)
+    config = current_app.config
+    broker = current_app.extensions['broker']
+
+    topics = ['user:%d' % user_id] + ['author:%d' % uid for uid in [user_id] + followee_ids(user_id)]
+    # Subscribe before reading the database, so that nothing published in
+    # between is lost. Events already replayed are skipped later.
+    subscription = broker.subscribe(topics, config['STREAM_QUEUE_SIZE'])
+    try:
+        if position is None:
+            position, replay, more = _current_position(user_id), [], False
+        else:
+            position = list(position)
+            replay, more = _replay(user_id, position, config['STREAM_REPLAY_LIMIT'])
+    except Exception:
+        broker.unsubscribe(subscription)
+        raise
+
+    heartbeat = config['STREAM_HEARTBEAT_SECONDS']
+    replayed = {(kind, key) for kind, key, data in replay}
+
+    def advance(kind, key):
+        if kind == 'message':
+            position[0:2] = max(tuple(position[0:2]), key)
+        else:
+            position[2] = max(position[2], key)
+
+    def events():
+        try:
+            yield 'retry: 3000\n\n'
+            for kind, key, data in replay:
+                advance(kind, key)
+                yield _format(kind, position, data)
+            # The replay was cut at the limit, let the client come back for the rest.
+            if more:
+                yield 'event: resync\ndata: {}\n\n'
+                return
+            while True:
+                event = subscription.get(heartbeat)
+                if event is None:
+                    yield ': keepalive\n\n'
+                    continue
+                if event is OVERFLOW:
+                    yield 'event: resync\ndata: {}\n\n'
+                    return
+                kind, key, data = event
+                if (kind, key) in replayed:
+                    continue
+                advance(kind, key)
+                yield _format(kind, position, data)
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # Also unsubscribe if the client goes away before the first event.
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
@@ -0,0 +1,74 @@
+import json
+from flask import Response, request, stream_with_context
+
+# Rows are fetched from the database this many at a time, and the encoded JSON
+# is sent in chunks of about CHUNK_SIZE characters.
+YIELD_PER = 1000
+CHUNK_SIZE = 65536
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+
+# Encodes rows one at a time into the JSON array, or NDJSON, of
+# serialize(row), and hands out the text in chunks of about CHUNK_SIZE
+# characters. It does no I/O, so that both stream_json and the async handlers
+# of asgi.py, which read rows in their own way, send the same bytes.
+class ChunkEncoder:
+    def __init__(self, serialize, ndjson):
+        self.encode = json.JSONEncoder(separators=(',', ':')).encode
+        self.serialize = serialize
+        self.ndjson = ndjson
+        self.chunk = [] if ndjson else ['[']
+        self.size = 0
+        self.first = True
+
+    # Add a row, and return the next chunk once it is full, or else None.
+    def add(self, row):
+        if not self.first and not self.ndjson:
+            self.chunk.append(',')
+        self.first = False
+        text = self.encode(self.serialize(row))
+        self.chunk.append(text + '\n' if self.ndjson else text)
+        self.size += len(text)
+        if self.size < CHUNK_SIZE:
+            return None
+        chunk = ''.join(self.chunk)
+        self.chunk, self.size = [], 0
+        return chunk
+
+    # The last chunk, which ends the array. Empty for NDJSON with nothing left.
+    def close(self):
+        if not self.ndjson:
+            self.chunk.append(']\n')
+        return ''.join(self.chunk)
+
+def _chunks(rows, serialize, ndjson):
+    encoder = ChunkEncoder(serialize, ndjson)
+    for row in rows:
+        chunk = encoder.add(row)
+        if chunk is not None:
+            yield chunk
+    chunk = encoder.close()
+    if chunk:
+        yield chunk
+
+def mimetype(ndjson):
+    return 'application/x-ndjson' if ndjson else 'application/json'
+
+# Encode all rows at once, the same way stream_json does, for responses that
+# are small enough to be kept, for example in a cache.
+def encode_json(rows, serialize, ndjson):
+    return ''.join(_chunks(rows, serialize, ndjson)).encode()
+
+# Return a streamed response with the JSON array of serialize(row) for every
+# row, or one JSON document per line when the client asks for NDJSON with
+# ?format=ndjson or an Accept header. Rows are encoded while they are read, so
+# memory stays the same whatever the number of rows and the first bytes go out
+# before the last row is read. Pass a query with yield_per to stream rows from
+# the database cursor as well.
+def stream_json(rows, serialize, headers=None):
+    ndjson = wants_ndjson()
+    # stream_with_context keeps the request, and with it the database session
+    # the rows come from, open until the last chunk has been sent.
+    return Response(stream_with_context(_chunks(rows, serialize, ndjson)), mimetype=mimetype(ndjson), headers=headers)
@@ -0,0 +1,155 @@
+from flask import current_app
+from sqlalchemy import text
+from models import User, Tweet, Follow, TimelineEntry
+from user_cache import invalidate_user
+from db import db, reader
+
+class UserNotFound(Exception):
+    pass
+
+class AlreadyFollowing(Exception):
+    pass
+
+class NotFollowing(Exception):
+    pass
+
+class CannotFollowSelf(Exception):
+    pass
+
+# Home timelines are built with fan-out-on-write: a new tweet is pushed into the
+# timeline of every follower of its author, so reading a feed is a range scan
+# of the timeline table. Authors with more than TIMELINE_FANOUT_LIMIT followers
+# are not fanned out. Their tweets are pulled from the tweet table when a
+# follower reads the feed, so one celebrity tweet costs one row, not millions.
+# When such an author falls back to the limit, their latest tweets are pushed
+# to all their followers, as those were never fanned out.
+
+FAN_OUT = text(
+    'INSERT OR IGNORE INTO timeline (user_id, tweet_id) '
+    'SELECT follower_id, :tweet_id FROM follow WHERE followee_id = :author_id'
+)
+BACKFILL = text(
+    'INSERT OR IGNORE INTO timeline (user_id, tweet_id) '
+    'SELECT :user_id, id FROM tweet WHERE uid = :author_id ORDER BY id DESC LIMIT :limit'
+)
+BACKFILL_FOLLOWERS = text(
+    'INSERT OR IGNORE INTO timeline (user_id, tweet_id) '
+    'SELECT follow.follower_id, latest.id FROM follow, '
+    '(SELECT id FROM tweet WHERE uid = :author_id ORDER BY id DESC LIMIT :limit) AS latest '
+    'WHERE follow.followee_id = :author_id'
+)
+REMOVE_AUTHOR = text(
+    'DELETE FROM timeline WHERE user_id = :user_id '
+    'AND tweet_id IN (SELECT id FROM tweet WHERE uid = :author_id)'
+)
+INSERT_TIMELINE = text('INSERT OR IGNORE INTO timeline (user_id, tweet_id) VALUES (:user_id, :tweet_id)')
+INSERT_FOLLOW = text('INSERT OR IGNORE INTO follow (follower_id, followee_id) VALUES (:follower_id, :followee_id)')
+DELETE_FOLLOW = text('DELETE FROM follow WHERE follower_id = :follower_id AND followee_id = :followee_id')
+ADD_FOLLOWERS = text('UPDATE user SET follower_count = follower_count + :delta WHERE id = :user_id')
+REMOVE_FOLLOWER = text('UPDATE user SET follower_count = follower_count - 1 WHERE id = :user_id RETURNING follower_count')
+
+def _fanout_limit():
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+
+def _is_celebrity(user):
+    return (user.follower_count or 0) > _fanout_limit()
+
+# Steps (see db.run_steps) that add a new tweet to the author's own timeline
+# and, unless the author has too many followers, to the timelines of all
+# followers. They run in the transaction of the tweet, so the tweet and its
+# timeline rows are committed together.
+def fan_out(author, tweet_id):
+    yield INSERT_TIMELINE, {'user_id': author.id, 'tweet_id': tweet_id}
+    if not _is_celebrity(author):
+        yield FAN_OUT, {'tweet_id': tweet_id, 'author_id': author.id}
+
+FAN_OUT_SINCE = text(
+    'INSERT OR IGNORE INTO timeline (user_id, tweet_id) '
+    'SELECT uid, id FROM tweet WHERE id > :after '
+    'UNION ALL '
+    'SELECT follow.follower_id, tweet.id FROM tweet '
+    'JOIN user ON user.id = tweet.uid '
+    'JOIN follow ON follow.followee_id = tweet.uid '
+    'WHERE tweet.id > :after AND user.follower_count <= :limit'
+)
+
+# Fan out every tweet with an id above after in one statement, for tweets that
+# were inserted in bulk.
+def fan_out_since(connection, after):
+    connection.execute(FAN_OUT_SINCE, {'after': after, 'limit': _fanout_limit()})
+
+def _followee(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise UserNotFound(username)
+    return user
+
+# Follow a user and copy their latest tweets into the follower's timeline, so
+# that the feed is not empty until they post again.
+def follow_user(follower_id, username):
+    followee = _followee(username)
+    if followee.id == follower_id:
+        raise CannotFollowSelf(username)
+    params = {'follower_id': follower_id, 'followee_id': followee.id}
+    if db.session.execute(INSERT_FOLLOW, params).rowcount == 0:
+        db.session.rollback()
+        raise AlreadyFollowing(username)
+    db.session.execute(ADD_FOLLOWERS, {'user_id': followee.id, 'delta': 1})
+    if not _is_celebrity(followee):
+        db.session.execute(BACKFILL, {
+            'user_id': follower_id,
+            'author_id': followee.id,
+            'limit': current_app.config.get('TIMELINE_BACKFILL', 100),
+        })
+    db.session.commit()
+    invalidate_user(followee.id)
+
+# Unfollow a user and drop their tweets from the follower's timeline. If that
+# brings the user back to the fan-out limit, the tweets their followers pulled
+# until now are pushed into their timelines.
+def unfollow_user(follower_id, username):
+    followee = _followee(username)
+    params = {'follower_id': follower_id, 'followee_id': followee.id}
+    if db.session.execute(DELETE_FOLLOW, params).rowcount == 0:
+        db.session.rollback()
+        raise NotFollowing(username)
+    if db.session.execute(REMOVE_FOLLOWER, {'user_id': followee.id}).scalar() == _fanout_limit():
+        db.session.execute(BACKFILL_FOLLOWERS, {
+            'author_id': followee.id,
+            'limit': current_app.config.get('TIMELINE_BACKFILL', 100),
+        })
+    db.session.execute(REMOVE_AUTHOR, {'user_id': follower_id, 'author_id': followee.id})
+    db.session.commit()
+    invalidate_user(followee.id)
+
+# Remove a deleted tweet from every timeline it was pushed to.
+def remove_tweet(tweet_id):
+    TimelineEntry.query.filter_by(tweet_id=tweet_id).delete()
+
+# Return the ids of one page of a user's home timeline, reading limit rows from
+# the precomputed timeline and at most limit rows of the followed celebrities.
+# Pages go newest first, starting below before. With after, they go oldest
+# first starting above after instead, which is how a live stream catches up.
+def timeline_ids(user_id, limit, before=None, after=None):
+    newest_first = after is None
+
+    def page(query, column):
+        if before is not None:
+            query = query.filter(column < before)
+        if after is not None:
+            query = query.filter(column > after)
+        order = column.desc() if newest_first else column.asc()
+        return [row[0] for row in query.order_by(order).limit(limit)]
+
+    ids = set(page(reader().query(TimelineEntry.tweet_id).filter(TimelineEntry.user_id == user_id), TimelineEntry.tweet_id))
+
+    celebrities = [row.followee_id for row in reader().query(Follow.followee_id)
+                   .join(User, User.id == Follow.followee_id)
+                   .filter(Follow.follower_id == user_id, User.follower_count > _fanout_limit())]
+    if celebrities:
+        ids.update(page(reader().query(Tweet.id).filter(Tweet.uid.in_(celebrities)), Tweet.id))
+
+    return sorted(ids, reverse=newest_first)[:limit]
+
+def followee_ids(user_id):
+    return [row.followee_id for row in reader().query(Follow.followee_id).filter(Follow.follower_id == user_id)]
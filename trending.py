@@ -0,0 +1,168 @@
+import atexit
+import heapq
+import math
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from models import Tweet
+from db import reader
+
+LN2 = math.log(2)
+EPOCH = datetime(1970, 1, 1)
+
+# Trending tweets, ranked by likes decayed with the age of the tweet: a tweet
+# posted age seconds ago with n likes scores (1 + n) / 2 ** (age / half_life).
+# In log space, and shifted by the same log(2) * now / half_life for every
+# tweet, that is
+#
+#   key = log(1 + n) + log(2) * posted / half_life
+#
+# which does not depend on the time. The order of the tweets only changes when
+# one is posted, liked, unliked or deleted, so nothing is rescored as time
+# passes and every change is one key update.
+#
+# Keys are kept in a dict and a max-heap. A change pushes the new key in
+# O(log n) and leaves the old entry in the heap, where it is skipped when read
+# and dropped once stale entries outnumber live ones. Reading the top k pops k
+# live entries and pushes them back, O(k log n), and the result is kept until
+# the next change.
+#
+# Only tweets of the last window seconds are indexed. A background thread
+# rebuilds the index from the tweet table every refresh_interval seconds,
+# which drops tweets that left the window and picks up what the index did not
+# see: tweets and likes written by other processes or loaded in bulk, and
+# changes that raced the previous rebuild.
+class TrendingTweets:
+    def __init__(self, app, half_life=21600, window=172800, refresh_interval=60):
+        self.app = app
+        self.half_life = half_life
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        # tweet_id -> (key, seconds since EPOCH the tweet was posted at).
+        self.tweets = {}
+        # (-key, tweet_id), live and stale.
+        self.heap = []
+        # limit -> [(tweet_id, key)] of the best limit tweets, until the next change.
+        self.top_cache = {}
+        self.loaded = False
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.closed = False
+
+    def key(self, like, posted):
+        return math.log1p(max(like or 0, 0)) + LN2 * posted / self.half_life
+
+    # The decayed score of a key at now: (1 + n) / 2 ** (age / half_life).
+    def score(self, key, now=None):
+        now = (now or datetime.utcnow()) - EPOCH
+        return math.exp(key - LN2 * now.total_seconds() / self.half_life)
+
+    def _set(self, tweet_id, like, posted):
+        key = self.key(like, posted)
+        self.tweets[tweet_id] = (key, posted)
+        heapq.heappush(self.heap, (-key, tweet_id))
+        self.top_cache.clear()
+        if len(self.heap) > 2 * len(self.tweets) + 64:
+            self.heap = [(-key, tweet_id) for tweet_id, (key, posted) in self.tweets.items()]
+            heapq.heapify(self.heap)
+
+    # A new tweet with like likes, posted at the datetime posted.
+    def posted(self, tweet_id, like, posted):
+        with self.lock:
+            self._set(tweet_id, like, (posted - EPOCH).total_seconds())
+
+    # The like count of a tweet changed. Tweets outside the window are ignored.
+    def liked(self, tweet_id, like):
+        with self.lock:
+            entry = self.tweets.get(tweet_id)
+            if entry is not None:
+                self._set(tweet_id, like, entry[1])
+
+    def deleted(self, tweet_id):
+        with self.lock:
+            if self.tweets.pop(tweet_id, None) is not None:
+                self.top_cache.clear()
+
+    # Return [(tweet_id, key)] of the limit best tweets, best first.
+    def top(self, limit):
+        if not self.loaded:
+            self.refresh()
+            self.start()
+        with self.lock:
+            cached = self.top_cache.get(limit)
+            if cached is not None:
+                return cached
+            best, seen = [], set()
+            while self.heap and len(best) < limit:
+                key, tweet_id = heapq.heappop(self.heap)
+                entry = self.tweets.get(tweet_id)
+                # Stale entries and duplicates of a key are dropped for good.
+                if entry is None or entry[0] != -key or tweet_id in seen:
+                    continue
+                seen.add(tweet_id)
+                best.append((tweet_id, -key))
+            for tweet_id, key in best:
+                heapq.heappush(self.heap, (-key, tweet_id))
+            self.top_cache[limit] = best
+            return best
+
+    # Rebuild the index from the tweets of the window. Needs an app context.
+    def refresh(self):
+        since = datetime.utcnow() - timedelta(seconds=self.window)
+        rows = reader().query(Tweet.id, Tweet.like, Tweet.created_at).filter(Tweet.created_at >= since).all()
+        tweets = {}
+        for row in rows:
+            posted = (row.created_at - EPOCH).total_seconds()
+            tweets[row.id] = (self.key(row.like, posted), posted)
+        heap = [(-key, tweet_id) for tweet_id, (key, posted) in tweets.items()]
+        heapq.heapify(heap)
+        with self.lock:
+            self.tweets, self.heap = tweets, heap
+            self.top_cache.clear()
+            self.loaded = True
+
+    # Start the background rebuilds, once the index is first read.
+    def start(self):
+        with self.lock:
+            if self.thread is not None or self.closed:
+                return
+            self.thread = threading.Thread(target=self._run, name='trending', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.refresh_interval)
+            if self.closed:
+                return
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                # The index keeps serving its current keys until the next try.
+                self.app.logger.exception('Failed to refresh trending tweets')
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+def init_trending(app):
+    app.extensions['trending'] = TrendingTweets(
+        app,
+        half_life=app.config['TRENDING_HALF_LIFE_HOURS'] * 3600,
+        window=app.config['TRENDING_WINDOW_HOURS'] * 3600,
+        refresh_interval=app.config['TRENDING_REFRESH_SECONDS'],
+    )
+
+# Tell the index about a change that has been committed, from a request.
+def tweet_posted(tweet_id, like, posted):
+    current_app.extensions['trending'].posted(tweet_id, like, posted)
+
+def tweet_liked(tweet_id, like):
+    current_app.extensions['trending'].liked(tweet_id, like)
+
+def tweet_deleted(tweet_id):
+    current_app.extensions['trending'].deleted(tweet_id)
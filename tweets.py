@@ -0,0 +1,83 @@
+from datetime import datetime
+from sqlalchemy import text
+from models import User, Tweet
+from pagination import paginate
+from streaming import encode_json
+from timeline import fan_out
+from versions import bump
+from db import reader, run_steps, db_time
+
+# Tweets are listed with their author's username, selected in one joined query
+# with only the columns we return, so a page costs one query whatever its size.
+def tweet_rows():
+    return reader().query(Tweet.id, Tweet.title, Tweet.content, Tweet.like, User.username) \
+        .join(User, Tweet.uid == User.id)
+
+def tweet_json(row):
+    return {'author': row.username, 'tweet_id': row.id, 'title': row.title, 'content': row.content, 'like': row.like}
+
+def tweets_json(rows):
+    return [tweet_json(row) for row in rows]
+
+# The newest tweets below the id before and not below floor, newest first,
+# read from the primary key with their authors joined.
+NEWEST_TWEETS = text(
+    'SELECT tweet.id, tweet.title, tweet.content, tweet."like", user.username '
+    'FROM tweet JOIN user ON tweet.uid = user.id '
+    'WHERE tweet.id < :before AND tweet.id >= :floor ORDER BY tweet.id DESC LIMIT :limit'
+)
+
+def newest_params(limit, before=None, floor=0):
+    # Without a cursor the page starts below the largest possible id.
+    return {'limit': limit, 'before': before if before is not None else 2 ** 63 - 1, 'floor': floor}
+
+# As steps (see db.run_steps), for the async handlers of asgi.py.
+def newest(limit, before=None, floor=0):
+    return (yield NEWEST_TWEETS, newest_params(limit, before, floor))
+
+def newest_tweets(limit, before=None, floor=0):
+    return run_steps(newest(limit, before, floor), reader())
+
+# The tweet listing is cached by version of the tweet table (see versions.py),
+# which is also its ETag.
+def listing_etag(version, ndjson):
+    return 'tweet-%d-%s' % (version, 'ndjson' if ndjson else 'json')
+
+# The encoded page of a listing and the cursor of the next page, from up to
+# limit + 1 tweets.
+def listing_page(tweets, limit, ndjson):
+    tweets, next_cursor = paginate(tweets, limit, lambda t: (t.id,))
+    return encode_json(tweets, tweet_json, ndjson), next_cursor
+
+# The tweets with the given ids, in the same order, without the ones that do
+# not exist.
+def tweets_by_id(ids):
+    if not ids:
+        return []
+    rows = {row.id: row for row in tweet_rows().filter(Tweet.id.in_(ids))}
+    return [rows[tweet_id] for tweet_id in ids if tweet_id in rows]
+
+INSERT_TWEET = text(
+    'INSERT INTO tweet (uid, title, content, "like", created_at) '
+    'VALUES (:uid, :title, :content, :like, :created_at) RETURNING id'
+)
+
+def tweet_params(author_id, title, content, like, created_at):
+    return {'uid': author_id, 'title': title, 'content': content, 'like': like, 'created_at': db_time(created_at)}
+
+# Insert a new tweet and return its id.
+def insert_tweet(author_id, title, content, like, created_at):
+    rows = yield INSERT_TWEET, tweet_params(author_id, title, content, like, created_at)
+    return rows[0].id
+
+# Add a new tweet and return its id and creation time. It is inserted in
+# db.session's transaction, for the caller to commit with the rest of it.
+def add_tweet(user, title, content, like):
+    created_at = datetime.utcnow()
+    return run_steps(insert_tweet(user.id, title, content, like, created_at)), created_at
+
+# Steps that list a new tweet, in its transaction: the timelines it goes to
+# and the version of the tweet listing.
+def list_tweet(author, tweet_id):
+    yield from fan_out(author, tweet_id)
+    yield from bump('tweet')
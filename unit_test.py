@@ -1,14 +1,39 @@
+import asyncio
+import gzip
 import pytest
 import json
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from urllib.parse import urlencode
 from app import create_app
-from db import db
-from werkzeug.security import check_password_hash
+from db import db, reader
+from models import User, Message, Tweet, TweetLike, TimelineEntry
+from likes import like_tweet, AlreadyLiked
+from like_buffer import LikeBuffer
+from pagination import encode_cursor
+from passwords import HashPool
+from ratelimit import TokenBuckets
+from trending import TrendingTweets
+from bulk import load
+from inbox import summarize_since
+from schema import create_schema
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import check_password_hash, generate_password_hash
 
 # Create a test app
 @pytest.fixture(scope='session')
 def app():
     app = create_app(test=True)
+    create_schema(app)
     yield app
 
     # Delete test database after unit tests.
@@ -19,6 +44,20 @@ def app():
 def client(app):
     return app.test_client()
 
+# Record the SQL statements executed against the test database inside a with block.
+@contextmanager
+def count_queries(app):
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
 ################################################################################
 class TestBase:
     def test_index(app, client):
@@ -353,6 +392,29 @@ class TestTweet:
 
         client.get('/logout')
 
+    def test_change_tweet_of_another_user(app, client):
+        login = {
+            'username': 'b',
+            'password': '2'
+        }
+        client.post('/login', data=login)
+
+        new_tweet = {
+            'tweet_id':'1',
+            'title':'not mine',
+            'content':'not mine'
+        }
+
+        response = client.put('/tweet', data=new_tweet)
+        assert response.status_code == 403
+        assert {'error': 'You can only change your own Tweets.'} == json.loads(response.get_data(as_text=True))
+
+        response2 = client.delete('/tweet', data={'tweet_id': '1'})
+        assert response2.status_code == 403
+        assert {'error': 'You can only change your own Tweets.'} == json.loads(response2.get_data(as_text=True))
+
+        client.get('/logout')
+
     def test_delete_tweet(app, client):
         login = {
             'username': 'a',
@@ -449,3 +511,1232 @@ class TestUnlike():
         }] == json.loads(response2.get_data(as_text=True))
 
         client.get('logout')
+
+################################################################################
+
+class TestTweetPagination():
+    def test_paginate_tweets(app, client):
+        login = {
+            'username': 'a',
+            'password': '1'
+        }
+        client.post('/login', data=login)
+
+        for i in range(3):
+            client.post('/tweet', data={'title': 'page title ' + str(i), 'content': 'page content'})
+
+        response = client.get('/tweet?limit=2')
+        assert response.status_code == 200
+        assert [4, 3] == [t['tweet_id'] for t in json.loads(response.get_data(as_text=True))]
+
+        response2 = client.get('/tweet?limit=2&cursor=' + response.headers['X-Next-Cursor'])
+        assert response2.status_code == 200
+        assert [2, 1] == [t['tweet_id'] for t in json.loads(response2.get_data(as_text=True))]
+        assert 'X-Next-Cursor' not in response2.headers
+
+        for tweet_id in ['2', '3', '4']:
+            client.delete('/tweet', data={'tweet_id': tweet_id})
+
+        client.get('/logout')
+
+    def test_invalid_cursor(app, client):
+        login = {
+            'username': 'a',
+            'password': '1'
+        }
+        client.post('/login', data=login)
+
+        response = client.get('/tweet?cursor=not-a-cursor')
+        assert response.status_code == 400
+        assert {'error': 'Invalid limit or cursor.'} == json.loads(response.get_data(as_text=True))
+
+        response2 = client.get('/tweet?limit=0')
+        assert response2.status_code == 400
+
+        # Keys past the 64-bit integers of SQLite are invalid too.
+        response3 = client.get('/tweet?cursor=' + encode_cursor(10 ** 23))
+        assert response3.status_code == 400
+        assert {'error': 'Invalid limit or cursor.'} == json.loads(response3.get_data(as_text=True))
+
+        client.get('/logout')
+
+################################################################################
+
+class TestTweetAuthors():
+    def test_author_is_tweet_owner(app, client):
+        login = {
+            'username': 'b',
+            'password': '2'
+        }
+        client.post('/login', data=login)
+        client.post('/tweet', data={'title': 'from b', 'content': 'hello from b'})
+        client.get('/logout')
+
+        login = {
+            'username': 'a',
+            'password': '1'
+        }
+        client.post('/login', data=login)
+
+        response = client.get('/tweet')
+        assert response.status_code == 200
+        assert [('b', 'from b'), ('a', 'this is title')] == [(t['author'], t['title']) for t in json.loads(response.get_data(as_text=True))]
+
+        client.get('/logout')
+
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.delete('/tweet', data={'tweet_id': '2'})
+        client.get('/logout')
+
+    def test_constant_query_count(self, app, client):
+        login = {
+            'username': 'a',
+            'password': '1'
+        }
+        client.post('/login', data=login)
+
+        with app.app_context():
+            users = User.query.order_by(User.id).all()
+            db.session.bulk_insert_mappings(Tweet, [
+                {'uid': users[i % len(users)].id, 'title': 'bulk', 'content': 'bulk', 'like': 0}
+                for i in range(1000)
+            ])
+            db.session.commit()
+
+        counts = []
+        for size in [1, 100, 1000]:
+            with count_queries(app) as statements:
+                response = client.get('/tweet?limit=' + str(size))
+            assert response.status_code == 200
+            assert size == len(json.loads(response.get_data(as_text=True)))
+            assert 1 == len([s for s in statements if 'FROM tweet' in s])
+            counts.append(len(statements))
+        assert counts[0] == counts[1] == counts[2]
+
+        with app.app_context():
+            Tweet.query.filter_by(title='bulk').delete()
+            db.session.commit()
+
+        client.get('/logout')
+
+################################################################################
+
+class TestLikeOnce():
+    def test_duplicate_like(app, client):
+        login = {
+            'username': 'b',
+            'password': '2'
+        }
+        client.post('/login', data=login)
+
+        response = client.post('/like', data={'tweet_id': '1'})
+        assert response.status_code == 200
+        assert {'success': 'Liked the Tweet! Like count is now 1!'} == json.loads(response.get_data(as_text=True))
+
+        response2 = client.post('/like', data={'tweet_id': '1'})
+        assert response2.status_code == 409
+        assert {'error': 'You have already liked this Tweet!'} == json.loads(response2.get_data(as_text=True))
+
+        response3 = client.post('/unlike', data={'tweet_id': '1'})
+        assert response3.status_code == 200
+        assert {'success': 'Unliked the Tweet! Like count is now 0!'} == json.loads(response3.get_data(as_text=True))
+
+        response4 = client.post('/unlike', data={'tweet_id': '1'})
+        assert response4.status_code == 409
+        assert {'error': 'You have not liked this Tweet!'} == json.loads(response4.get_data(as_text=True))
+
+        response5 = client.post('/like', data={'tweet_id': '100'})
+        assert response5.status_code == 404
+        assert {'error': 'Tweet Not Found'} == json.loads(response5.get_data(as_text=True))
+
+        # An id too large for SQLite matches no tweet either.
+        response6 = client.post('/like', data={'tweet_id': '99999999999999999999999'})
+        assert response6.status_code == 404
+        assert {'error': 'Tweet Not Found'} == json.loads(response6.get_data(as_text=True))
+
+        client.get('/logout')
+
+    def test_like_requires_login(app, client):
+        response = client.post('/like', data={'tweet_id': '1'})
+        assert response.status_code == 302
+
+    def test_concurrent_likes(self, app, client):
+        def like(user_id):
+            with app.app_context():
+                like_tweet(user_id, 1)
+
+        threads = [threading.Thread(target=like, args=(1000 + i,)) for i in range(100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with app.app_context():
+            assert 100 == Tweet.query.get(1).like
+            assert 100 == TweetLike.query.filter_by(tweet_id=1).count()
+            TweetLike.query.filter_by(tweet_id=1).delete()
+            Tweet.query.get(1).like = 0
+            db.session.commit()
+
+################################################################################
+
+class TestLikeBuffer():
+    def test_buffered_likes(self, app, client):
+        with app.app_context():
+            buffer = LikeBuffer(app, flush_interval_ms=60000)
+            for user_id in range(2000, 2010):
+                assert user_id - 1999 == buffer.like(user_id, 1)
+            with pytest.raises(AlreadyLiked):
+                buffer.like(2000, 1)
+
+            # A like that is taken back before the flush is never written.
+            # The buffer leaves the changes of the caller's session alone.
+            tweet = Tweet.query.get(1)
+            tweet.title = 'not committed'
+            assert 11 == buffer.like(3000, 1)
+            assert 10 == buffer.unlike(3000, 1)
+            assert ('not committed', 0) == (tweet.title, tweet.like)
+            db.session.rollback()
+
+            assert 10 == buffer.flush()
+            assert 10 == Tweet.query.get(1).like
+            assert 10 == TweetLike.query.filter_by(tweet_id=1).count()
+            db.session.rollback()
+
+            for user_id in range(2000, 2010):
+                buffer.unlike(user_id, 1)
+            buffer.close()
+            assert 0 == Tweet.query.get(1).like
+            assert 0 == TweetLike.query.filter_by(tweet_id=1).count()
+
+################################################################################
+
+class TestTimeline():
+    def test_follow(app, client):
+        login = {
+            'username': 'a',
+            'password': '1'
+        }
+        client.post('/login', data=login)
+
+        response = client.post('/follow', data={'username': 'b'})
+        assert response.status_code == 200
+        assert {'success': 'You are now following b!'} == json.loads(response.get_data(as_text=True))
+
+        response2 = client.post('/follow', data={'username': 'b'})
+        assert response2.status_code == 409
+
+        response3 = client.post('/follow', data={'username': 'a'})
+        assert response3.status_code == 400
+
+        response4 = client.post('/follow', data={'username': 'c'})
+        assert response4.status_code == 404
+
+        client.get('/logout')
+
+    def test_fan_out_on_write(self, app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/tweet', data={'title': 'pushed', 'content': 'from b'})
+        client.get('/logout')
+
+        with app.app_context():
+            assert 1 == TimelineEntry.query.join(Tweet, Tweet.id == TimelineEntry.tweet_id) \
+                .filter(TimelineEntry.user_id == 2, Tweet.title == 'pushed').count()
+
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        response = client.get('/timeline')
+        assert response.status_code == 200
+        assert [('b', 'pushed'), ('a', 'this is title')] == [(t['author'], t['title']) for t in json.loads(response.get_data(as_text=True))]
+        client.get('/logout')
+
+    def test_fan_out_on_read(self, app, client):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/tweet', data={'title': 'pulled', 'content': 'from b'})
+        client.get('/logout')
+
+        with app.app_context():
+            assert 0 == TimelineEntry.query.join(Tweet, Tweet.id == TimelineEntry.tweet_id) \
+                .filter(TimelineEntry.user_id == 2, Tweet.title == 'pulled').count()
+
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        response = client.get('/timeline?limit=2')
+        assert [('b', 'pulled'), ('b', 'pushed')] == [(t['author'], t['title']) for t in json.loads(response.get_data(as_text=True))]
+
+        response2 = client.get('/timeline?limit=2&cursor=' + response.headers['X-Next-Cursor'])
+        assert [('a', 'this is title')] == [(t['author'], t['title']) for t in json.loads(response2.get_data(as_text=True))]
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+        response3 = client.post('/unfollow', data={'username': 'b'})
+        assert response3.status_code == 200
+        assert {'success': 'You are no longer following b!'} == json.loads(response3.get_data(as_text=True))
+
+        response4 = client.get('/timeline')
+        assert [('a', 'this is title')] == [(t['author'], t['title']) for t in json.loads(response4.get_data(as_text=True))]
+
+        response5 = client.post('/unfollow', data={'username': 'b'})
+        assert response5.status_code == 409
+        client.get('/logout')
+
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        for tweet_id in ['2', '3']:
+            client.delete('/tweet', data={'tweet_id': tweet_id})
+        client.get('/logout')
+
+    def test_celebrity_back_under_the_limit(self, app, client):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        for username, password in [('a', '1'), ('testuser', 'testpassword')]:
+            client.post('/login', data={'username': username, 'password': password})
+            client.post('/follow', data={'username': 'b'})
+            client.get('/logout')
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/tweet', data={'title': 'famous', 'content': 'pulled by followers'})
+        client.get('/logout')
+
+        with app.app_context():
+            tweet_id = Tweet.query.filter_by(title='famous').one().id
+            assert 0 == TimelineEntry.query.filter_by(user_id=2, tweet_id=tweet_id).count()
+
+        # b is back to one follower, so the tweet is pushed to a's timeline.
+        client.post('/login', data={'username': 'testuser', 'password': 'testpassword'})
+        client.post('/unfollow', data={'username': 'b'})
+        client.get('/logout')
+        with app.app_context():
+            assert 1 == TimelineEntry.query.filter_by(user_id=2, tweet_id=tweet_id).count()
+            assert 0 == TimelineEntry.query.filter_by(user_id=1, tweet_id=tweet_id).count()
+
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        response = client.get('/timeline?limit=1')
+        assert [('b', 'famous')] == [(t['author'], t['title']) for t in json.loads(response.get_data(as_text=True))]
+        client.post('/unfollow', data={'username': 'b'})
+        client.get('/logout')
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.delete('/tweet', data={'tweet_id': tweet_id})
+        client.get('/logout')
+
+################################################################################
+
+class TestConversation():
+    def test_conversation(app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/chat', data={'_to': 'a', 'content': 'hello, a'})
+        client.get('/logout')
+
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        client.post('/chat', data={'_to': 'b', 'content': 'how are you, b'})
+
+        response = client.get('/conversation/b?limit=2')
+        assert response.status_code == 200
+        messages = json.loads(response.get_data(as_text=True))
+        assert [('a', 'how are you, b'), ('b', 'hello, a')] == [(m['_from'], m['message']) for m in messages]
+
+        response2 = client.get('/conversation/b?limit=2&cursor=' + response.headers['X-Next-Cursor'])
+        assert [('a', 'hello, b')] == [(m['_from'], m['message']) for m in json.loads(response2.get_data(as_text=True))]
+        assert 'X-Next-Cursor' not in response2.headers
+
+        response3 = client.get('/conversation/c')
+        assert response3.status_code == 404
+
+        response4 = client.get('/history/sent')
+        assert [{'_to': 'b', 'message': 'hello, b'}, {'_to': 'b', 'message': 'how are you, b'}] == json.loads(response4.get_data(as_text=True))
+
+        client.get('/logout')
+
+################################################################################
+
+class TestInbox():
+    def login(self, client, username):
+        client.get('/logout')
+        client.post('/login', data={'username': username, 'password': 'inbox'})
+
+    def inbox(self, client):
+        return json.loads(client.get('/inbox').get_data(as_text=True))
+
+    def test_unread_counts(self, app, client):
+        for username in ('inbox_x', 'inbox_y'):
+            client.post('/register', data={'username': username, 'password': 'inbox', 'password2': 'inbox'})
+        self.login(client, 'inbox_x')
+        for i in range(3):
+            client.post('/chat', data={'_to': 'inbox_y', 'content': 'unread %d' % i})
+
+        self.login(client, 'inbox_y')
+        inbox = self.inbox(client)
+        assert 3 == inbox['unread_messages']
+        assert 1 == inbox['unread_conversations']
+        assert [('inbox_x', 3, 'unread 2')] == [(c['username'], c['unread'], c['last_message']['message'])
+                                                for c in inbox['conversations']]
+
+        with app.app_context():
+            first = Message.query.filter_by(_to='inbox_y').order_by(Message.id).first().id
+        response = client.post('/inbox/read', data={'username': 'inbox_x', 'message_id': first})
+        assert {'success': 'Marked as read!', 'unread': 2} == json.loads(response.get_data(as_text=True))
+        assert (2, 1) == (self.inbox(client)['unread_messages'], self.inbox(client)['unread_conversations'])
+
+        # The sender sees the read receipt.
+        self.login(client, 'inbox_x')
+        conversation = self.inbox(client)['conversations'][0]
+        assert (first, 0) == (conversation['read_by_peer'], conversation['unread'])
+
+        self.login(client, 'inbox_y')
+        client.post('/inbox/read', data={'username': 'inbox_x'})
+        client.post('/chat', data={'_to': 'inbox_x', 'content': 'reply'})
+        inbox = self.inbox(client)
+        assert (0, 0) == (inbox['unread_messages'], inbox['unread_conversations'])
+        assert 'reply' == inbox['conversations'][0]['last_message']['message']
+
+        self.login(client, 'inbox_x')
+        inbox = self.inbox(client)
+        assert (1, 1) == (inbox['unread_messages'], inbox['unread_conversations'])
+        assert 404 == client.post('/inbox/read', data={'username': 'nobody'}).status_code
+        assert 400 == client.post('/inbox/read', data={'username': 'inbox_y', 'message_id': 'x'}).status_code
+        client.get('/logout')
+
+    def test_bulk_messages_are_summarized(self, app, client):
+        lines = [json.dumps({'from': 'inbox_y', 'to': 'inbox_x', 'content': 'bulk %d' % i}) for i in range(5)]
+        with app.app_context():
+            assert 5 == load('messages', lines, batch_size=2)['inserted']
+
+        self.login(client, 'inbox_x')
+        inbox = self.inbox(client)
+        assert (6, 1) == (inbox['unread_messages'], inbox['unread_conversations'])
+        assert ('inbox_y', 6, 'bulk 4') == (inbox['conversations'][0]['username'], inbox['conversations'][0]['unread'],
+                                            inbox['conversations'][0]['last_message']['message'])
+        client.get('/logout')
+
+################################################################################
+
+class TestStream():
+    def test_resume_stream(app, client):
+        client.post('/login', data={'username': 'a', 'password': '1'})
+
+        # Resuming from the very beginning replays the received message and the
+        # timeline of a.
+        response = client.get('/stream', headers={'Last-Event-ID': encode_cursor(0, 0, 0)})
+        assert response.status_code == 200
+        assert 'text/event-stream' == response.mimetype
+        chunks = iter(response.response)
+        assert 'retry: 3000\n\n' == next(chunks).decode()
+        message = next(chunks).decode()
+        assert 'event: message' in message and 'hello, a' in message
+        tweet = next(chunks).decode()
+        assert 'event: tweet' in tweet and 'this is title' in tweet
+        response.close()
+
+        response2 = client.get('/stream', headers={'Last-Event-ID': 'bad'})
+        assert response2.status_code == 400
+
+        client.get('/logout')
+
+    def test_live_stream(self, app, client):
+        app.config['STREAM_HEARTBEAT_SECONDS'] = 0.01
+        client.post('/login', data={'username': 'a', 'password': '1'})
+
+        response = client.get('/stream')
+        chunks = iter(response.response)
+        next(chunks)
+        assert ': keepalive\n\n' == next(chunks).decode()
+
+        client.post('/chat', data={'_to': 'a', 'content': 'note to self'})
+        message = next(chunks).decode()
+        assert 'event: message' in message and 'note to self' in message
+
+        client.post('/tweet', data={'title': 'live', 'content': 'live tweet'})
+        tweet = next(chunks).decode()
+        assert 'event: tweet' in tweet and 'live tweet' in tweet
+
+        response.close()
+        assert 0 == app.extensions['broker'].count()
+        app.config['STREAM_HEARTBEAT_SECONDS'] = 15
+
+        client.delete('/tweet', data={'tweet_id': '2'})
+        client.get('/logout')
+
+################################################################################
+
+class TestUserCache():
+    def test_cached_user_loader(self, app, client):
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        client.get('/tweet')
+
+        cache = app.extensions['user_cache']
+        hits = cache.stats()['hits']
+        with count_queries(app) as statements:
+            response = client.get('/tweet')
+        assert response.status_code == 200
+        assert 1 == len(statements)
+        assert hits + 1 == cache.stats()['hits']
+
+        client.get('/logout')
+
+    def test_invalidate_on_change(self, app, client):
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        client.get('/tweet')
+        cache = app.extensions['user_cache']
+        assert cache.get(2) is not None
+
+        # Following b changes b's follower count with plain SQL.
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.get('/tweet')
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        assert cache.get(3) is not None
+        client.post('/follow', data={'username': 'b'})
+        assert cache.get(3) is None
+        client.post('/unfollow', data={'username': 'b'})
+
+        with app.app_context():
+            user = User.query.get(2)
+            user.follower_count = 1
+            db.session.commit()
+            assert cache.get(2) is None
+            user.follower_count = 0
+            db.session.commit()
+
+        client.get('/logout')
+
+################################################################################
+
+class TestPasswordHashing():
+    def test_rehash_on_login(self, app, client):
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        response = client.post('/login', data={'username': 'a', 'password': '1'})
+        assert response.status_code == 302
+        with app.app_context():
+            assert User.query.get(2).password_hash.startswith('pbkdf2:sha256:1000$')
+        client.get('/logout')
+
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:260000'
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        with app.app_context():
+            assert User.query.get(2).password_hash.startswith('pbkdf2:sha256:260000$')
+        client.get('/logout')
+
+    def test_saturated_pool(self, app, client):
+        pool = app.extensions['hash_pool']
+        app.extensions['hash_pool'] = saturated = HashPool(workers=1, max_pending=1)
+        # The only slot is taken by a hash that is still running.
+        busy = saturated.submit(time.sleep, 1)
+        # Callbacks run in order, so this one runs after the slot is released.
+        released = threading.Event()
+        busy.add_done_callback(lambda future: released.set())
+        response = client.post('/login', data={'username': 'a', 'password': '1'})
+        assert response.status_code == 503
+        assert '1' == response.headers['Retry-After']
+        assert {'error': 'Server is busy, try again later.'} == json.loads(response.get_data(as_text=True))
+
+        # Once it is done, the slot is free again.
+        assert released.wait(30)
+        assert 302 == client.post('/login', data={'username': 'a', 'password': '1'}).status_code
+        client.get('/logout')
+        saturated.executor.shutdown()
+        app.extensions['hash_pool'] = pool
+
+    def test_unbounded_pool(self):
+        pool = HashPool(workers=1, max_pending=0)
+        futures = [pool.submit(abs, -i) for i in range(3)]
+        assert [0, 1, 2] == [future.result() for future in futures]
+        pool.executor.shutdown()
+
+################################################################################
+
+class TestProductionProfile():
+    def test_pragmas_and_read_pool(self, tmp_path):
+        production = create_app(test=True, config={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'production.db'),
+            'DATABASE_PROFILE': 'production',
+        })
+        with production.app_context():
+            db.create_all()
+            assert 'wal' == db.session.execute('PRAGMA journal_mode').scalar()
+            assert 1 == db.session.execute('PRAGMA synchronous').scalar()
+            assert 5000 == db.session.execute('PRAGMA busy_timeout').scalar()
+
+            assert reader() is not db.session
+            assert [] == reader().query(Tweet).all()
+            with pytest.raises(OperationalError):
+                reader().execute("INSERT INTO user (username, follower_count) VALUES ('x', 0)")
+
+################################################################################
+
+class TestSearch():
+    def test_search_tweets(app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/tweet', data={'title': 'searching', 'content': 'full text search in sqlite'})
+        client.post('/tweet', data={'title': 'another', 'content': 'searching for sqlite tips'})
+
+        response = client.get('/search?q=searching')
+        assert response.status_code == 200
+        tweets = json.loads(response.get_data(as_text=True))
+        # The match in the title ranks first.
+        assert ['searching', 'another'] == [t['title'] for t in tweets]
+        assert '<mark>searching</mark>' in tweets[1]['snippet']
+
+        response2 = client.get('/search?q=sql*&limit=1')
+        assert 1 == len(json.loads(response2.get_data(as_text=True)))
+        response3 = client.get('/search?q=sql*&limit=1&cursor=' + response2.headers['X-Next-Cursor'])
+        assert 1 == len(json.loads(response3.get_data(as_text=True)))
+        assert 'X-Next-Cursor' not in response3.headers
+
+        # Updated and deleted tweets are kept in sync with the index.
+        client.put('/tweet', data={'tweet_id': '2', 'title': 'renamed', 'content': 'nothing here'})
+        client.delete('/tweet', data={'tweet_id': '3'})
+        assert [] == json.loads(client.get('/search?q=sqlite').get_data(as_text=True))
+        client.delete('/tweet', data={'tweet_id': '2'})
+
+        response4 = client.get('/search?q=')
+        assert response4.status_code == 400
+
+        client.get('/logout')
+
+    def test_search_messages(app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        response = client.get('/search?type=messages&q=hello')
+        assert ['hello, a', 'hello, b'] == sorted(m['message'] for m in json.loads(response.get_data(as_text=True)))
+        client.get('/logout')
+
+        client.post('/login', data={'username': 'testuser', 'password': 'testpassword'})
+        response2 = client.get('/search?type=messages&q=hello')
+        assert [] == json.loads(response2.get_data(as_text=True))
+        client.get('/logout')
+
+################################################################################
+
+class TestStreamingJSON():
+    def test_ndjson_history(app, client):
+        client.post('/login', data={'username': 'a', 'password': '1'})
+
+        response = client.get('/history/sent?format=ndjson')
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert 'application/x-ndjson' == response.mimetype
+        lines = response.get_data(as_text=True).splitlines()
+        assert {'_to': 'b', 'message': 'hello, b'} == json.loads(lines[0])
+
+        response2 = client.get('/tweet', headers={'Accept': 'application/x-ndjson'})
+        assert 'this is title' == json.loads(response2.get_data(as_text=True).splitlines()[0])['title']
+
+        client.get('/logout')
+
+    def test_constant_memory_export(self, app, client):
+        with app.app_context():
+            db.session.execute(Message.__table__.insert(), [
+                {'sender_id': 3, 'recipient_id': 2, '_from': 'b', '_to': 'a', 'content': 'x' * 100,
+                 'created_at': datetime(2000, 1, 1)}
+                for i in range(20000)
+            ])
+            db.session.commit()
+
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        tracemalloc.start()
+        response = client.get('/history/received')
+        count = 0
+        for chunk in response.response:
+            count += chunk.count(b'"_from"')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        response.close()
+        assert 20000 <= count
+        # Building the whole list of 20000 dicts and its JSON would take several MB.
+        assert peak < 2 * 1024 * 1024
+
+        with app.app_context():
+            Message.query.filter_by(created_at=datetime(2000, 1, 1)).delete()
+            db.session.commit()
+        client.get('/logout')
+
+################################################################################
+
+class TestConditionalGet():
+    def test_not_modified(self, app, client):
+        client.post('/login', data={'username': 'a', 'password': '1'})
+
+        response = client.get('/tweet')
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        with count_queries(app) as statements:
+            response2 = client.get('/tweet', headers={'If-None-Match': etag})
+        assert response2.status_code == 304
+        assert etag == response2.headers['ETag']
+        assert 0 == len([s for s in statements if 'FROM tweet' in s])
+
+        # The cached page is served without reading the tweet table.
+        with count_queries(app) as statements:
+            response3 = client.get('/tweet')
+        assert response.get_data() == response3.get_data()
+        assert 0 == len([s for s in statements if 'FROM tweet' in s])
+
+        client.post('/like', data={'tweet_id': '1'})
+        response4 = client.get('/tweet', headers={'If-None-Match': etag})
+        assert response4.status_code == 200
+        assert etag != response4.headers['ETag']
+        assert 1 == json.loads(response4.get_data(as_text=True))[0]['like']
+
+        client.post('/unlike', data={'tweet_id': '1'})
+        client.get('/logout')
+
+################################################################################
+
+class TestBatch():
+    def test_batch_operations(self, app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/tweet', data={'title': 'batch other', 'content': 'not yours'})
+        client.get('/logout')
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        for i in range(2):
+            client.post('/tweet', data={'title': 'batch %d' % i, 'content': 'batched'})
+        with app.app_context():
+            other, first, second = [t.id for t in Tweet.query.filter(Tweet.title.like('batch %')).order_by(Tweet.id)]
+
+        operations = [
+            {'op': 'like', 'tweet_id': first},
+            {'op': 'like', 'tweet_id': first},
+            {'op': 'unlike', 'tweet_id': second},
+            {'op': 'update', 'tweet_id': first, 'title': 'batch updated', 'content': 'batched'},
+            {'op': 'update', 'tweet_id': other, 'title': 'mine now', 'content': 'batched'},
+            {'op': 'delete', 'tweet_id': second},
+            {'op': 'like', 'tweet_id': second},
+            {'op': 'like', 'tweet_id': other},
+            {'op': 'retweet', 'tweet_id': first},
+            {'op': 'like'},
+            {'op': 'like', 'tweet_id': 10 ** 23},
+        ]
+        with count_queries(app) as statements:
+            response = client.post('/batch', json=operations)
+        assert response.status_code == 200
+        results = json.loads(response.get_data(as_text=True))['results']
+        assert [200, 409, 409, 200, 403, 200, 404, 200, 400, 400, 404] == [r['status'] for r in results]
+        assert 'Liked the Tweet! Like count is now 1!' == results[0]['success']
+        assert {'error': 'You can only change your own Tweets.', 'status': 403} == results[4]
+        # The tweets are read once for the whole batch.
+        assert 1 == len([s for s in statements if s.startswith('SELECT tweet.id AS tweet_id, tweet.uid')])
+
+        with app.app_context():
+            assert ('batch updated', 1) == (Tweet.query.get(first).title, Tweet.query.get(first).like)
+            assert Tweet.query.get(second) is None
+            assert 'batch other' == Tweet.query.get(other).title
+            assert 1 == Tweet.query.get(other).like
+
+        assert 413 == client.post('/batch', json=[{'op': 'like', 'tweet_id': first}] * 101).status_code
+        assert 400 == client.post('/batch', json={'op': 'like', 'tweet_id': first}).status_code
+        client.post('/batch', json=[{'op': 'unlike', 'tweet_id': other}, {'op': 'delete', 'tweet_id': first}])
+        client.get('/logout')
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/batch', json=[{'op': 'delete', 'tweet_id': other}])
+        client.get('/logout')
+        with app.app_context():
+            assert 0 == Tweet.query.filter(Tweet.title.like('batch %')).count()
+
+################################################################################
+
+class TestBulkLoad():
+    def test_bulk_tweets(self, app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        lines = [json.dumps({'title': 'bulk %d' % i, 'content': 'bulk loaded tweet'}) for i in range(10)]
+        lines.insert(3, 'not json')
+        lines.append(json.dumps({'title': '', 'content': 'no title'}))
+        # A count without the likes behind it would not match the tweet_like rows.
+        lines.append(json.dumps({'title': 'bulk liked', 'content': 'liked', 'like': 3}))
+        lines.append(json.dumps({'title': 'bulk liked', 'content': 'liked', 'like': True}))
+        response = client.post('/bulk/tweets', data='\n'.join(lines), content_type='application/x-ndjson')
+        assert response.status_code == 200
+        report = json.loads(response.get_data(as_text=True))
+        assert 10 == report['inserted']
+        assert [
+            {'line': 4, 'error': 'invalid JSON object'},
+            {'line': 12, 'error': 'title is required'},
+            {'line': 13, 'error': 'like must be 0, likes cannot be loaded'},
+            {'line': 14, 'error': 'like must be 0, likes cannot be loaded'},
+        ] == report['errors']
+
+        response2 = client.get('/search?q=bulk&limit=100')
+        assert 10 == len(json.loads(response2.get_data(as_text=True)))
+        response3 = client.get('/timeline?limit=100')
+        assert 10 == len([t for t in json.loads(response3.get_data(as_text=True)) if t['title'].startswith('bulk')])
+        client.get('/logout')
+
+        with app.app_context():
+            Tweet.query.filter(Tweet.title.like('bulk %')).delete(synchronize_session=False)
+            TimelineEntry.query.filter(TimelineEntry.tweet_id > 1).delete()
+            db.session.commit()
+
+    def test_created_at_offsets(self, app):
+        lines = [json.dumps({'author': 'b', 'title': 'bulk %d' % i, 'content': 'dated', 'created_at': created_at})
+                 for i, created_at in enumerate(['2020-01-01T12:00:00+02:00', '2020-01-01T12:00:00Z', '2020-01-01T12:00:00'])]
+        with app.app_context():
+            assert 3 == load('tweets', lines)['inserted']
+            tweets = Tweet.query.filter(Tweet.title.like('bulk %')).order_by(Tweet.id).all()
+            assert [datetime(2020, 1, 1, 10), datetime(2020, 1, 1, 12), datetime(2020, 1, 1, 12)] == \
+                [tweet.created_at for tweet in tweets]
+            TimelineEntry.query.filter(TimelineEntry.tweet_id.in_([tweet.id for tweet in tweets])).delete(synchronize_session=False)
+            Tweet.query.filter(Tweet.title.like('bulk %')).delete(synchronize_session=False)
+            db.session.commit()
+
+    def test_load_command(self, app, tmp_path):
+        path = tmp_path / 'messages.ndjson'
+        path.write_text('\n'.join(json.dumps({'from': 'b', 'to': 'a', 'content': 'loaded message %d' % i}) for i in range(50)))
+
+        result = app.test_cli_runner().invoke(args=['load', 'messages', str(path), '--batch-size', '20'])
+        assert 0 == result.exit_code
+        assert 50 == json.loads(result.output.splitlines()[-1])['inserted']
+
+        with app.app_context():
+            assert 50 == db.session.execute("SELECT count(*) FROM message_fts WHERE message_fts MATCH 'loaded'").scalar()
+            assert 'ix_message_recipient_id_created_at' in [row[1] for row in db.session.execute("PRAGMA index_list('message')")]
+            Message.query.filter(Message.content.like('loaded message%')).delete(synchronize_session=False)
+            db.session.commit()
+
+################################################################################
+
+class TestTrending():
+    def test_decayed_order(self, app):
+        trending = TrendingTweets(app, half_life=3600)
+        trending.loaded = True
+        now = datetime.utcnow()
+        trending.posted(1, 0, now - timedelta(hours=2))
+        trending.posted(2, 0, now)
+        trending.posted(3, 7, now - timedelta(hours=2))
+        assert [3, 2, 1] == [tweet_id for tweet_id, key in trending.top(10)]
+
+        # Four likes now beat eight likes two half-lives ago.
+        trending.liked(2, 3)
+        top = trending.top(10)
+        assert [2, 3, 1] == [tweet_id for tweet_id, key in top]
+        assert abs(4 - trending.score(top[0][1], now)) < 1e-6
+        assert abs(0.25 - trending.score(top[2][1], now)) < 1e-6
+
+        # Likes of tweets outside the window are ignored.
+        trending.liked(99, 5)
+        trending.deleted(3)
+        assert [2, 1] == [tweet_id for tweet_id, key in trending.top(10)]
+        assert [2] == [tweet_id for tweet_id, key in trending.top(1)]
+
+    def test_trending_endpoint(self, app, client):
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.post('/tweet', data={'title': 'trending', 'content': 'liked by everyone'})
+        with app.app_context():
+            tweet_id = Tweet.query.filter_by(title='trending').first().id
+        client.post('/like', data={'tweet_id': tweet_id})
+        client.get('/logout')
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        client.post('/like', data={'tweet_id': tweet_id})
+
+        response = client.get('/trending?limit=100')
+        assert response.status_code == 200
+        tweets = json.loads(response.get_data(as_text=True))
+        assert [tweet_id] == [t['tweet_id'] for t in tweets if t['title'] == 'trending']
+        assert 2 == [t['like'] for t in tweets if t['tweet_id'] == tweet_id][0]
+        assert sorted(tweets, key=lambda t: -t['score']) == tweets
+
+        # A rebuild from the database ranks the same way.
+        trending = app.extensions['trending']
+        before = trending.top(100)
+        with app.app_context():
+            trending.refresh()
+        assert before == trending.top(100)
+
+        # Deleted by its author.
+        client.get('/logout')
+        client.post('/login', data={'username': 'b', 'password': '2'})
+        client.delete('/tweet', data={'tweet_id': tweet_id})
+        tweets = json.loads(client.get('/trending').get_data(as_text=True))
+        assert tweet_id not in [t['tweet_id'] for t in tweets]
+        assert 400 == client.get('/trending?limit=0').status_code
+        client.get('/logout')
+
+################################################################################
+
+class TestArchive():
+    def test_archive_and_read_through(self, tmp_path):
+        config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'hot.db'),
+            'ARCHIVE_DATABASE': str(tmp_path / 'archive.db'),
+            'ARCHIVE_SEGMENT_SIZE': 4,
+            'PASSWORD_HASH_WORKERS': 0,
+        }
+        app = create_app(test=True, config=config)
+        create_schema(app)
+        now = datetime.utcnow()
+        with app.app_context():
+            x, y, z = [User(username, password='pw') for username in ('x', 'y', 'z')]
+            db.session.add_all([x, y, z])
+            db.session.commit()
+            # x and y talk every day for 20 days, z last wrote to x 60 days ago.
+        # Archiving after 10 days moves days 10 to 20, and day 10 just made it.
+            for day in range(20, 0, -1):
+                for sender, recipient in ((x, y), (y, x)):
+                    message = Message(sender, recipient, 'day %d from %s' % (day, sender.username))
+                    message.created_at = now - timedelta(days=day)
+                    db.session.add(message)
+            old = Message(z, x, 'long ago')
+            old.created_at = now - timedelta(days=60)
+            db.session.add(old)
+            for day in range(20, 0, -1):
+                tweet = Tweet(x, 'day %d' % day, 'tweeted', day)
+                tweet.created_at = now - timedelta(days=day)
+                db.session.add(tweet)
+            db.session.flush()
+            summarize_since(db.session.connection(), 0)
+            db.session.commit()
+            archive = app.extensions['archive']
+            assert {'message': None, 'tweet': 0} == archive.watermarks()
+
+        # The job runs in a process of its own, here an app of its own.
+        job = create_app(test=True, config=config)
+        result = job.test_cli_runner().invoke(args=['archive', '--days', '10'])
+        assert 0 == result.exit_code, result.output
+        assert {'messages': 23, 'tweets': 11, 'segments': 10} == json.loads(result.output)
+        with app.app_context():
+            assert (18, 9) == (Message.query.count(), Tweet.query.count())
+        # Nothing is left to move the second time.
+        result = app.test_cli_runner().invoke(args=['archive', '--days', '10'])
+        assert {'messages': 0, 'tweets': 0, 'segments': 0} == json.loads(result.output)
+
+        # The app sees the job's version bump and reads the new watermarks once.
+        statements = []
+        event.listen(archive.engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+        with app.app_context():
+            assert 12 == archive.watermarks()['tweet'] == archive.watermarks()['tweet']
+        assert 1 == len(statements)
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'x', 'password': 'pw'})
+        sent = json.loads(client.get('/history/sent').get_data(as_text=True))
+        assert ['day %d from x' % day for day in range(20, 0, -1)] == [m['message'] for m in sent]
+        received = json.loads(client.get('/history/received').get_data(as_text=True))
+        assert ['long ago'] + ['day %d from y' % day for day in range(20, 0, -1)] == [m['message'] for m in received]
+
+        # Conversation and tweet pages cross from the hot rows into the archive.
+        messages, cursor = [], ''
+        while cursor is not None:
+            response = client.get('/conversation/y?limit=7&cursor=' + cursor)
+            messages += json.loads(response.get_data(as_text=True))
+            cursor = response.headers.get('X-Next-Cursor')
+        assert 40 == len(messages) == len({m['message_id'] for m in messages})
+        assert 'day 1 from y' == messages[0]['message'] and 'day 20 from x' == messages[-1]['message']
+
+        tweets, cursor = [], ''
+        while cursor is not None:
+            response = client.get('/tweet?limit=6&cursor=' + cursor)
+            tweets += json.loads(response.get_data(as_text=True))
+            cursor = response.headers.get('X-Next-Cursor')
+        assert ['day %d' % day for day in range(1, 21)] == [t['title'] for t in tweets]
+        assert ('x', 20) == (tweets[-1]['author'], tweets[-1]['like'])
+
+        inbox = json.loads(client.get('/inbox').get_data(as_text=True))
+        assert [('y', 'day 1 from y'), ('z', 'long ago')] == \
+            [(c['username'], c['last_message']['message']) for c in inbox['conversations']]
+
+################################################################################
+
+class TestPages():
+    def test_forms_are_served_from_memory(self, app, client):
+        client = app.test_client()
+        register = app.jinja_env.get_template('register.html').render().encode()
+
+        response = client.get('/register', headers={'Accept-Encoding': 'identity'})
+        assert (200, register) == (response.status_code, response.get_data())
+        assert response.headers['Cache-Control'] == 'no-cache'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        etag = response.headers['ETag']
+
+        # The compressed variant has its own strong ETag.
+        response = client.get('/register', headers={'Accept-Encoding': 'gzip, deflate'})
+        assert 'gzip' == response.headers['Content-Encoding']
+        assert register == gzip.decompress(response.get_data())
+        assert response.headers['ETag'] != etag and not response.headers['ETag'].startswith('W/')
+
+        response = client.get('/register', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        assert (304, b'') == (response.status_code, response.get_data())
+        response = client.get('/register', headers={'If-None-Match': etag})
+        assert 304 == response.status_code
+
+        # Rendered once per process, whatever the number of hits.
+        with count_queries(app) as statements:
+            for _ in range(3):
+                assert 200 == client.get('/login').status_code
+        assert [] == statements
+        assert {'register.html', 'login.html'} <= set(app.extensions['pages'].pages)
+
+    def test_chat_form_is_private(self, app, client):
+        client = app.test_client()
+        client.post('/login', data={'username': 'a', 'password': '1'})
+        response = client.get('/chat')
+        assert 200 == response.status_code and b'name = "_to"' in response.get_data()
+        assert response.headers['Cache-Control'] == 'private, no-cache'
+
+################################################################################
+
+class TestMetrics():
+    def test_disabled(app, client):
+        assert client.get('/metrics').status_code == 404
+
+    def test_request_metrics(self, tmp_path, caplog):
+        measured = create_app(test=True, config={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'metrics.db'),
+            'METRICS': True,
+            'METRICS_SLOW_REQUEST_MS': 0.001,
+        })
+        with measured.app_context():
+            db.create_all()
+        client = measured.test_client()
+        # Bodies are read, as a server would send them.
+        client.get('/users').get_data()
+        client.get('/users?limit=1').get_data()
+        client.get('/tweet').get_data()
+        client.get('/nowhere').get_data()
+
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        body = response.get_data(as_text=True)
+        # Streamed responses are recorded once they have been sent, with their queries.
+        assert 'http_request_duration_seconds_count{endpoint="users",method="GET"} 2' in body
+        assert 'http_request_duration_seconds_bucket{endpoint="users",method="GET",le="+Inf"} 2' in body
+        assert 'http_requests_total{endpoint="tweets",method="GET",status="302"} 1' in body
+        assert 'http_requests_total{endpoint="unmatched",method="GET",status="404"} 1' in body
+        assert 'db_queries_total{endpoint="users",method="GET"} 2' in body
+        assert 'http_response_size_bytes_total{endpoint="users",method="GET"} 6' in body
+        assert 'user_cache_hits_total 0' in body
+        assert any('Slow request GET /users?limit=1' in record.message and 'SELECT' in record.message
+                   for record in caplog.records)
+
+################################################################################
+
+class TestRateLimit():
+    def test_token_buckets(app):
+        buckets = TokenBuckets(shards=1, sweep_every=4)
+        assert [0, 0, 0] == [buckets.take('a', 3, 60) for _ in range(3)]
+        assert 19 < buckets.take('a', 3, 60) <= 20
+        # Other keys have their own bucket.
+        assert 0 == buckets.take('b', 3, 60)
+        # Buckets that have refilled are dropped.
+        assert 0 == buckets.take('c', 1000, 0.001)
+        time.sleep(0.01)
+        for key in 'de':
+            buckets.take(key, 1000, 0.001)
+        assert 'c' not in buckets.shards[0][1]
+        assert 'a' in buckets.shards[0][1]
+
+    def test_limited_routes(self, tmp_path):
+        limited = create_app(test=True, config={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'limits.db'),
+            'RATE_LIMIT': True,
+            'RATE_LIMITS': {'login': '2/minute', 'like': '3/minute'},
+            'PASSWORD_HASH_WORKERS': 0,
+        })
+        with limited.app_context():
+            db.create_all()
+            db.session.add(User('writer', password='pw'))
+            db.session.commit()
+        client = limited.test_client()
+
+        # Before login, requests are limited per address.
+        for _ in range(2):
+            assert 404 == client.post('/login', data={'username': 'nobody', 'password': 'x'}).status_code
+        response = client.post('/login', data={'username': 'writer', 'password': 'pw'})
+        assert 429 == response.status_code
+        assert 0 < int(response.headers['Retry-After']) <= 30
+        assert {'error': 'Too many requests, try again later.'} == json.loads(response.get_data(as_text=True))
+
+        # Logged in users have their own limits.
+        with client.session_transaction() as session:
+            session['_user_id'] = '1'
+            session['_fresh'] = True
+
+        # Like and unlike share one limit, and rejected requests run no queries.
+        for path in ['/like', '/unlike', '/like']:
+            assert 404 == client.post(path, data={'tweet_id': '1'}).status_code
+        with count_queries(limited) as statements:
+            assert 429 == client.post('/unlike', data={'tweet_id': '1'}).status_code
+        assert [] == statements
+        # Routes without a limit are not affected.
+        assert 200 == client.get('/tweet').status_code
+
+################################################################################
+
+# Send one request to an ASGI app and return its status, headers and body.
+async def asgi_request(asgi_app, method, path, form=None, cookie=None, query=''):
+    body = urlencode(form).encode() if form is not None else b''
+    headers = [(b'content-type', b'application/x-www-form-urlencoded')] if form is not None else []
+    if cookie:
+        headers.append((b'cookie', cookie.encode()))
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': query.encode(),
+        'headers': headers, 'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    response_headers = {name.decode().lower(): value.decode() for name, value in sent[0]['headers']}
+    return sent[0]['status'], response_headers, b''.join(m.get('body', b'') for m in sent[1:])
+
+class TestASGI():
+    def test_async_routes(self, tmp_path):
+        asgi = pytest.importorskip('asgi')
+        asgi_app = asgi.create_asgi_app(test=True, config={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'asgi.db'),
+            'PASSWORD_HASH_WORKERS': 1,
+            'METRICS': True,
+        })
+        create_schema(asgi_app.app)
+
+        async def scenario():
+            try:
+                await requests()
+            finally:
+                await asgi_app.db.close()
+
+        async def requests():
+            request = lambda *args, **kwargs: asgi_request(asgi_app, *args, **kwargs)
+            for username in ['async', 'async2']:
+                status, _, _ = await request('POST', '/register', {'username': username, 'password': 'pw', 'password2': 'pw'})
+                assert 302 == status
+            status, _, body = await request('POST', '/register', {'username': 'async', 'password': 'pw', 'password2': 'pw'})
+            assert (409, {'error': 'User exists, try another username!'}) == (status, json.loads(body))
+            assert 401 == (await request('POST', '/login', {'username': 'async', 'password': 'wrong'}))[0]
+
+            status, headers, _ = await request('POST', '/login', {'username': 'async', 'password': 'pw'})
+            assert 302 == status
+            cookie = headers['set-cookie'].split(';')[0]
+
+            status, headers, _ = await request('POST', '/chat', {'_to': 'async2', 'content': 'hi'})
+            assert (302, '/login?next=%2Fchat') == (status, headers['location'])
+            assert 200 == (await request('POST', '/chat', {'_to': 'async2', 'content': 'hi'}, cookie))[0]
+            status, _, body = await request('GET', '/history/sent', cookie=cookie)
+            assert [{'_to': 'async2', 'message': 'hi'}] == json.loads(body)
+
+            assert 200 == (await request('POST', '/tweet', {'title': 'async', 'content': 'from asgi'}, cookie))[0]
+            status, headers, body = await request('GET', '/tweet', cookie=cookie)
+            assert [{'author': 'async', 'tweet_id': 1, 'title': 'async', 'content': 'from asgi', 'like': 0}] == json.loads(body)
+            etag = headers['etag']
+
+            status, _, body = await request('POST', '/like', {'tweet_id': '1'}, cookie)
+            assert (200, 'Liked the Tweet! Like count is now 1!') == (status, json.loads(body)['success'])
+            assert 409 == (await request('POST', '/like', {'tweet_id': '1'}, cookie))[0]
+            assert 404 == (await request('POST', '/like', {'tweet_id': '99'}, cookie))[0]
+            assert 404 == (await request('POST', '/like', {'tweet_id': '99999999999999999999999'}, cookie))[0]
+            assert 200 == (await request('POST', '/unlike', {'tweet_id': '1'}, cookie))[0]
+
+            # The like changed the version of the tweet listing.
+            status, headers, _ = await request('GET', '/tweet', cookie=cookie + '; x=1')
+            assert headers['etag'] != etag
+
+            # Other routes are served by the Flask app, with the same session.
+            status, _, body = await request('GET', '/timeline', cookie=cookie)
+            assert (200, ['async']) == (status, [t['title'] for t in json.loads(body)])
+            status, _, body = await request('GET', '/inbox', cookie=cookie)
+            assert ['async2'] == [c['username'] for c in json.loads(body)['conversations']]
+
+            # The async handlers are measured under the endpoints of the Flask routes.
+            _, _, body = await request('GET', '/metrics')
+            for line in ['http_requests_total{endpoint="register",method="POST",status="302"} 2',
+                         'http_requests_total{endpoint="register",method="POST",status="409"} 1',
+                         'http_requests_total{endpoint="like",method="POST",status="404"} 2']:
+                assert line in body.decode()
+            assert 'db_queries_total{endpoint="chat",method="POST"} 6' in body.decode()
+
+        asyncio.run(scenario())
+
+################################################################################
+
+class TestStartup():
+    def test_schema_is_an_explicit_step(self, tmp_path):
+        config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'main.db'),
+            'ARCHIVE_DATABASE': str(tmp_path / 'archive.db'),
+        }
+        # Creating the app touches no database.
+        app = create_app(test=True, config=config)
+        assert not (tmp_path / 'main.db').exists() and not (tmp_path / 'archive.db').exists()
+
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        assert 0 == result.exit_code, result.output
+        with app.app_context():
+            assert {'user', 'tweet', 'message', 'timeline'} <= set(inspect(db.engine).get_table_names())
+        assert 'message_segment' in inspect(app.extensions['archive'].engine).get_table_names()
+
+        # The first request of a new worker runs its query and nothing else.
+        worker = create_app(test=True, config=config)
+        with count_queries(worker) as statements:
+            assert 200 == worker.test_client().get('/users').status_code
+        assert 1 == len(statements) and statements[0].startswith('SELECT')
+
+    # A cold start answers its first request without importing what is only
+    # needed later. Timing depends on the machine and its load, so the budget
+    # is only checked when asked:
+    #   STARTUP_BUDGET=1 python -m pytest unit_test.py -k cold_start
+    def test_cold_start(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'startup.py')
+        args = [sys.executable, script, '--runs', '1'] + (['--check'] if os.environ.get('STARTUP_BUDGET') else [])
+        result = subprocess.run(args, capture_output=True, text=True)
+        assert 0 == result.returncode, result.stdout + result.stderr
+        assert [] == json.loads(result.stdout.splitlines()[0])['lazy_modules']
+
+################################################################################
+
+class TestUpgrade():
+    # The database in the repository was made before the columns added since.
+    def test_upgrade_shipped_database(self, tmp_path):
+        path = tmp_path / 'upgrade.db'
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twitter_clone.db'), path)
+        old = sqlite3.connect(str(path))
+        old.executemany('INSERT INTO user (username, password_hash) VALUES (?, ?)',
+                        [(username, generate_password_hash('pw')) for username in ('old', 'old2')])
+        old.executemany('INSERT INTO message (_from, _to, content) VALUES (?, ?, ?)',
+                        [('old', 'old2', 'first'), ('old2', 'old', 'second'), ('old', 'gone', 'lost'), ('old', 'old2', 'third')])
+        old.execute('INSERT INTO tweet (uid, title, content, "like") SELECT id, ?, ?, 0 FROM user WHERE username = ?',
+                    ('old tweet', 'from before', 'old'))
+        old.commit()
+        old.close()
+
+        app = create_app(test=True, config={'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(path), 'PASSWORD_HASH_WORKERS': 0})
+        result = app.test_cli_runner().invoke(args=['init-db'])
+        assert 0 == result.exit_code, result.output
+        # Running it again finds nothing to do.
+        assert 0 == app.test_cli_runner().invoke(args=['init-db']).exit_code
+
+        client = app.test_client()
+        assert 302 == client.post('/login', data={'username': 'old', 'password': 'pw'}).status_code
+        assert 200 == client.post('/follow', data={'username': 'old2'}).status_code
+        with app.app_context():
+            assert [0, 1] == [User.query.filter_by(username=name).one().follower_count for name in ('old', 'old2')]
+            indexes = [row[1] for row in db.session.execute("PRAGMA index_list('message')")]
+            assert {'ix_message_sender_id_created_at', 'ix_message_recipient_id_created_at'} <= set(indexes)
+            assert 'ix_tweet_created_at' in [row[1] for row in db.session.execute("PRAGMA index_list('tweet')")]
+            assert Tweet.query.filter_by(title='old tweet').one().created_at is not None
+
+        # Old messages are in the inbox, unread until read.
+        response0 = client.get('/inbox')
+        inbox = json.loads(response0.get_data(as_text=True))
+        assert [('old2', 1, 'third')] == [(c['username'], c['unread'], c['last_message']['message']) for c in inbox['conversations']]
+        assert (1, 1) == (inbox['unread_messages'], inbox['unread_conversations'])
+
+        # Old messages keep their order, and one to a user who is gone stays with its sender.
+        response = client.get('/history/sent')
+        assert [('old2', 'first'), ('gone', 'lost'), ('old2', 'third')] == [(m['_to'], m['message']) for m in json.loads(response.get_data(as_text=True))]
+        response2 = client.get('/conversation/old2')
+        assert ['third', 'second', 'first'] == [m['message'] for m in json.loads(response2.get_data(as_text=True))]
+        assert 200 == client.post('/chat', data={'_to': 'old2', 'content': 'new'}).status_code
+        response3 = client.get('/conversation/old2?limit=1')
+        assert ['new'] == [m['message'] for m in json.loads(response3.get_data(as_text=True))]
+
+        # Old tweets and messages can be searched.
+        response5 = client.get('/search?q=before')
+        assert ['old tweet'] == [t['title'] for t in json.loads(response5.get_data(as_text=True))]
+        response6 = client.get('/search?type=messages&q=first')
+        assert ['first'] == [m['message'] for m in json.loads(response6.get_data(as_text=True))]
+
+        # The old tweet is listed with the new ones.
+        assert 200 == client.post('/tweet', data={'title': 'new tweet', 'content': 'from after'}).status_code
+        response4 = client.get('/tweet')
+        assert ['new tweet', 'old tweet'] == [t['title'] for t in json.loads(response4.get_data(as_text=True))]
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from models import User
+from db import db
+
+# Process-wide cache of user rows for Flask-Login. Every authenticated request
+# loads its user, so the rows are kept here as detached copies, least recently
+# used first, each for at most ttl seconds. A hit is merged into the request's
+# session without loading it, so the session's identity map then serves every
+# other lookup of that user by id during the request.
+#
+# Users changed through the ORM are dropped from the cache automatically. Code
+# that changes user rows with plain SQL calls invalidate_user. Other processes
+# only notice a change once the ttl has passed.
+class UserCache:
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, user):
+        if self.size <= 0:
+            return
+        copy = User.__mapper__.class_manager.new_instance()
+        for attribute in User.__mapper__.column_attrs:
+            setattr(copy, attribute.key, getattr(user, attribute.key))
+        make_transient_to_detached(copy)
+        with self.lock:
+            self.users[user.id] = (time.monotonic() + self.ttl, copy)
+            self.users.move_to_end(user.id)
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.users)}
+
+    # Return the user with this id attached to the current session, or None.
+    def load(self, user_id):
+        cached = self.get(user_id)
+        if cached is not None:
+            return db.session.merge(cached, load=False)
+        user = User.query.get(user_id)
+        if user is not None:
+            self.put(user)
+        return user
+
+def init_user_cache(app):
+    app.extensions['user_cache'] = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+def invalidate_user(user_id):
+    cache = current_app.extensions.get('user_cache')
+    if cache is not None:
+        cache.invalidate(user_id)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, user):
+    invalidate_user(user.id)
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from sqlalchemy import text
+from db import db, reader, run_steps
+
+BUMP = text(
+    'INSERT INTO table_version (name, version) VALUES (:name, 1) '
+    'ON CONFLICT (name) DO UPDATE SET version = version + 1'
+)
+READ = text('SELECT version FROM table_version WHERE name = :name')
+
+# Increase the version of a table in the caller's transaction, so that it
+# changes exactly when the write becomes visible. connection can be given by
+# code that writes outside the session.
+def bump_version(name, connection=None):
+    (connection or db.session).execute(BUMP, {'name': name})
+
+# The same, as steps (see db.run_steps).
+def bump(name):
+    yield BUMP, {'name': name}
+
+def version(name):
+    rows = yield READ, {'name': name}
+    return rows[0].version if rows else 0
+
+def current_version(name):
+    return run_steps(version(name), reader())
+
+# A bounded cache of encoded responses, least recently used first. Keys start
+# with the table version, so a write makes all older entries unreachable and
+# they are evicted as new ones come in.
+class ResponseCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+def init_response_cache(app):
+    app.extensions['tweet_cache'] = ResponseCache(app.config['TWEET_CACHE_SIZE'])